@@ -201,6 +201,13 @@ class MultiBackend(BackendBase):
     def download(self, url, user_data=None):
         return any(backend.download(url, user_data) for backend in self.backends)
 
+    def search(self, keywords, scope="global"):
+        for backend in self.backends:
+            search = backend.search(keywords, scope)
+            if search:
+                return search
+        return None
+
     def run(self):
         current_backends_classes = {backend.__class__ for backend in self.backends}
         new_backends = [
@@ -217,7 +224,7 @@ class MultiBackend(BackendBase):
                 # Proxy events
                 for name in ("download_new", "download_update",
                              "download_remove", "download_hide",
-                             "download_unhide"):
+                             "download_unhide", "search_update"):
                     backend.on(name, functools.partial(self.emit, name))
                 # Setting known state
                 try:
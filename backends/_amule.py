@@ -8,12 +8,18 @@ import os.path
 import hashlib
 import random
 import time
+import errno
 import logging
+import operator
+import itertools
+import heapq
 import urlparse
 import struct
+import socket
 import threading
 
 import shutil
+import Queue as queue
 
 try:
     import cStringIO as StringIO
@@ -121,6 +127,263 @@ uint32_t file tag count
 
 '''
 
+class Finalizer(object):
+    '''
+    Move files of finished downloads out of aMule incoming directory
+    using a single background thread.
+
+    Files are renamed when source and destination are on the same
+    device, and copied in chunks (reporting progress) otherwise.
+
+    Progress and results are queued and applied to downloads by
+    process_results, on backend refresh.
+    '''
+    chunksize = 1048576 # 1 MiB
+    progress_interval = 0.5
+
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._results = queue.Queue() # (download method, args)
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def add(self, download, src_dir):
+        '''
+        Enqueue download, its finalize_progress, finalize_done and
+        finalize_failed methods will be called by process_results.
+        '''
+        self._queue.put((download, src_dir))
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+
+    def process_results(self):
+        '''
+        Call download methods queued by worker thread, must be called
+        from main thread.
+        '''
+        while True:
+            try:
+                method, args = self._results.get_nowait()
+            except queue.Empty:
+                break
+            method(*args)
+
+    def _run(self):
+        while True:
+            try:
+                download, src_dir = self._queue.get(True, 5)
+            except queue.Empty:
+                with self._lock:
+                    if self._queue.empty():
+                        self._thread = None
+                        return
+                continue
+            try:
+                filenames = self._finalize(download, src_dir)
+            except BaseException as e:
+                logger.exception(e)
+                self._results.put((download.finalize_failed, (e,)))
+            else:
+                self._results.put((download.finalize_done, (filenames,)))
+
+    def _finalize(self, download, src_dir):
+        dst_dir = download.download_dir
+        if not os.path.isdir(dst_dir):
+            os.makedirs(dst_dir)
+        # One listing instead of probing every candidate name
+        taken = set(my_env.get_listdir(dst_dir))
+        moves = []
+        for name in download.filenames:
+            src = os.path.join(src_dir, name)
+            if not os.path.exists(src):
+                logger.error("File %s does not exists." % src)
+                continue
+            if name in taken:
+                base, ext = name.rsplit(".", 1) if "." in name else (name, None)
+                for j in itertools.count():
+                    aux = "%s - %d.%s" % (base, j, ext) if ext else "%s - %d" % (base, j)
+                    if not aux in taken:
+                        name = aux
+                        break
+            taken.add(name)
+            moves.append((src, os.path.join(dst_dir, name), name))
+
+        total = sum(os.stat(src).st_size for src, dst, name in moves)
+        done = 0
+        for src, dst, name in moves:
+            try:
+                os.rename(src, dst)
+                done += os.stat(dst).st_size
+                continue
+            except OSError as e:
+                if e.errno != errno.EXDEV:
+                    raise
+            try:
+                done = self._copy(download, src, dst, done, total)
+            except BaseException:
+                # Never leave a truncated copy behind
+                try:
+                    os.remove(dst)
+                except OSError:
+                    pass
+                raise
+            os.remove(src)
+        return [name for src, dst, name in moves] or download.filenames
+
+    def _copy(self, download, src, dst, done, total):
+        '''
+        Chunked cross-device copy, returns updated done bytes
+        '''
+        chunksize = max(self.chunksize, my_env.get_blocksize(os.path.dirname(dst)))
+        last = time.time()
+        with open(src, "rb") as fsrc:
+            with open(dst, "wb") as fdst:
+                chunk = fsrc.read(chunksize)
+                while chunk:
+                    fdst.write(chunk)
+                    done += len(chunk)
+                    now = time.time()
+                    if now - last > self.progress_interval:
+                        last = now
+                        self._results.put((download.finalize_progress, (done, total)))
+                    chunk = fsrc.read(chunksize)
+        shutil.copystat(src, dst)
+        self._results.put((download.finalize_progress, (done, total)))
+        return done
+
+
+class Search(object):
+    '''
+    aMule search polled on every backend refresh.
+
+    Results are fetched incrementally on a reserved EC socket and merged
+    in an index by file hash (source counts are merged keeping the
+    highest seen). Only new or changed results are emitted by backend
+    as `search_update` events.
+
+    Index holds at most `max_results` entries as (name, size, sources,
+    complete sources) tuples, results with less sources are dropped
+    first.
+
+    If daemon refuses to start it or its socket fails, search is
+    finished and flagged as `failed`, with daemon answer or error as
+    `message`.
+    '''
+    max_results = 20000
+    finished_status = frozenset((100, 0xFFFF))
+
+    def __init__(self, backend, keywords, scope="global"):
+        self.backend = backend
+        self.keywords = keywords
+        self.scope = scope
+        self.progress = 0
+        self.finished = False
+        self.failed = False
+        self.message = None
+        self._index = {}
+        self._socket = None
+
+    def start(self):
+        client = self.backend.client
+        self._socket = client.reserve_socket()
+        try:
+            success, message = getattr(client, "search_%s" % self.scope)(self.keywords, self._socket)
+        except BaseException as e:
+            logger.exception(e)
+            success, message = False, "%s" % e
+        if not success:
+            logger.debug("Search %r failed: %s" % (self.keywords, message))
+            client.release_socket(self._socket) # no-op if socket was closed
+            self._socket = None
+            self.message = message
+            self.failed = self.finished = True
+
+    def stop(self):
+        if self._socket:
+            client = self.backend.client
+            if not self.finished:
+                client.search_stop(self._socket)
+            client.release_socket(self._socket)
+            self._socket = None
+        self.finished = True
+
+    def __len__(self):
+        return len(self._index)
+
+    def result(self, key):
+        name, size, sources, complete_sources = self._index[key]
+        return {
+            "hash": key.encode("hex"),
+            "name": name,
+            "size": size,
+            "sources": sources,
+            "complete_sources": complete_sources,
+            }
+
+    @property
+    def results(self):
+        return [self.result(key) for key in self._index]
+
+    def poll(self):
+        '''
+        Fetch progress and changed results, emit search_update if any.
+        '''
+        if self._socket is None:
+            return
+        client = self.backend.client
+        try:
+            if self._socket.closed:
+                raise ec.ConnectionFailedError("Search socket closed.")
+            status = client.search_progress(self._socket)
+            records = client.search_results(True, self._socket)
+        except (ec.ConnectionFailedError, socket.error) as e:
+            # Reserved socket is closed on errors, and incremental state
+            # is lost with it, so search cannot continue. Not a sync
+            # failure, daemon is checked by refresh.
+            logger.debug("Search %r failed: %s" % (self.keywords, e))
+            self._socket = None
+            self.message = "%s" % e
+            self.failed = self.finished = True
+            self.backend.emit("search_update", self, [])
+            return
+        if not status is None and status != 0xFFFE:
+            self.progress = min(status, 100)
+        index = self._index
+        changed = []
+        for record in records.itervalues():
+            key = record.partfile_hash or record.value
+            old = index.get(key)
+            if old is None:
+                entry = (
+                    record.partfile_name, record.partfile_size_full,
+                    record.partfile_source_count or 0,
+                    record.partfile_source_count_xfer or 0
+                    )
+            else:
+                # Incremental updates carry only changed fields
+                entry = (
+                    old[0] if record.partfile_name is None else record.partfile_name,
+                    old[1] if record.partfile_size_full is None else record.partfile_size_full,
+                    max(old[2], record.partfile_source_count or 0),
+                    max(old[3], record.partfile_source_count_xfer or 0)
+                    )
+            if entry != old:
+                index[key] = entry
+                changed.append(key)
+        if len(index) > self.max_results:
+            keep = heapq.nlargest(self.max_results, index.iteritems(), key=lambda i: i[1][2])
+            index.clear()
+            index.update(keep)
+            changed = [key for key in changed if key in index]
+        if status in self.finished_status:
+            self.stop()
+        if changed or self.finished:
+            self.backend.emit("search_update", self, [self.result(key) for key in changed])
+
+
 class Download(DownloadBase):
     _custom_status = (
         "connecting", "looking for peers", "downloading from %d peers"
@@ -140,45 +403,45 @@ class Download(DownloadBase):
     _has_data = False
     def _update(self, data = None):
         if data is None:
-            if self.finished and not all(
-              os.path.exists(os.path.join(self.download_dir, i))
-              for i in self.filenames):
-                self.backend.download(self.ed2k_link)
-                self.finished = False
+            if self.finished and not self.processing:
+                names = self.backend.listdir_cached(self.download_dir)
+                if not all(i in names for i in self.filenames):
+                    self.backend.download(self.ed2k_link)
+                    self.finished = False
             return
         self._has_data = True
 
-        partfile = data.partfile
-
         self.last_update = time.time()
-        self.hash = partfile.hash.encode("hex")
-        self.name = partfile.name
-        self.filenames = [partfile.name]
-        self.size = partfile.size.full
-        self.comments = partfile.comments.values() if hasattr(partfile, "comments") and partfile.comments else []
-        self.ed2k_link = partfile.ed2k_link
+        self.hash = data.partfile_hash.encode("hex")
+        self.name = data.partfile_name
+        if not self.finished: # Finished filenames could be renamed
+            self.filenames = [data.partfile_name]
+        self.size = data.partfile_size_full
+        comments = data.partfile_comments
+        self.comments = [v for k, v in comments[1] if isinstance(v, unicode)] if comments else []
+        self.ed2k_link = data.partfile_ed2k_link
 
         '''
-        if hasattr(partfile, "part_status"):
+        if data.partfile_part_status:
             self._parts = [
                 b == "1"
-                for i in partfile.part_status
+                for i in data.partfile_part_status
                 for b in bin(ord(i))[2:].rjust(8, "0")
                 ]
         elif self.finished:
             self._parts = [True]
         '''
 
-        if data.is_downloading:
+        if self.hash in self.backend._downloading:
             self.finished = False
-            self.progress = float(partfile.size.done) / partfile.size.full
-            self.paused = partfile.status == 7
-            self.downloaded = partfile.size.done
-            self.downspeed = partfile.speed if hasattr(partfile, "speed") else 0
-            self.upspeed = partfile.size_xfer_up if hasattr(partfile, "size_xfer_up") else 0
-
-            self.sources = partfile.source_count_xfer
-            state_code = partfile.status
+            self.progress = float(data.partfile_size_done) / data.partfile_size_full
+            self.paused = data.partfile_status == 7
+            self.downloaded = data.partfile_size_done
+            self.downspeed = data.partfile_speed or 0
+            self.upspeed = data.partfile_size_xfer_up or 0
+
+            self.sources = data.partfile_source_count_xfer
+            state_code = data.partfile_status
             downloading = False
             if state_code in (2, 3):
                 state = self._status[3]
@@ -194,40 +457,47 @@ class Download(DownloadBase):
             self.downloading = downloading
         elif not self.finished:
             self.finished = True
+            self.processing = True
             logger.debug("Finishing download %s" % self.name)
-            self.state = self._status[9]
+            self.state = self._status[8]
             self.progress = 1
             self.downloaded = self.size
             self.downspeed = 0
             self.downloading = False
-            old_dir = self.backend.amule_download_dir
             logger.debug("Removing %s from queue" % self.name)
-            self.backend.client.remove_hash(self.hash)
+            self.backend.client.remove_hash(self.hash.decode("hex"))
             logger.debug("Moving files of %s to download folder." % self.name)
-            # Ensure download_dir exists
-            if not os.path.isdir(self.download_dir):
-                os.makedirs(self.download_dir)
-            # Move download files to download_dir
-            for n, i in enumerate(self.filenames):
-                p = os.path.join(old_dir, i)
-                if os.path.exists(p):
-                    d = os.path.join(self.download_dir, i)
-                    if os.path.exists("%s" % d):
-                        g, ext = d.rsplit(".", 1)
-                        for j in xrange(sys.maxint):
-                            aux = "%s - %d.%s" % (g, j, ext)
-                            if not os.path.exists(aux):
-                                d = aux
-                                break
-                        self.filenames[n] = d
-                    shutil.move(p, d)
-                else:
-                    logger.error("File %s does not exists." % p)
-            logger.debug("Download %s finished." % self.name)
+            self.backend.finalizer.add(self, self.backend.amule_download_dir)
+
+    def finalize_progress(self, done, total):
+        '''
+        Called by Finalizer.process_results (on main thread) while moving files
+        '''
+        self.state = "%s (%d%%)" % (self._status[8], 100 * done / total) if total else self._status[8]
+        self.backend.outdated_downloads.add(self)
+
+    def finalize_done(self, filenames):
+        '''
+        Called by Finalizer.process_results (on main thread) once files are moved
+        '''
+        self.filenames = filenames
+        self.processing = False
+        self.state = self._status[9]
+        self.backend.outdated_downloads.add(self)
+        logger.debug("Download %s finished." % self.name)
+
+    def finalize_failed(self, error):
+        '''
+        Called by Finalizer.process_results (on main thread) when files could not be moved
+        '''
+        self.processing = False
+        self.state = self._status[4]
+        self.backend.outdated_downloads.add(self)
+        logger.error("Download %s could not be moved: %s" % (self.name, error))
 
     def refresh(self):
-        self._update(self.backend._data[self.hash])
-        DownloadBase.refresh()
+        self._update(self.backend._data.get(self.hash))
+        DownloadBase.refresh(self)
 
     def has_metadata(self):
         return self._has_data
@@ -769,6 +1039,13 @@ class Backend(BackendBase):
     _sync_numfails = 0
     _sync_restarting_daemon = False
 
+    # Record fields Download._update depends on
+    _fingerprint = staticmethod(operator.attrgetter(
+        "partfile_name", "partfile_size_full", "partfile_size_done",
+        "partfile_status", "partfile_speed", "partfile_size_xfer_up",
+        "partfile_source_count_xfer", "partfile_ed2k_link", "partfile_comments",
+        ))
+
     _last_hashes = frozenset()
     _last_hash = None
     def refresh(self):
@@ -786,34 +1063,46 @@ class Backend(BackendBase):
 
                 # Queue merge (one file can be in two queues)
                 downloads = {}
-                for queue in (dlq, ulq, shd):
-                    is_downloading = queue is dlq
+                downloading = set()
+                for is_downloading, queue in ((True, dlq), (False, ulq), (False, shd)):
                     for download in queue.itervalues():
                         dhash = download.partfile_hash.encode("hex")
+                        if is_downloading:
+                            downloading.add(dhash)
                         if dhash in downloads:
                             downloads[dhash].update(download)
-                            downloads[dhash]["is_downloading"] |= is_downloading
                         else:
                             downloads[dhash] = download
-                            downloads[dhash]["is_downloading"] = is_downloading
 
-                downloads_changed = downloads != self._data #frozen_cmp(downloads, self._data) != 0
+                # Only downloads whose fingerprint changed are outdated
+                fingerprint = self._fingerprint
+                last_fingerprints = self._fingerprints
+                fingerprints = {
+                    dhash: (dhash in downloading, fingerprint(download))
+                    for dhash, download in downloads.iteritems()
+                    }
+                changed = [
+                    dhash for dhash, fp in fingerprints.iteritems()
+                    if last_fingerprints.get(dhash) != fp
+                    ]
 
                 self._status.update(status)
                 self._data = downloads
+                self._downloading = downloading
+                self._fingerprints = fingerprints
 
-                if downloads_changed:
-                    # Download updates
-                    for dhash, download in downloads.iteritems():
-                        if dhash in self._downloads:
-                            self.outdated_downloads.add(self._downloads[dhash])
-                        else:
-                            self._downloads[dhash] = Download(self, download, None)
-                            self.emit("download_new", self._downloads[dhash])
+                # Download updates
+                for dhash in changed:
+                    if dhash in self._downloads:
+                        self.outdated_downloads.add(self._downloads[dhash])
+                    else:
+                        self._downloads[dhash] = Download(self, downloads[dhash], None)
+                        self.emit("download_new", self._downloads[dhash])
 
+                if changed or len(fingerprints) != len(last_fingerprints):
                     # Removing deleted downloads
                     unowned = not self.manager is self
-                    for dhash in frozenset(downloads).symmetric_difference(self._downloads):
+                    for dhash in frozenset(self._downloads).difference(downloads):
                         if self._downloads[dhash].finished:
                             self.outdated_downloads.add(self._downloads[dhash])
                         else:
@@ -822,6 +1111,11 @@ class Backend(BackendBase):
                                 self.manager.remove(self._downloads[dhash])
                             del self._downloads[dhash]
 
+                # Active searches
+                for search in self._searches:
+                    search.poll()
+                self._searches[:] = [i for i in self._searches if not i.finished]
+
                 self._status_cache = ("",)
             else:
                 self._status_cache = ("backend not ready",)
@@ -850,8 +1144,37 @@ class Backend(BackendBase):
                 self._sync_worked_once = True
                 self._sync_max_numfails = 1
             self._sync_numfails = 0
+        self.finalizer.process_results()
         BackendBase.refresh(self)
 
+    def search(self, keywords, scope="global"):
+        '''
+        Start a search, scope can be "local", "global" or "kad".
+
+        Returns Search instance, or None if daemon is not ready.
+        '''
+        if not self.ready:
+            return None
+        search = Search(self, keywords, scope)
+        search.start()
+        self._searches.append(search)
+        return search
+
+    def listdir_cached(self, path):
+        '''
+        Directory listing as frozenset, cached until directory mtime
+        changes, so finished downloads are checked with a single stat.
+        '''
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            return frozenset()
+        cached = self._listdir_cache.get(path)
+        if cached is None or cached[0] != mtime:
+            cached = (mtime, frozenset(my_env.get_listdir(path)))
+            self._listdir_cache[path] = cached
+        return cached[1]
+
     def can_download(self, url):
         if (
          (url.startswith("ed2k://") and "|" in url) or
@@ -893,6 +1216,11 @@ class Backend(BackendBase):
         self._status = ec.TagDict()
         self._downloads = {}
         self._data = {}
+        self._downloading = frozenset()
+        self._fingerprints = {}
+        self._listdir_cache = {}
+        self.finalizer = Finalizer()
+        self._searches = []
         self._download_queue = []
         self._status_cache = ("starting backend",)
         self._tmp_user_data = {}
@@ -978,6 +1306,9 @@ class Backend(BackendBase):
     def stop(self):
         self._stopped = True
         if self.ready:
+            for search in self._searches:
+                search.stop()
+            del self._searches[:]
             self.client.stop_paused_downloads()
             self.client.shutdown()
             for i in xrange(50):
@@ -38,6 +38,7 @@ class Download(DownloadBase):
     def __init__(self, backend, data, resume_data=None):
         DownloadBase.__init__(self, backend, resume_data)
         self.data = data
+        self._boosted_pieces = {} # {piece: priority before streaming}
         if resume_data:
             self._blacklist_cache = None
 
@@ -249,6 +250,67 @@ class Download(DownloadBase):
             return 0
         return self._status.upload_payload_rate
 
+    _file_spans = None
+    def _piece_range(self, path, start, end):
+        '''
+        Get xrange of piece indexes holding bytes from start to end
+        (excluded) of given file, or None if file is unknown.
+        '''
+        if self._info is None:
+            return None
+        if self._file_spans is None:
+            self._file_spans = {
+                unicode(f.path, "utf-8"): (n, f.offset, f.size)
+                for n, f in enumerate(self._info.files())
+                }
+        span = self._file_spans.get(path)
+        if span is None:
+            return None
+        index, offset, size = span
+        end = min(end, size)
+        if end <= start:
+            return xrange(0)
+        piece_length = self._info.piece_length()
+        return xrange((offset + start) // piece_length, (offset + end - 1) // piece_length + 1)
+
+    def file_size(self, path):
+        if self._piece_range(path, 0, 0) is None:
+            return None
+        return self._file_spans[path][2]
+
+    def have_range(self, path, start, end):
+        pieces = self._piece_range(path, start, end)
+        if pieces is None:
+            return False
+        have_piece = self.data.have_piece
+        return all(have_piece(i) for i in pieces)
+
+    stream_deadline = 500 # milliseconds for first missing piece
+    stream_deadline_step = 250 # milliseconds added for every next piece
+    def prioritize_range(self, path, start, end):
+        pieces = self._piece_range(path, start, end)
+        if pieces and self.data.file_priority(self._file_spans[path][0]) != 0:
+            handle = self.data
+            deadline = self.stream_deadline
+            for piece in pieces:
+                if not handle.have_piece(piece):
+                    if not piece in self._boosted_pieces:
+                        self._boosted_pieces[piece] = handle.piece_priority(piece)
+                        handle.piece_priority(piece, 7)
+                    handle.set_piece_deadline(piece, deadline)
+                    deadline += self.stream_deadline_step
+
+    def release_range(self, path, start, end):
+        pieces = self._piece_range(path, start, end)
+        if pieces and self._boosted_pieces:
+            handle = self.data
+            for piece in pieces:
+                priority = self._boosted_pieces.pop(piece, None)
+                if not priority is None:
+                    handle.piece_priority(piece, priority)
+                    if hasattr(handle, "reset_piece_deadline"): # 0.16+
+                        handle.reset_piece_deadline(piece)
+
     _files_progress_cache = (0, None)
     @property
     def files_progress(self):
@@ -314,10 +376,10 @@ class Backend(BackendBase):
         BackendBase.__init__(self, config, app, version, manager)
         self.session = lt.session()
         self.tmp_resume_data = {}
-        self.handler_cache = {}
+        self.handler_cache = utils.Cache("libtorrent.alert_handlers")
         self.process_lock = threading.Lock()
         self.save_lock = threading.Lock()
-        self.state_cache = {}
+        self.state_cache = utils.Cache("libtorrent.resume_data")
         self.remove_list = []
         self.force_update = set()
 
@@ -342,12 +404,12 @@ class Backend(BackendBase):
             flushflag = lt.save_resume_flags_t.flush_disk_cache if flush else 0
             downloads = self.downloads[:]
             for download in downloads:
-                cacheid = id(download)
-                if cacheid in self.state_cache and self.state_cache[cacheid][0] == download.last_update:
+                cached = self.state_cache.get(id(download))
+                if cached and cached[0] == download.last_update:
                     # We cache resume data for unmodified torrents
                     # (low cache hits with few downloading torrents, but
                     # a lot of hits with a bunch of finished ones)
-                    self.torrent_resume_data.append(self.state_cache[cacheid][1])
+                    self.torrent_resume_data.append(cached[1])
                 else:
                     download.data.save_resume_data( flushflag | self._savedictflag)
                 nts += 1
@@ -677,18 +739,10 @@ class Backend(BackendBase):
         alert = self.session.pop_alert()
         while alert:
             name = "handle_%s" % type(alert).__name__
-            try:
-                if self.handler_cache[name]:
-                    yield (self.handler_cache[name], (alert,))
-            except KeyError:
-                if hasattr(self, name):
-                    handler = getattr(self, name)
-                    self.handler_cache[name] = handler
-                    yield (handler, (alert,))
-                else:
-                    self.handler_cache[name] = None
-            else:
-                alert = self.session.pop_alert()
+            handler = self.handler_cache.get_or_set(name, getattr, self, name, None)
+            if handler:
+                yield (handler, (alert,))
+            alert = self.session.pop_alert()
 
     def _process_alert(self):
         with self.process_lock:
@@ -708,6 +762,7 @@ class Backend(BackendBase):
 
                 for download in rmcp.intersection(self.downloads):
                     self.emit("download_remove", download)
+                    self.state_cache.pop(id(download), None)
                     for download_list in download_lists:
                         if download in download_list:
                             download_list.remove(download)
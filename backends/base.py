@@ -147,6 +147,38 @@ class Download(object):
     def remove(self):
         pass
 
+    def file_size(self, path):
+        '''
+        Get final size of given download file, or None if unknown.
+        '''
+        if self.finished:
+            try:
+                return os.path.getsize(os.path.join(self.download_dir, path))
+            except OSError:
+                pass
+        return None
+
+    def have_range(self, path, start, end):
+        '''
+        Get if bytes from start to end (excluded) of given download file
+        are already on disk.
+        '''
+        return self.finished
+
+    def prioritize_range(self, path, start, end):
+        '''
+        Ask backend to download bytes from start to end (excluded) of
+        given download file as soon as possible, for streaming.
+        '''
+        pass
+
+    def release_range(self, path, start, end):
+        '''
+        Restore normal download priority of given download file range,
+        once streaming ended.
+        '''
+        pass
+
     def json(self):
         return dict(
             (i, getattr(self, i))
@@ -179,9 +211,12 @@ class Backend(utils.EventHandler):
         |- download_hide
         |  |- Emited once download is hidden.
         |  `- Callable params: download_instance.
-        `- download_unhide
-           |- Emited once download is not hidden after being hidden.
-           `- Callable params: download_instance
+        |- download_unhide
+        |  |- Emited once download is not hidden after being hidden.
+        |  `- Callable params: download_instance
+        `- search_update
+           |- Emited by backends supporting search when results change.
+           `- Callable params: search_instance, list of changed results
     - Events emitted by managers:
         |- backend_add
         |  |- Emited when new backend is added to manager
@@ -307,6 +342,15 @@ class Backend(utils.EventHandler):
         '''
         return False
 
+    def search(self, keywords, scope="global"):
+        '''
+        Start a search on backends supporting it, see search_update
+        event.
+
+        Returns search instance, or None if not supported.
+        '''
+        return None
+
     def refresh(self):
         while self.outdated_downloads:
             outdated_download = self.outdated_downloads.pop()
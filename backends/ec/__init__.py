@@ -1,11 +1,13 @@
 from conn import Connection, ConnectionFailedError
 from packet import TagDict
+from record import ECRecord
 
-__all__ = ["Connection", "ConnectionFailedError", "OperationFailedError", "TagDict"]
+__all__ = ["Connection", "ConnectionFailedError", "OperationFailedError", "TagDict", "ECRecord"]
 
 if __name__ == "__main__":
     import doctest
-    import conn, packet, tag
+    import conn, fake, packet, record, tag
     doctest.testmod(conn)
+    doctest.testmod(fake)
     doctest.testmod(packet)
     doctest.testmod(tag)
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+EC protocol benchmark against a local FakeDaemon.
+
+USAGE: python backends/ec/bench.py [--backend] [FILES [CHURN [TICKS]]]
+
+Drives either ec.Connection queue requests or, with --backend, the
+whole _amule.Backend.refresh (which requires the app environment) and
+reports ticks per second, bytes on the wire, decode time, objects left
+behind and peak RSS.
+
+Python 2 has no allocation counters (tracemalloc), so objects are
+measured as gc tracked objects retained after all ticks
+(retained_gc_objects), which shows leaks and caches growth but not
+short-lived allocations.
+'''
+
+import sys
+import os
+import os.path
+import gc
+import time
+import shutil
+import tempfile
+import functools
+
+import conn
+import fake
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+PASSWORD = "bench"
+
+class DecodeTimer(object):
+    '''
+    Context manager accumulating time spent in ReadPacketData of given
+    conn module.
+    '''
+    def __init__(self, module):
+        self.module = module
+        self.elapsed = 0.
+        self.calls = 0
+
+    def _wrapper(self, fnc, *args, **kwargs):
+        t = time.time()
+        try:
+            return fnc(*args, **kwargs)
+        finally:
+            self.elapsed += time.time() - t
+            self.calls += 1
+
+    def __enter__(self):
+        self._original = self.module.ReadPacketData
+        self.module.ReadPacketData = functools.partial(self._wrapper, self._original)
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.module.ReadPacketData = self._original
+
+
+def connection_ticker(daemon):
+    client = conn.Connection(PASSWORD, "127.0.0.1", daemon.port, "bench", "0")
+    def tick():
+        client.get_status()
+        client.show_dl()
+        client.show_ul()
+        client.show_shared()
+    return tick, lambda: None, conn
+
+def backend_ticker(daemon):
+    root = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+    if not root in sys.path:
+        sys.path.insert(0, root)
+    from backends import _amule
+    tmpdir = tempfile.mkdtemp()
+    backend = _amule.Backend({"download_dir": tmpdir}, "bench", "0")
+    backend.download_dir = tmpdir
+    backend.client = _amule.ec.Connection(PASSWORD, "127.0.0.1", daemon.port, "bench", "0")
+    backend.ready = True
+    def close():
+        backend.ready = False
+        shutil.rmtree(tmpdir, True)
+    return backend.refresh, close, _amule.ec.conn
+
+def run(files=1000, churn=0.1, ticks=20, use_backend=False):
+    '''
+    Run benchmark and return results as dict
+    '''
+    daemon = fake.FakeDaemon(PASSWORD, files=files, churn=churn)
+    tick, close, conn_module = (backend_ticker if use_backend else connection_ticker)(daemon)
+    try:
+        tick() # Warm up: authentication, new downloads...
+        daemon.reset_counters()
+        gc.collect()
+        objects = len(gc.get_objects())
+        with DecodeTimer(conn_module) as timer:
+            start = time.time()
+            for i in xrange(ticks):
+                tick()
+            elapsed = time.time() - start
+        gc.collect()
+        objects = len(gc.get_objects()) - objects
+    finally:
+        close()
+        daemon.stop()
+    return {
+        "files": files,
+        "churn": churn,
+        "ticks": ticks,
+        "ticks_per_second": ticks / elapsed,
+        "bytes_sent_per_tick": daemon.bytes_sent / ticks,
+        "bytes_received_per_tick": daemon.bytes_received / ticks,
+        "decode_seconds_per_tick": timer.elapsed / ticks,
+        "retained_gc_objects": objects,
+        "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss if resource else -1,
+        }
+
+if __name__ == "__main__":
+    params = [i for i in sys.argv[1:] if not i.startswith("--")]
+    if "--help" in sys.argv:
+        print __doc__
+        sys.exit(0)
+    results = run(
+        int(params[0]) if len(params) > 0 else 1000,
+        float(params[1]) if len(params) > 1 else 0.1,
+        int(params[2]) if len(params) > 2 else 20,
+        "--backend" in sys.argv
+        )
+    for k in ("files", "churn", "ticks", "ticks_per_second",
+              "bytes_sent_per_tick", "bytes_received_per_tick",
+              "decode_seconds_per_tick", "retained_gc_objects", "max_rss_kb"):
+        print "%-24s %s" % (k, results[k])
@@ -41,6 +41,10 @@ class SocketWorker(object):
     def __getattr__(self, k):
         return getattr(self._sock, k)
 
+    @property
+    def closed(self):
+        return self._cancelled
+
     def __enter__(self):
         self._level += 1 # Increase level
         return self
@@ -330,9 +334,9 @@ class Connection(object):
         Stops all paused download
         """
         tags = [
-            (codes.EC_TAG_PARTFILE, str(download["partfile_hash"]))
+            (codes.EC_TAG_PARTFILE, str(download.partfile_hash))
             for download in self.show_dl().itervalues()
-            if download["partfile_status"] == 7
+            if download.partfile_status == 7
             ]
         data = ECPacket((codes.EC_OP_PARTFILE_STOP, tags))
         self.communicate(data)
@@ -386,25 +390,38 @@ class Connection(object):
         response = self.communicate(data)
         return response[1]
 
-    def search_local(self, keywords):
-        """Start a kad search.
+    def reserve_socket(self):
+        """Take a socket out of the pool for requests relying on
+        per-connection daemon state, like incremental updates.
+
+        Must be given back using release_socket."""
+        sock = self._pool.socket
+        sock.__enter__()
+        return sock
+
+    def release_socket(self, sock):
+        """Give back a socket taken by reserve_socket."""
+        sock.__exit__(None, None, None)
+
+    def search_local(self, keywords, socket=None):
+        """Start a local search.
 
         See function "search" for further details."""
-        return self.search(codes.EC_SEARCH_LOCAL, keywords)
+        return self.search(codes.EC_SEARCH_LOCAL, keywords, socket)
 
-    def search_global(self, keywords):
-        """Start a kad search.
+    def search_global(self, keywords, socket=None):
+        """Start a global search.
 
         See function "search" for further details."""
-        return self.search(codes.EC_SEARCH_GLOBAL, keywords)
+        return self.search(codes.EC_SEARCH_GLOBAL, keywords, socket)
 
-    def search_kad(self, keywords):
+    def search_kad(self, keywords, socket=None):
         """Start a kad search.
 
         See function "search" for further details."""
-        return self.search(codes.EC_SEARCH_KAD, keywords)
+        return self.search(codes.EC_SEARCH_KAD, keywords, socket)
 
-    def search(self, type, keywords):
+    def search(self, type, keywords, socket=None):
         """Start a search.
 
         Returns a tuple consisting of a boolean value indicating success and
@@ -427,31 +444,47 @@ class Connection(object):
                 )
             ])
         data = ECPacket(packet)
-        opcode, tags = self.communicate(data)
-        not_connected = "progress" in tags["search_status"]
-        return (not_connected, tags)
+        opcode, tags = self.communicate(data, False, socket)
+        message = tags.get("string", u"") if isinstance(tags, dict) else u""
+        return (opcode != codes.EC_OP_FAILED, message)
 
-    def search_progress(self):
-        """Doesn't work correctly, don't use it.
+    def search_progress(self, socket=None):
+        """Get progress of last search.
+
+        Returns search status as integer: a percentage for local and global
+        searches, 0xFFFE while a kad search is running and 0xFFFF once it
+        finished. None if unknown.
         """
         data = ECPacket((codes.EC_OP_SEARCH_PROGRESS,[]))
-        response = self.communicate(data)
-        return response
+        opcode, tags = self.communicate(data, False, socket)
+        status = tags.get("search_status") if isinstance(tags, dict) else None
+        return status if isinstance(status, (int, long)) else None
 
-    def search_results(self):
+    def search_stop(self, socket=None):
+        """Stop current search."""
+        data = ECPacket((codes.EC_OP_SEARCH_STOP,[]))
+        self.communicate(data, False, socket)
+
+    def search_results(self, incremental=False, socket=None):
         """Get results of last search.
 
-        Returns a list of search results. The data for a search result is
-         stored in a dictionary with the following keys:
-        - "name": file name
-        - "size": size in Bytes
-        - "hash": file hash stored in 16 Byte
-        - "sources": number of clients sharing the file
-        - "sources_complete": number of clients sharing all parts of the file
+        Returns a dictionary of search result records by hash, with (among
+        others) the following fields:
+        - "partfile_name": file name
+        - "partfile_size_full": size in Bytes
+        - "partfile_hash": file hash stored in 16 Byte
+        - "partfile_source_count": number of clients sharing the file
+        - "partfile_source_count_xfer": number of clients sharing all parts
+          of the file
+
+        If incremental is True, only results changed since last incremental
+        request on the same socket are sent, carrying only changed fields,
+        so a socket given by reserve_socket should be used.
         """
-        data = ECPacket((codes.EC_OP_SEARCH_RESULTS, []))
-        response = self.communicate(data)
-        return response[1]
+        tags = [(codes.EC_TAG_DETAIL_LEVEL, codes.EC_DETAIL_INC_UPDATE)] if incremental else []
+        data = ECPacket((codes.EC_OP_SEARCH_RESULTS, tags))
+        response = self.communicate(data, False, socket)
+        return response[1].get("searchfile", {}) if isinstance(response[1], dict) else {}
 
     def add_link(self, link):
         """Add link to aMule core.
@@ -464,7 +497,7 @@ class Connection(object):
 
     def pause_all(self):
         tags = [
-            (codes.EC_TAG_PARTFILE, str(v["partfile_hash"]))
+            (codes.EC_TAG_PARTFILE, str(v.partfile_hash))
             for v in self.show_dl().itervalues()
             ]
         data = ECPacket((codes.EC_OP_PARTFILE_PAUSE, tags))
@@ -472,7 +505,7 @@ class Connection(object):
 
     def resume_all(self):
         tags = [
-            (codes.EC_TAG_PARTFILE, str(v["partfile_hash"]))
+            (codes.EC_TAG_PARTFILE, str(v.partfile_hash))
             for v in self.show_dl().itervalues()
             ]
         data = ECPacket((codes.EC_OP_PARTFILE_RESUME, tags))
@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Local stand-in for amuled speaking enough of the EC protocol for
+testing and benchmarking: authentication with salt, status, download,
+upload and shared queues with synthetic part files, and searches over
+those. Any other request is answered with EC_OP_NOOP.
+
+>>> import conn
+>>> daemon = FakeDaemon("secret", files=3)
+>>> client = conn.Connection("secret", "127.0.0.1", daemon.port)
+>>> dl = client.show_dl()
+>>> len(dl)
+3
+>>> sorted(i.partfile_name for i in dl.itervalues())[0]
+u'synthetic file 0000.avi'
+>>> client.get_status()["stats_dl_speed"] > 0
+True
+>>> daemon.stop()
+'''
+
+import socket
+import struct
+import random
+import hashlib
+import zlib
+import logging
+import threading
+
+from constants import EC_CODES as codes
+from packet import ECPacket, ReadPacketData
+
+logger = logging.getLogger(__name__)
+
+class SyntheticPartfile(object):
+    '''
+    Fake part file whose progress advances on every tick
+    '''
+    def __init__(self, n, rnd):
+        self.hash = hashlib.md5("synthetic%d" % n).digest()
+        self.name = u"synthetic file %04d.avi" % n
+        self.size = rnd.randint(1 << 20, 1 << 32)
+        self.done = rnd.randint(0, self.size)
+        self.speed = 0
+        self.sources = rnd.randint(0, 50)
+        self.status = 0
+
+    def tick(self, rnd):
+        self.speed = rnd.randint(0, 1 << 20)
+        self.sources = max(0, self.sources + rnd.randint(-2, 2))
+        self.done = min(self.size - 1, self.done + self.speed)
+
+    @property
+    def link(self):
+        return u"ed2k://|file|%s|%d|%s|/" % (self.name, self.size, self.hash.encode("hex").upper())
+
+    def tag(self, shared=False):
+        subtags = [
+            (codes.EC_TAG_PARTFILE_NAME, self.name),
+            (codes.EC_TAG_PARTFILE_HASH, self.hash),
+            (codes.EC_TAG_PARTFILE_SIZE_FULL, self.size),
+            (codes.EC_TAG_PARTFILE_ED2K_LINK, self.link),
+            ]
+        if shared:
+            subtags.append((codes.EC_TAG_KNOWNFILE_XFERRED, self.done / 2))
+            return (codes.EC_TAG_KNOWNFILE, (self.hash, subtags))
+        subtags.extend((
+            (codes.EC_TAG_PARTFILE_SIZE_DONE, self.done),
+            (codes.EC_TAG_PARTFILE_SIZE_XFER, self.done),
+            (codes.EC_TAG_PARTFILE_SPEED, self.speed),
+            (codes.EC_TAG_PARTFILE_STATUS, self.status),
+            (codes.EC_TAG_PARTFILE_SOURCE_COUNT, self.sources),
+            (codes.EC_TAG_PARTFILE_SOURCE_COUNT_XFER, self.sources / 2),
+            ))
+        return (codes.EC_TAG_PARTFILE, (self.hash, subtags))
+
+
+class FakeDaemon(object):
+    '''
+    Threaded EC server on localhost.
+
+    Params:
+        password: EC password clients must authenticate with.
+        files: number of synthetic part files in download queue.
+        churn: fraction (0 to 1) of files changing on every download
+               queue request.
+        shared_every: every n-th part file is also in shared queue.
+        port: port to listen on, random if not given.
+        seed: random seed, for reproducible runs.
+
+    Bytes sent and received and number of requests are counted in
+    `bytes_sent`, `bytes_received` and `requests`.
+    '''
+    _header_struct = struct.Struct("!II")
+
+    def __init__(self, password, files=100, churn=0.1, shared_every=4, port=0, seed=0):
+        self.password = password
+        self.churn = churn
+        self.shared_every = shared_every
+        self._random = random.Random(seed)
+        self.partfiles = [SyntheticPartfile(n, self._random) for n in xrange(files)]
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.requests = 0
+        self.search_polls = 0
+        self._lock = threading.Lock()
+        self._running = True
+        self._clients = {} # socket: thread
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.bind(("127.0.0.1", port))
+        self._sock.listen(16)
+        self.port = self._sock.getsockname()[1]
+        self._thread = threading.Thread(target=self._accept)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def reset_counters(self):
+        with self._lock:
+            self.bytes_sent = 0
+            self.bytes_received = 0
+            self.requests = 0
+
+    def stop(self):
+        '''
+        Close listening and client sockets, waiting for their threads,
+        so none of them outlives the interpreter.
+        '''
+        self._running = False
+        try:
+            # Wake up accept
+            socket.create_connection(("127.0.0.1", self.port)).close()
+        except socket.error:
+            pass
+        self._thread.join()
+        self._sock.close()
+        with self._lock:
+            clients = self._clients.items()
+        for client, thread in clients:
+            try:
+                client.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+        for client, thread in clients:
+            thread.join()
+
+    def _accept(self):
+        while self._running:
+            client, addr = self._sock.accept()
+            if not self._running:
+                client.close()
+                break
+            t = threading.Thread(target=self._serve, args=(client,))
+            t.daemon = True
+            with self._lock:
+                self._clients[client] = t
+            t.start()
+
+    def _recv(self, sock, n):
+        data = ""
+        while len(data) < n:
+            d = sock.recv(n - len(data))
+            if not d:
+                raise EOFError
+            data += d
+        return data
+
+    def _serve(self, sock):
+        salt = None
+        try:
+            while self._running:
+                header = self._recv(sock, 8)
+                flags, data_len = self._header_struct.unpack(header)
+                data = self._recv(sock, data_len)
+                if flags & codes.EC_FLAG_ZLIB:
+                    data = zlib.decompress(data)
+                opcode, tags = ReadPacketData(data, bool(flags & codes.EC_FLAG_UTF8_NUMBERS))
+                if opcode == codes.EC_OP_AUTH_REQ:
+                    salt = self._random.randint(1, 0xFFFFFFFFFFFF)
+                    response = (codes.EC_OP_AUTH_SALT, [(codes.EC_TAG_PASSWD_SALT, salt)])
+                elif opcode == codes.EC_OP_AUTH_PASSWD:
+                    response = (
+                        codes.EC_OP_AUTH_OK if tags.get("passwd_hash") == self._salted_hash(salt) else
+                        codes.EC_OP_AUTH_FAIL, [])
+                else:
+                    response = self.handle(opcode, tags)
+                packet = ECPacket(response)
+                sock.sendall(packet)
+                with self._lock:
+                    self.requests += 1
+                    self.bytes_received += len(header) + data_len
+                    self.bytes_sent += len(packet)
+        except (EOFError, socket.error):
+            pass
+        except BaseException as e:
+            logger.exception(e)
+        finally:
+            with self._lock:
+                self._clients.pop(sock, None)
+            sock.close()
+
+    def _salted_hash(self, salt):
+        if salt is None:
+            return None
+        passhash = hashlib.md5(self.password).hexdigest().lower()
+        salthash = hashlib.md5("%lX" % salt).hexdigest()
+        return hashlib.md5(passhash + salthash).digest()
+
+    def tick(self):
+        '''
+        Advance `churn` fraction of part files
+        '''
+        changes = int(len(self.partfiles) * self.churn)
+        for partfile in self._random.sample(self.partfiles, changes):
+            partfile.tick(self._random)
+
+    def handle(self, opcode, tags):
+        '''
+        Build response for given authenticated request
+        '''
+        if opcode == codes.EC_OP_STAT_REQ:
+            return (codes.EC_OP_STATS, [
+                (codes.EC_TAG_STATS_UL_SPEED, sum(i.speed for i in self.partfiles) / 4),
+                (codes.EC_TAG_STATS_DL_SPEED, sum(i.speed for i in self.partfiles) or 1),
+                (codes.EC_TAG_STATS_UL_SPEED_LIMIT, 0),
+                (codes.EC_TAG_STATS_DL_SPEED_LIMIT, 0),
+                (codes.EC_TAG_STATS_UL_QUEUE_LEN, 0),
+                (codes.EC_TAG_STATS_TOTAL_SRC_COUNT, sum(i.sources for i in self.partfiles)),
+                (codes.EC_TAG_CONNSTATE, (0x01, [(codes.EC_TAG_CLIENT_ID, 0x2000000)])),
+                ])
+        elif opcode == codes.EC_OP_GET_DLOAD_QUEUE:
+            self.tick()
+            return (codes.EC_OP_DLOAD_QUEUE, [i.tag() for i in self.partfiles])
+        elif opcode == codes.EC_OP_GET_ULOAD_QUEUE:
+            return (codes.EC_OP_ULOAD_QUEUE, [])
+        elif opcode == codes.EC_OP_GET_SHARED_FILES:
+            return (codes.EC_OP_SHARED_FILES, [
+                i.tag(True) for i in self.partfiles[::self.shared_every]
+                ])
+        elif opcode == codes.EC_OP_SEARCH_START:
+            self.search_polls = 0
+            return (codes.EC_OP_STRINGS, [(codes.EC_TAG_STRING, u"Search in progress.")])
+        elif opcode == codes.EC_OP_SEARCH_PROGRESS:
+            return (codes.EC_OP_SEARCH_PROGRESS, [
+                (codes.EC_TAG_SEARCH_STATUS, min(100, self.search_polls * 25))
+                ])
+        elif opcode == codes.EC_OP_SEARCH_RESULTS:
+            # A new batch of results on every request, previous ones with
+            # more sources
+            self.search_polls += 1
+            return (codes.EC_OP_SEARCH_RESULTS, [
+                (codes.EC_TAG_SEARCHFILE, (i.hash, [
+                    (codes.EC_TAG_PARTFILE_NAME, i.name),
+                    (codes.EC_TAG_PARTFILE_SIZE_FULL, i.size),
+                    (codes.EC_TAG_PARTFILE_HASH, i.hash),
+                    (codes.EC_TAG_PARTFILE_SOURCE_COUNT, self.search_polls),
+                    ]))
+                for i in self.partfiles[:self.search_polls * 2]
+                ])
+        elif opcode == codes.EC_OP_GET_SERVER_LIST:
+            return (codes.EC_OP_SERVER_LIST, [
+                (codes.EC_TAG_SERVER, (u"127.0.0.1:4661", [(codes.EC_TAG_SERVER_NAME, u"fake")]))
+                ])
+        return (codes.EC_OP_NOOP, [])
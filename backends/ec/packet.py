@@ -5,7 +5,8 @@ import zlib
 from struct import pack, unpack
 from hashlib import md5
 
-from tag import ECTag, ReadTag
+from tag import ECTag, ECUTF8Num, ReadTag, ReadUTF8Num
+from record import ECRecord, records_by_opcode
 from constants import EC_CODES as codes
 
 class VirtualTag(dict):
@@ -120,12 +121,14 @@ class TagDict(dict):
             - tags: list of tuples of tags
 
         Translate recursive list of tags tuples to dictionaries using tag
-        constants names.
+        constants names. Records are keyed by their value.
         '''
         r = cls()
         for k, v in tags:
             k = codes.reverse_tags.get(k, k)
-            if v and isinstance(v, list) and isinstance(v[0], tuple) and len(v[0]) == 2 and isinstance(v[0][0], int):
+            if isinstance(v, ECRecord):
+                v = {v.value: v}
+            elif v and isinstance(v, list) and isinstance(v[0], tuple) and len(v[0]) == 2 and isinstance(v[0][0], int):
                 v = cls.from_list(v)
             elif isinstance(v, tuple) and len(v) == 2:
                 v = cls.from_list([v])
@@ -173,7 +176,7 @@ def ECPacket(data_tuple):
 
 def ECPacketData(data_tuple):
     dtype, tags = data_tuple
-    return pack('!BB', dtype, len(tags)) + ''.join(ECTag(name, data) for name, data in tags)
+    return pack('!B', dtype) + ECUTF8Num(len(tags)) + ''.join(ECTag(name, data) for name, data in tags)
 
 def ReadPacketData(data, utf8_nums = True):
     opcode, = unpack('!B', data[:1])
@@ -183,15 +186,16 @@ def ReadPacketData(data, utf8_nums = True):
         return opcode, []
 
     if utf8_nums:
-        offset = 2
-        num_tags, = unpack('!B', data[1:2])
+        num_len, num_tags = ReadUTF8Num(data[1:])
+        offset = 1 + num_len
     else:
         offset = 3
         num_tags, = unpack('!H', data[1:3])
 
+    records = records_by_opcode.get(opcode)
     tags = []
-    for i in range(num_tags):
-        tag_len, tag_name, tag_data = ReadTag(data[offset:], utf8_nums)
+    for i in xrange(num_tags):
+        tag_len, tag_name, tag_data = ReadTag(data[offset:], utf8_nums, records)
         offset += tag_len
         tags.append((tag_name, tag_data))
 
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from constants import EC_CODES as codes
+
+class ECRecord(object):
+    '''
+    Base for slotted records generated from EC tag tables.
+
+    Every subtag is stored in a slot named after its tag constant (ie.
+    EC_TAG_PARTFILE_SIZE_FULL as `partfile_size_full`), so field access
+    is a plain attribute read. Value of the tag holding the record (the
+    file hash for file lists) is stored in `value`. Missing fields read
+    as None, unknown subtags are dropped and nested subtags are kept as
+    decoded (value, [(tag, value), ...]) tuples.
+    '''
+    __slots__ = ("value",)
+    _fields = ()
+    _tag_fields = {}
+
+    def __init__(self, value=None):
+        self.value = value
+
+    def __getattr__(self, k):
+        # Only reached for unset slots
+        if k in self._fields:
+            return None
+        raise AttributeError("%s has no attribute %s." % (self.__class__.__name__, k))
+
+    def set(self, tag, value):
+        '''
+        Set field by tag code, return False if tag is unknown
+        '''
+        name = self._tag_fields.get(tag)
+        if name is None:
+            return False
+        setattr(self, name, value)
+        return True
+
+    def get(self, k, default=None):
+        v = getattr(self, k, None)
+        return default if v is None else v
+
+    def iteritems(self):
+        for k in self._fields:
+            v = getattr(self, k)
+            if not v is None:
+                yield k, v
+
+    def update(self, other):
+        '''
+        Copy fields set on given record and known by this one.
+        '''
+        fields = self._fields
+        for k, v in other.iteritems():
+            if k in fields:
+                setattr(self, k, v)
+
+    def __eq__(self, other):
+        return (
+            isinstance(other, ECRecord) and
+            self.value == other.value and
+            dict(self.iteritems()) == dict(other.iteritems())
+            )
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    __hash__ = object.__hash__
+
+    def __repr__(self):
+        return "<%s %r %s>" % (self.__class__.__name__, self.value, dict(self.iteritems()))
+
+# Response opcode, tag holding every record and tag groups of its subtags
+RECORD_LAYOUTS = (
+    (codes.EC_OP_DLOAD_QUEUE, codes.EC_TAG_PARTFILE, ("partfile", "knownfile")),
+    (codes.EC_OP_SHARED_FILES, codes.EC_TAG_KNOWNFILE, ("partfile", "knownfile")),
+    (codes.EC_OP_SEARCH_RESULTS, codes.EC_TAG_SEARCHFILE, ("partfile", "search")),
+    (codes.EC_OP_ULOAD_QUEUE, codes.EC_TAG_CLIENT, ("client",)),
+    (codes.EC_OP_SERVER_LIST, codes.EC_TAG_SERVER, ("server",)),
+    )
+
+def record_class(opcode, groups):
+    '''
+    Generate ECRecord subclass for given response opcode with a slot for
+    every tag whose name starts with any of given group names.
+    '''
+    prefixes = tuple("%s_" % i for i in groups)
+    tag_fields = {
+        tag: name
+        for tag, name in codes.reverse_tags.iteritems()
+        if name.startswith(prefixes)
+        }
+    fields = tuple(sorted(tag_fields.itervalues()))
+    name = "".join(i.capitalize() for i in codes.reverse_ops[opcode].split("_"))
+    return type("%sRecord" % name, (ECRecord,), {
+        "__slots__": fields,
+        "_fields": frozenset(fields),
+        "_tag_fields": tag_fields,
+        })
+
+# {opcode: {tag: ECRecord subclass}}
+records_by_opcode = {
+    opcode: {tag: record_class(opcode, groups)}
+    for opcode, tag, groups in RECORD_LAYOUTS
+    }
@@ -13,7 +13,7 @@ def ECTagData(data):
     subtag_data = ''
     if isinstance(data, tuple):
         data, subtags = data
-        subtag_data += unichr(len(subtags)).decode("utf-8")
+        subtag_data += unichr(len(subtags)).encode("utf-8")
         for tag in subtags:
             subtag_data += ECTag(tag[0], tag[1])
     if isinstance(data, unicode):
@@ -37,11 +37,11 @@ def ECTagData(data):
             fmtStr = '!Q'
             tagType = tagtype.EC_TAGTYPE_UINT64
             length = 8
-        retval += struct.pack('!BB', tagType, length + len(subtag_data))
+        retval += struct.pack('!B', tagType) + ECUTF8Num(length + len(subtag_data))
         retval += subtag_data
         retval += struct.pack(fmtStr, data)
     elif isinstance(data, str):
-        retval += struct.pack('!BB', tagtype.EC_TAGTYPE_HASH16, 16 + len(subtag_data))
+        retval += struct.pack('!B', tagtype.EC_TAGTYPE_HASH16) + ECUTF8Num(16 + len(subtag_data))
         retval += subtag_data
         retval += data
     else:
@@ -107,7 +107,12 @@ def ReadUTF8Num(data):
     value = ord(data[:utf_len].decode("utf-8"))
     return utf_len, value
 
-def ReadTag(data, utf8_nums = True):
+def ReadTag(data, utf8_nums = True, records = None):
+    '''
+    Read tag from data, tags with subtags found in `records` mapping
+    (tag code to ECRecord subclass) are decoded straight into a record
+    instead of a (value, subtags) tuple.
+    '''
     if utf8_nums:
         name_len, tag_value = ReadUTF8Num(data)
     else:
@@ -115,13 +120,14 @@ def ReadTag(data, utf8_nums = True):
         tag_value, = struct.unpack("!H", data[:2])
     tag_name = tag_value/2
     tag_has_subtags = (tag_value%2 == 1)
-    data_len, data = ReadTagData(data[name_len:], tag_has_subtags, utf8_nums)
+    record = records.get(tag_name) if records else None
+    data_len, data = ReadTagData(data[name_len:], tag_has_subtags, utf8_nums, record)
     return name_len + data_len , tag_name, data
 
 _readTagDataStructLength = struct.Struct('!I')
 _readTagDataStructNumTags = struct.Struct('!H')
 
-def ReadTagData(data, tag_has_subtags=False, utf8_nums=True):
+def ReadTagData(data, tag_has_subtags=False, utf8_nums=True, record=None):
     dtype = ord(data[0])
     if utf8_nums:
         utf_len, length = ReadUTF8Num(data[1:])
@@ -132,19 +138,20 @@ def ReadTagData(data, tag_has_subtags=False, utf8_nums=True):
         tag_data = data[5:]
     if tag_has_subtags:
         if utf8_nums:
-            num_subtags = ord(tag_data[0])
-            offset = 1
+            offset, num_subtags = ReadUTF8Num(tag_data)
         else:
             num_subtags = _readTagDataStructNumTags.unpack(tag_data[:2])[0]
             offset = 2
-        subtags = []
-        subtag_data = tag_data
+        subtags = [] if record is None else record()
         length = 1+utf_len+offset
-        for i in range(num_subtags):
+        for i in xrange(num_subtags):
             subtag_len, subtag_name, subtag_data = ReadTag(tag_data[offset:],utf8_nums)
             offset += subtag_len
             length += subtag_len
-            subtags.append((subtag_name, subtag_data))
+            if record is None:
+                subtags.append((subtag_name, subtag_data))
+            else:
+                subtags.set(subtag_name, subtag_data)
         tag_data = tag_data[offset:]
 
     if dtype in (tagtype.EC_TAGTYPE_UINT8, tagtype.EC_TAGTYPE_UINT16,
@@ -176,7 +183,10 @@ def ReadTagData(data, tag_has_subtags=False, utf8_nums=True):
     else:
         raise TypeError("Invalid tag type %d" % dtype)
     if tag_has_subtags:
-        return length, (value, subtags)
+        if record is None:
+            return length, (value, subtags)
+        subtags.value = value
+        return length, subtags
     return length + utf_len + 1, value
 
 ReadInt_fmtStr = {1: "!B", 2: "!H", 4: "!I", 8: "!Q"}
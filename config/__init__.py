@@ -187,8 +187,8 @@ class ResourceManager(object):
     image_dir = "gui"
 
     def __init__(self):
-        self._guess_icon_cache = {(): CATEGORY_ICONS["misc"]}
-        self._guess_web_icon_cache = {(): constants.WEB_CATEGORY_ICONS["unknown"]}
+        self._guess_icon_cache = utils.Cache("resources.guess_icon", maxsize=1024)
+        self._guess_web_icon_cache = utils.Cache("resources.guess_web_icon", maxsize=1024)
         self.data = DefaultAttrDict(factory=self._data_factory)
         self.bitmap = DefaultAttrDict(factory=self._bitmap_factory)
         self.image = DefaultAttrDict(factory=self._image_factory)
@@ -251,8 +251,11 @@ class ResourceManager(object):
 
     _guess_icon_cache = None
     def guess_icon(self, filenames):
+        if not filenames:
+            return self.image[CATEGORY_ICONS["misc"]]
         r = tuple(sorted(filenames))
-        if not r in self._guess_icon_cache:
+        icon = self._guess_icon_cache.get(r)
+        if icon is None:
             category = guess_category(filenames)
             for i in filenames:
                 ext = i[i.find(".", max(i.find(os.sep), 0))+1: ]
@@ -262,16 +265,19 @@ class ResourceManager(object):
             else:
                 icon = CATEGORY_ICONS[category]
             self._guess_icon_cache[r] = icon
-        return self.image[self._guess_icon_cache[r]]
+        return self.image[icon]
 
     _guess_web_icon_cache = None
     def guess_web_icon(self, filenames):
+        if not filenames:
+            return self.image[constants.WEB_CATEGORY_ICONS["unknown"]]
         r = tuple(sorted(filenames))
-        if not r in self._guess_web_icon_cache:
+        icon = self._guess_web_icon_cache.get(r)
+        if icon is None:
             category = guess_web_category(filenames)
             icon = constants.WEB_CATEGORY_ICONS.get(category, constants.WEB_CATEGORY_ICONS["unknown"])
             self._guess_web_icon_cache[r] = icon
-        return self.image[self._guess_web_icon_cache[r]]
+        return self.image[icon]
 
     def get_web_category_icon(self, name):
         if name in constants.WEB_CATEGORY_ICONS:
@@ -773,11 +779,12 @@ class AutoUpdater(object):
             response = utils.GetURL(
                 self.download_url % {"version": self._appversion, "file": filename, "platform": self.platform},
                 buffsize = self.download_chunk_size,
-                useragent = self._useragent
+                useragent = self._useragent,
+                method = "HEAD" # see save_segmented
                 )
             if response.code == 200:
                 setup_path = os.path.join(self.download_path, filename)
-                response.save(setup_path)
+                response.save_segmented(setup_path)
                 self.downloaded_files[filename] = response.finished and not response.failed
             else:
                 self.downloaded_files[filename] = False
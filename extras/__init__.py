@@ -263,7 +263,7 @@ class SignedPlugin(object):
         self.path = path
         with zipfile.ZipFile(self.path) as zf:
             self.mb = {i for i in zf.namelist() if not i.endswith("/")} # only files
-        self.cache = {}
+        self.cache = utils.Cache("extras.modulepath")
 
     def modulepath(self, fullname):
         '''
@@ -275,8 +275,9 @@ class SignedPlugin(object):
         Returns:
             Virtual module path as basestring or None.
         '''
-        if fullname in self.cache:
-            return self.cache[fullname]
+        relpath = self.cache.get(fullname)
+        if relpath is not None:
+            return relpath or None # False means not found
         path = fullname.replace(".", "/")
         for alt in (path, path+"/__init__"):
             for ext in (".py", ".pyc", ".pyo"):
@@ -284,6 +285,7 @@ class SignedPlugin(object):
                 if relpath in self.mb:
                     self.cache[fullname] = relpath
                     return relpath
+        self.cache[fullname] = False
         return None
 
     _types = {
@@ -475,7 +477,7 @@ class ExtraInstaller(threading.Thread):
             self.path = os.path.join(self.modulepath, extra_name)
 
         try:
-            self.geturl = utils.GetURL(url)
+            self.geturl = utils.GetURL(url, method="HEAD") # see save_segmented
         except:
             self.geturl = None
 
@@ -487,7 +489,7 @@ class ExtraInstaller(threading.Thread):
         '''
         if self in self._instances:
             self._instances.remove(self)
-        if self.installer and os.path.exists(self.path):
+        if self.installer and os.path.exists(self.path) and not utils.GetURL.resumable(self.path):
             os.remove(self.path)
 
 
@@ -507,9 +509,10 @@ class ExtraInstaller(threading.Thread):
         while not (self.geturl.failed or self.geturl.finished):
             new_state = self.progress
             if last_state != new_state:
-                wx.CallAfter(self._progress_updater_callback)
+                last_state = new_state
+                self._progress_updater_callback()
             time.sleep(0.1)
-        wx.CallAfter(self._progress_updater_callback)
+        self._progress_updater_callback()
 
     def run(self):
         '''
@@ -521,7 +524,7 @@ class ExtraInstaller(threading.Thread):
             if not os.path.exists(self.modulepath):
                 os.makedirs(self.modulepath)
             self.progress_updater.start()
-            self.geturl.save(self.path)
+            self.geturl.save_segmented(self.path)
             if self.geturl.failed:
                 raise GetURLFailed("GetURL failed to save %r to %r" % (self.url, self.path))
             # If installer, we need to call it and wait until completion
@@ -610,6 +613,8 @@ class ExtraManager(utils.EventHandler):
 
     def __init__(self, app):
         self.app = app
+        # Installer threads emit progress, coalesced until GUI gets it
+        self.set_event_bus(utils.EventBus(wx.CallAfter, utils.is_main_thread), ("progress",))
         self._downloads = {}
         self._extra_state = collections.defaultdict(int)
         self._sandboxed_extras = {}
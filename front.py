@@ -454,7 +454,10 @@ class Main(WxAppProxy):
 
         self.webserver = server.Server(self)
         self.webserver.open_handler = {
-            i: lambda card: self.playerdialog.Play(card.name, card.fspath)
+            i: lambda card: self.playerdialog.Play(
+                card.name,
+                self.webserver.url + urllib.quote(card.stream_path.encode("utf-8"))
+                if card.stream_path and card.progress < 1 else card.fspath)
             for i in config.constants.PLAYER_CATEGORIES
             }
 
@@ -2065,6 +2068,8 @@ class Main(WxAppProxy):
             # Thread managers
             utils.CheckURL.close_all_connections()
             utils.TaskPool.clean_all()
+            utils.ProcessPool.clean_all()
+            utils.DirectoryCache.close_all()
         except BaseException as e:
             logger.exception(e)
 
@@ -2463,8 +2468,8 @@ class AppDebugger(wx.App):
                 if size != old_size:
                     with open(path_f, "r") as f:
                         ctrl.ChangeValue(f.read())
-            elif isinstance(path_f, utils.FileEater):
-                size = len(path_f)
+            elif isinstance(path_f, utils.OutputBuffer):
+                size = path_f.received
                 if size != old_size:
                     ctrl.ChangeValue(path_f.value)
             if size != old_size:
@@ -2583,6 +2588,10 @@ def main():
     '''
     Main endpoint
     '''
+    if utils.multiprocessing:
+        # Frozen worker processes must not start the app
+        utils.multiprocessing.freeze_support()
+
     if config.DEBUG and not config.SLAVE:
         r = main_debugger()
     else:
@@ -2612,8 +2621,8 @@ def main_debugger():
         args = [sys.executable] + sys.argv + ["--slave"]
         p = subprocess.Popen(args, 0, args[0], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     if p:
-        stdout = utils.FileEater(p.stdout)
-        stderr = utils.FileEater(p.stderr)
+        stdout = utils.collect_output(p.stdout)
+        stderr = utils.collect_output(p.stderr)
     else:
         stderr = my_env.tempfilepath("stderr.log")
         stdout = my_env.tempfilepath("stdout.log")
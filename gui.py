@@ -375,7 +375,7 @@ class Download(object):
             except BaseException as e:
                 logging.exception(e)
                 bsize = 4096 # 4 KiB
-            self._geturl = utils.GetURL(self.url, buffsize=bsize)
+            self._geturl = utils.GetURL(self.url, buffsize=bsize, method="HEAD") # see save_segmented
 
         # Thread info initialization
         self._ok = False
@@ -393,9 +393,13 @@ class Download(object):
                     self.tmpfolder,
                     self.filename or urlparse.urlparse(self._geturl.url).path.rsplit("/")[-1]
                     )
-                # Name choosing, (we cannot write in open files)
-                self._dest = my_env.choose_filename(path)
-                self._geturl.save(self._dest)
+                # Name choosing, (we cannot write in open files) unless
+                # resuming an interrupted download
+                if utils.GetURL.resumable(path):
+                    self._dest = path
+                else:
+                    self._dest = my_env.choose_filename(path)
+                self._geturl.save_segmented(self._dest)
                 if self._geturl.finished:
                     self.launch()
             except BaseException as e:
@@ -8,11 +8,16 @@ implemented for a linux system.
 """
 
 import sys
+import os
 import os.path
 import atexit
 import subprocess
 import logging
 import shutil
+import struct
+import errno
+import ctypes
+import ctypes.util
 
 import dbus
 
@@ -184,3 +189,72 @@ def set_run_startup(value):
         path = state.autostart_dir + '/%s.desktop' % state.exename
         if os.path.exists(path):
             os.remove(path)
+
+
+
+class Inotify(object):
+    "Minimal inotify(7) binding, readable with select through fileno"
+
+    IN_MODIFY = 0x00000002
+    IN_ATTRIB = 0x00000004
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF = 0x00000800
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ONLYDIR = 0x01000000
+
+    _IN_NONBLOCK = 04000
+    _IN_CLOEXEC = 02000000
+    _event_struct = struct.Struct("iIII") # wd, mask, cookie, len
+    _libc = None
+
+    def __init__(self):
+        if Inotify._libc is None:
+            Inotify._libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = self._libc.inotify_init1(self._IN_NONBLOCK | self._IN_CLOEXEC)
+        if self.fd < 0:
+            self._raise()
+
+    def _raise(self, path=None):
+        code = ctypes.get_errno()
+        raise OSError(code, os.strerror(code), path)
+
+    def fileno(self):
+        return self.fd
+
+    def add_watch(self, path, mask):
+        "Watch given path, returning its watch descriptor"
+        if isinstance(path, unicode):
+            path = path.encode(sys.getfilesystemencoding() or "utf-8")
+        wd = self._libc.inotify_add_watch(self.fd, path, mask)
+        if wd < 0:
+            self._raise(path)
+        return wd
+
+    def rm_watch(self, wd):
+        self._libc.inotify_rm_watch(self.fd, wd)
+
+    def read_events(self):
+        "Get pending events as (wd, mask, cookie, name) tuples"
+        try:
+            data = os.read(self.fd, 65536)
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return []
+            raise
+        events = []
+        pos = 0
+        size = self._event_struct.size
+        while pos < len(data):
+            wd, mask, cookie, length = self._event_struct.unpack_from(data, pos)
+            pos += size
+            events.append((wd, mask, cookie, data[pos:pos+length].rstrip("\0")))
+            pos += length
+        return events
+
+    def close(self):
+        os.close(self.fd)
@@ -13,28 +13,29 @@ import itertools
 import re
 import datetime
 import functools
+import hashlib
 import urlparse
+import collections
+import threading
+import shutil
 
 import wx
 import jinja2
 import base64
 
-try:
-    from cStringIO import StringIO  # C module
-except ImportError:
-    from StringIO import StringIO  # Python fallback
-
 import utils
 import config
 import my_env
 import constants.constants as constants
 
 import gevent
+import gevent.event
 from gevent.pywsgi import WSGIServer
 
 from wxproxy import WxProxy
 
 from .comm import DownloaderXHRConn
+from .thumbnails import ThumbnailCache, ThumbnailService, key_for_file
 
 # Syntax sugar (attribute getter)
 from utils import attribute
@@ -92,8 +93,8 @@ def whitestrip(data):
     #return _html_whitestrip.sub("><", data)
 
 class PlayCardMixin(object):
-    _html_cache = ""
-    _html_cache_last_update = 0
+    _html_cache = utils.Cache("playcard.html", maxsize=512) # {playcard: (last_update, html)}
+    _json_cache = utils.Cache("playcard.json", maxsize=2048) # {(path, html): (last_update, fragment)}
 
     @property
     def preview(self, url):
@@ -105,13 +106,33 @@ class PlayCardMixin(object):
             return "/card_image/" + self.path
         return None
 
+    stream_path = None # see FilePlayCard.stream_path
+
     @property
     def html(self):
         last_update = self.last_update
-        if last_update > self._html_cache_last_update:
-            self._html_cache_last_update = last_update
-            self._html_cache = whitestrip(self._template.module.card(self))
-        return self._html_cache
+        cached = self._html_cache.get(self)
+        if cached is None or last_update > cached[0]:
+            cached = (last_update, whitestrip(self._template.module.card(self)))
+            self._html_cache[self] = cached
+        return cached[1]
+
+    def json_fragment(self, html=False):
+        '''
+        Get json, with html if html is True, encoded as JSONFragment.
+
+        Fragments are shared by all /comm sessions until card is
+        updated.
+        '''
+        key = (self.path, html)
+        last_update = self.last_update
+        cached = self._json_cache.get(key)
+        if cached is None or last_update > cached[0]:
+            data = self.json
+            data["html"] = self.html if html else None
+            cached = (last_update, utils.JSONFragment(json.dumps(data)))
+            self._json_cache[key] = cached
+        return cached[1]
 
     @property
     def base(self):
@@ -128,23 +149,84 @@ class PlayCardMixin(object):
             }
 
 
+class ProgressTree(object):
+    '''
+    Aggregated (done, total) counters of every file and directory of a
+    download, updated from per file progress deltas.
+
+    >>> tree = ProgressTree()
+    >>> tree.update({"a/b/1": (1, 4), "a/b/2": (0, 4), "a/3": (2, 2)})
+    >>> tree.get("a"), tree.get("a/b")
+    ((3, 10), (1, 8))
+    >>> tree.update({"a/b/1": (4, 4), "a/b/2": (0, 4), "a/3": (2, 2)})
+    >>> tree.get("a"), tree.get("a/b/1")
+    ((6, 10), (4, 4))
+    '''
+    def __init__(self, sep="/"):
+        self.sep = sep
+        self.version = None
+        self._files = {} # {path: (done, total)}
+        self._dirs = {} # {path: [done, total]}
+
+    def _add(self, path, done, total):
+        sep = self.sep
+        dirs = self._dirs
+        pos = path.find(sep)
+        while pos > -1:
+            parent = path[:pos]
+            if parent in dirs:
+                counters = dirs[parent]
+                counters[0] += done
+                counters[1] += total
+            else:
+                dirs[parent] = [done, total]
+            pos = path.find(sep, pos + 1)
+
+    def update(self, files_progress, version=None):
+        '''
+        Apply changes from given {path: (done, total)} dict.
+
+        Params:
+            files_progress: dict with progress of every file.
+            version: value stored as `version`, to tell if tree is
+                     up to date.
+        '''
+        files = self._files
+        if len(files) > len(files_progress) or not files.viewkeys() <= files_progress.viewkeys():
+            # Files removed, rebuild
+            files.clear()
+            self._dirs.clear()
+        for path, value in files_progress.iteritems():
+            old = files.get(path)
+            if old != value:
+                files[path] = value
+                if old is None:
+                    self._add(path, value[0], value[1])
+                else:
+                    self._add(path, value[0] - old[0], value[1] - old[1])
+        self.version = version
+
+    def get(self, path):
+        '''
+        Get (done, total) counters of given file or directory path.
+        '''
+        if path in self._files:
+            return self._files[path]
+        if path in self._dirs:
+            return tuple(self._dirs[path])
+        return (0, 0)
+
+
 class DownloadPlayCard(PlayCardMixin):
     @property
     def last_update(self):
         return self._last_update
 
     _medatata_creation = 0
-    _last_update_progress = -1
     @last_update.setter
     def last_update(self, v):
         self._last_update = v
 
-        # _progress_cache refresh
-        new_progress = int(self._download.progress*100)
-        if self._last_update_progress != new_progress:
-            self.last_update_progress = new_progress
-            self._progress_cache = None
-
         # _metadata_creation set
         if self._medatata_creation == 0 and self._download.has_metadata():
             self._medatata_creation = v
@@ -162,42 +244,61 @@ class DownloadPlayCard(PlayCardMixin):
             return r
         return "unknown"
 
-    def _preview_finished(self, r):
-        if not r:
-            return  # no image as raw data, nothing to save
-        imgsize = utils.image_size(r)
-        if imgsize[0] > 50 and imgsize[1] > 50:
-            self.data["img_data"] = r
-            self._server.update_download(self._download)
+    _preview_future = None
+    def _preview_finished(self, future):
+        # Called on worker thread
+        try:
+            key = future.result()
+        except BaseException as e:
+            logger.debug(e)
+            key = None
+        wx.CallAfter(self._set_preview_key, key)
+
+    def _set_preview_key(self, key):
+        '''
+        Store thumbnail key on play data, or forget it if None, dropping
+        raw images of older versions.
 
-    def _preview_failed(self, e):
-        del self.data["img_data"] # makes retry again later
-        logger.debug(e)
+        Must be called on main thread, where play data is pickled.
+        '''
+        self._preview_future = None
+        data = self.data
+        data.pop("img_data", None) # moved to thumbnail cache, or invalid
+        data.pop("img_data_scaled", None)
+        if key:
+            data["img_key"] = key
+            self._server.update_download(self._download)
+        else:
+            data.pop("img_key", None)
 
+    thumbnail_size = 150
     @property
     def preview(self):
-        if "img_data_scaled" in self.data:
-            # Nice, we already have a scaled version of the image
-            return self.data["img_data_scaled"]
-        elif "img_data" in self.data and self.data["img_data"] is not None:
-            # Get its size and see if we need to rescale it
-            data = self.data["img_data"]
-            img = wx.ImageFromStream(StringIO(data), utils.image_type(data))
-            w, h = img.GetSize()
-            if w > 150 or h > 150:
-                f = 150. / min(w, h)  # factor used to rescale
-                img.Rescale(int(f*w), int(f*h), wx.IMAGE_QUALITY_HIGH)
-                io_data_new = StringIO()  # will contain the raw image rescaled
-                img.SaveStream(io_data_new, type=wx.BITMAP_TYPE_PNG)
-                self.data["img_data_scaled"] = io_data_new.getvalue()
-                img.Destroy()
-            else:
-                self.data["img_data_scaled"] = data
-            return self.data["img_data_scaled"]
+        # Read from web server thread, play data changes are left to
+        # _set_preview_key
+        data = self.data
+        thumbnails = self._server.thumbnails
+        key = data.get("img_key")
+        if key:
+            r = thumbnails.cache.get(key, self.thumbnail_size)
+            if r:
+                return r
+        if self._preview_future is not None:
+            # Already requested, wait for _set_preview_key
+            return None
+        if data.get("img_data"):
+            # Raw image from older versions
+            future = thumbnails.request_data(data["img_data"])
         elif self._download.user_data and self._download.user_data.get("img", None):
-            self.data["img_data"] = None
-            url = self._download.user_data["img"]
-            utils.async(utils.GetURL(url).read_all, success=self._preview_finished, error=self._preview_failed)
+            future = thumbnails.request_url(self._download.user_data["img"])
+        else:
+            future = None
+        if future:
+            self._preview_future = future
+            future.add_done_callback(self._preview_finished)
+        elif key:
+            # Removed from thumbnail cache and cannot be rendered again
+            wx.CallAfter(self._set_preview_key, None)
         return None
 
     @property
@@ -263,32 +364,28 @@ class DownloadPlayCard(PlayCardMixin):
                 )
 
         if filtered_files:
-            listdir = my_env.get_listdir(base + path)
+            listdir = utils.listdir_cached(base + path)
             if path:
                 listdir = (path + sep + i for i in listdir)
             for path in filtered_files.intersection(listdir): # Much faster than check for existence
                 yield self.get_playcard(path)
 
-    _progress_cache = None
+    @attribute
+    def _progress_tree(self):
+        return ProgressTree(os.sep)
+
     def get_progress_of(self, path):
         if self._download.finished or self._download.hidden:
             return 1
         path = path.replace("/", os.sep)
-        cache = self._progress_cache
-        if cache is None:
+        tree = self._progress_tree
+        if tree.version != self._last_update:
             try:
-                self._progress_cache = cache = self._download.files_progress
+                tree.update(self._download.files_progress, self._last_update)
             except BaseException as e:
                 logger.exception(e)
                 return 0
-        if path in cache:
-            done, total = cache[path]
-        else:
-            prefix = path + os.sep
-            p = [v for k, v in cache.iteritems() if k.startswith(prefix)]
-            done = sum(i[0] for i in p)
-            total = sum(i[1] for i in p)
-            cache[path] = (done, total)
+        done, total = tree.get(path)
         if total == 0:
             return 0
         return float(done)/total
@@ -375,6 +472,13 @@ class DownloadPlayCard(PlayCardMixin):
         ''' main directory (top level directory in download tree) '''
         return self._download.path
 
+    @property
+    def stream_path(self):
+        ''' server path for playing single-file downloads while being downloaded '''
+        if self.numfiles == 1:
+            return "/stream/" + self.path
+        return None
+
 
 class FilePlayCard(PlayCardMixin):
     def __init__(self, parent, path):
@@ -432,9 +536,54 @@ class FilePlayCard(PlayCardMixin):
     def category(self):
         return self._parent.get_category_of(self._path)
 
+    @attribute
+    def _thumbnail_key(self):
+        try:
+            return key_for_file(self.fspath)
+        except OSError:
+            return None
+
+    @property
+    def thumbnailable(self):
+        # Files being downloaded change on every request, so they would
+        # get a new thumbnail key (and mplayer run) every time.
+        return (
+            self.category in self._server.thumbnails.file_categories and
+            self.type == "file" and
+            self.progress >= 1)
+
     @property
     def preview(self):
-        #TODO(felipe): implement
+        '''
+        Thumbnail data if already rendered, see request_preview.
+        '''
+        if self.thumbnailable and self._thumbnail_key:
+            return self._server.thumbnails.cache.get(self._thumbnail_key, self.thumbnail_size)
+        return None
+
+    @property
+    def preview_path(self):
+        # Thumbnails are rendered lazily when requested by browser
+        if self.thumbnailable:
+            return "/card_image/" + self.path
+        return None
+
+    @property
+    def stream_path(self):
+        ''' server path for playing file while being downloaded '''
+        return "/stream/" + self.path
+
+    def request_preview(self):
+        '''
+        Request thumbnail rendering.
+
+        Returns:
+            Future object resolving to thumbnail key, or None if cannot
+            be rendered.
+        '''
+        if self.thumbnailable and self._thumbnail_key:
+            return self._server.thumbnails.request_file(
+                self.fspath, self.category, self._thumbnail_key)
         return None
 
     @attribute
@@ -448,9 +597,9 @@ class FilePlayCard(PlayCardMixin):
     @attribute
     def type(self):
         fspath = self.fspath
-        if os.path.isdir(fspath):
+        if utils.isdir_cached(fspath):
             return "folder"
-        elif not os.path.exists(fspath):
+        elif not utils.exists_cached(fspath):
             return "virtual"
         return "file"
 
@@ -712,13 +861,47 @@ class Request(object):
           ]
 
 
+class StaticAsset(object):
+    '''
+    Static file held by Server asset cache, with gzipped data for
+    compressible mime types.
+    '''
+    __slots__ = ("data", "gzdata", "etag", "mime", "mtime")
+    _compressible = ("text/", "application/javascript", "application/json", "application/xml", "image/svg+xml")
+    gzip_min_size = 1024
+
+    def __init__(self, data, mime, mtime):
+        self.data = data
+        self.mime = mime
+        self.mtime = mtime
+        self.etag = '"%s"' % hashlib.md5(data).hexdigest()
+        self.gzdata = None
+        if mime.startswith(self._compressible) and len(data) > self.gzip_min_size:
+            gzdata = utils.gzip_data(data)
+            if len(gzdata) < len(data):
+                self.gzdata = gzdata
+
+    @property
+    def size(self):
+        return len(self.data) + len(self.gzdata or "")
+
+
 class TemplateLoader(jinja2.BaseLoader):
+    '''
+    Jinja2 loader inlining static scripts, stylesheets and stylesheet
+    images into templates.
+
+    If `cache_dir` is given, processed sources are stored there along
+    with modification times of every inlined resource, and reused while
+    none of them changes.
+    '''
     _script_re = re.compile(r'<script(?P<attributes>\b[^>]*)></script>', re.IGNORECASE)
     _link_re = re.compile(r'<link(?P<attributes>\b[^>]*)>', re.IGNORECASE)
     _url_re = re.compile(r'url\((?P<url>[^)]*)\)')
-    def __init__(self, base, static):
+    def __init__(self, base, static, cache_dir=None):
         self.base = base
         self.static = static
+        self.cache_dir = cache_dir
         self.autoreload = config.DEBUG and not my_env.is_archive
 
     @classmethod
@@ -747,27 +930,29 @@ class TemplateLoader(jinja2.BaseLoader):
     def _up_to_date(cls, mtime, path):
         return mtime == -1 or mtime == utils.get_resource_mtime(path)
 
-    def _script_replace(self, match):
+    def _script_replace(self, deps, match):
         rep = match.group("attributes").rstrip("/").split("src=", 1)[-1].split(None, 1)[0].strip("'").strip("\"")
         if self._check_uri(rep):
             path = self.static + "/" + rep.lstrip("/")
+            deps.add(path)
             data = utils.get_resource_data(path).decode("utf-8")
             if data:
                 return "{% raw %}<script type=\"text/javascript\">\n" + data + "\n</script>{% endraw %}"
         return '<script %s></script>' % (match.group("attributes"),)
 
-    def _link_replace(self, match):
+    def _link_replace(self, deps, match):
         rep = match.group("attributes").rstrip("/").split("href=", 1)[-1].split(None, 1)[0].strip("'").strip("\"")
         if self._check_uri(rep):
             path = self.static + "/" + rep.lstrip("/")
+            deps.add(path)
             data = utils.get_resource_data(path).decode("utf-8")
             if data:
-                data = self._url_re.sub(functools.partial(self._url_replace, path), data)
+                data = self._url_re.sub(functools.partial(self._url_replace, deps, path), data)
                 return "{% raw %}<style type=\"text/css\">\n" + data + "\n</style>{% endraw %}"
         tagcontent = match.group("attributes")
         return '<link%s%s>' % (tagcontent, "" if tagcontent[-1] == "/" else "/")
 
-    def _url_replace(self, path, match):
+    def _url_replace(self, deps, path, match):
         url = match.group("url").strip("'").strip("\"")
         if self._check_uri(url):
             path = os.path.dirname(path)
@@ -780,23 +965,81 @@ class TemplateLoader(jinja2.BaseLoader):
                 url = absurl[len(self.static)+1:]
                 ext = url[url.rfind(".")+1:]
                 if ext in ("gif", "png", "jpg") and utils.get_resource_exists(absurl):
+                    deps.add(absurl)
                     data = "data:image/" + ext + ";base64," + base64.b64encode(utils.get_resource_data(absurl))
                     return "url({% endraw %}{% if uridata_support %}" + data + "{% else %}'" + url + "'{% endif %}{% raw %})"
         return "url('%s')" % url
 
+    def _cache_path(self, rpath):
+        return os.path.join(self.cache_dir, "%s.json" % hashlib.md5(rpath).hexdigest())
+
+    def _load_cached(self, rpath):
+        '''
+        Get processed source for given template from cache, or None if
+        not cached or any of its resources changed.
+        '''
+        try:
+            with open(self._cache_path(rpath), "rb") as f:
+                cached = json.load(f)
+            for dep, mtime in cached["deps"].iteritems():
+                if utils.get_resource_mtime(dep) != mtime:
+                    return None
+            return cached["source"]
+        except (IOError, OSError, ValueError, KeyError):
+            pass
+        return None
+
+    def _store_cached(self, rpath, data, deps):
+        path = self._cache_path(rpath)
+        tmp = path + ".tmp"
+        try:
+            with open(tmp, "wb") as f:
+                json.dump({
+                    "deps": {dep: utils.get_resource_mtime(dep) for dep in deps},
+                    "source": data,
+                    }, f)
+            if os.path.exists(path):
+                os.remove(path) # no atomic replace on windows
+            os.rename(tmp, path)
+        except (IOError, OSError) as e:
+            logger.exception(e)
+
     def get_source(self, environment, path):
         rpath = os.path.join(self.base, path)
-        data = utils.get_resource_data(rpath).decode("utf-8")
+        data = self._load_cached(rpath) if self.cache_dir else None
         if data is None:
-            raise jinja2.TemplateNotFound, path
-        data = self._link_re.sub(self._link_replace, data)
-        data = self._script_re.sub(self._script_replace, data)
+            data = utils.get_resource_data(rpath)
+            if data is None:
+                raise jinja2.TemplateNotFound, path
+            data = data.decode("utf-8")
+            deps = {rpath}
+            data = self._link_re.sub(functools.partial(self._link_replace, deps), data)
+            data = self._script_re.sub(functools.partial(self._script_replace, deps), data)
+            if self.cache_dir:
+                self._store_cached(rpath, data, deps)
         mtime = utils.get_resource_mtime(rpath) if self.autoreload else -1
         return data, path, functools.partial(self._up_to_date, mtime, rpath)
 
 
 class Server(object):
+    '''
+    Web library server.
+
+    Playcard changes and removals are recorded on a versioned change log,
+    so XHR sessions only get cards changed after their version cursor.
+    Log is compacted up to the oldest cursor of all sessions, or to
+    `changelog_maxlen` entries, sessions left behind are given a full
+    update.
+
+    HTTP server runs on its own thread and gevent hub. Pages listening
+    on /events are woken as soon as the change log grows, GUI actions
+    requested by web handlers are run on main thread (see async_action).
+    '''
     _all_servers = set()
+    changelog_maxlen = 10000
+    sse_keepalive = 15 # seconds between /events keepalive comments
+    static_cache_size = 16777216 # 16 MiB
+    static_max_asset_size = 1048576 # bigger static files are streamed
     def __init__(self, app, port=0, static="server/static", templates="server/templates"):
         self.app = app
         self.settings = SettingsManager(app)
@@ -811,10 +1054,12 @@ class Server(object):
 
         # Jinja2 config
         autoreload = config.DEBUG and not my_env.is_archive
+        cache_dir = self._template_cache_dir()
         self._jinjaenv = jinja2.Environment(
-            loader = TemplateLoader(templates, static),
+            loader = TemplateLoader(templates, static, cache_dir),
             auto_reload = autoreload,
-            extensions=['jinja2.ext.i18n']
+            extensions=['jinja2.ext.i18n'],
+            bytecode_cache = jinja2.FileSystemBytecodeCache(cache_dir) if cache_dir else None,
             #cache_size = 0 if autoreload else 10
             )
         self._jinjaenv.globals.update({
@@ -827,23 +1072,72 @@ class Server(object):
             "LANGUAGES": constants.LANGUAGES.items(),
             })
 
-        self._async_actions = {}
-        self._handler_cache = {}
+        self._gui_bus = utils.EventBus(wx.CallAfter, utils.is_main_thread)
+        self.thumbnails = ThumbnailService(ThumbnailCache(os.path.join(my_env.get_config_dir(), "thumbnails")))
+        self._static_cache = utils.Cache("server.static", maxmemory=self.static_cache_size, sizeof=lambda k, v: v.size)
+        self._static_streamed = set() # paths bigger than static_max_asset_size
+        self._handler_cache = utils.Cache("server.handlers", maxsize=256)
         self._playcards = {}
+        # Guards playcard indexes, changed on GUI thread and read by web
+        # server thread (_playcards, _recent_cards, _category_cards,
+        # _card_categories and _used_hidden_categories)
+        self._playcards_lock = threading.RLock()
         self._last_jump_id = None
-        self._removed_playcards = []
+        self._changelog = collections.deque() # (version, download id)
+        self._changelog_lock = threading.Lock()
+        self._changelog_start = 0 # versions up to this one were compacted
+        self._card_versions = {} # {download id: last change version}
+        self._category_cards = collections.defaultdict(set) # {category: download ids}
+        self._card_categories = {} # {download id: category}
+        self._recent_cards = set()
         self._data = {
             "server": self,
             }
         self._used_hidden_categories = set()
 
+    template_cache_dirname = "template_cache"
+    preloaded_templates = ("play.html", "settings.html")
+    @classmethod
+    def _template_cache_dir(cls):
+        '''
+        Get per app version template cache directory, removing the ones
+        of other versions.
+
+        Returns:
+            Directory path, or None if it cannot be created.
+        '''
+        base = os.path.join(my_env.get_config_dir(), cls.template_cache_dirname)
+        path = os.path.join(base, constants.APP_VERSION)
+        try:
+            if os.path.isdir(base):
+                for name in os.listdir(base):
+                    if name != constants.APP_VERSION:
+                        shutil.rmtree(os.path.join(base, name), True)
+            if not os.path.isdir(path):
+                os.makedirs(path)
+        except OSError as e:
+            logger.exception(e)
+            return None
+        return path
+
+    def load_templates(self):
+        '''
+        Compile templates which will be requested first, so their
+        sources and bytecode are ready before pages are requested.
+        '''
+        for path in self.preloaded_templates:
+            try:
+                self.get_template(path)
+            except BaseException as e:
+                logger.exception(e)
+
     def set_language(self, catalog):
         self._jinjaenv.install_gettext_translations(catalog)
 
-    _last_remove = 0
+    _version = 0
     @property
-    def last_remove(self):
-        return self._last_remove
+    def version(self):
+        return self._version
 
     _last_update = 0
     @property
@@ -864,10 +1158,56 @@ class Server(object):
     def last_jump(self):
         return self._last_jump
 
-    def get_last_removed_playcards(self, lt=0):
-        for t, did in self._removed_playcards:
-            if t > lt:
-                yield did
+    def _log_change(self, did):
+        with self._changelog_lock:
+            self._version += 1
+            self._changelog.append((self._version, did))
+            self._card_versions[did] = self._version
+            if len(self._changelog) > self.changelog_maxlen:
+                self._compact(self._changelog[-self.changelog_maxlen][0] - 1)
+        self._wake()
+
+    def _compact(self, version):
+        # Changelog lock must be held
+        changelog = self._changelog
+        versions = self._card_versions
+        while changelog and changelog[0][0] <= version:
+            v, did = changelog.popleft()
+            if versions.get(did) == v and not did in self._playcards:
+                del versions[did] # removal acknowledged by everyone
+        self._changelog_start = max(self._changelog_start, version)
+
+    def compact_changes(self, version):
+        '''
+        Discard change log entries up to given version, once every
+        session has got them.
+        '''
+        with self._changelog_lock:
+            self._compact(version)
+
+    def get_changes(self, since):
+        '''
+        Get download playcards changed after given change log version.
+
+        Params:
+            since: change log version cursor.
+
+        Returns:
+            Tuple of sets (changed, removed) of download ids, or None if
+            log has been compacted past given version.
+        '''
+        changed = set()
+        removed = set()
+        with self._changelog_lock:
+            if since < self._changelog_start:
+                return None
+            versions = self._card_versions
+            for version, did in reversed(self._changelog):
+                if version <= since:
+                    break
+                if versions.get(did) == version: # skip superseded entries
+                    (changed if did in self._playcards else removed).add(did)
+        return changed, removed
 
     def get_last_jump_path(self, lt=0):
         if self._last_jump_id in self._playcards:
@@ -890,40 +1230,54 @@ class Server(object):
         return template.module.toolbar_tasks(numcards, self.get_num_files())
 
     def get_num_files(self):
-        return sum(download.numfiles for download in self._playcards.itervalues())
+        with self._playcards_lock:
+            playcards = self._playcards.values()
+        return sum(download.numfiles for download in playcards)
 
     def get_playcard(self, category="all", download=None, path="", mintime=0):
         if download in self._playcards:
             return self._playcards[download].get_playcard(path)
         return None
 
-    def get_playcards_json(self, category="all", download=None, path="", mintime=0):
-        for card in self.get_playcards(category, download, path, mintime):
+    def get_playcards_json(self, category="all", download=None, path="", mintime=0, changed=None):
+        '''
+        Get encoded json of playcards as utils.JSONFragment objects, see
+        get_playcards and utils.json_dumps.
+        '''
+        for card in self.get_playcards(category, download, path, mintime, changed):
             # HTML was deferred until now for performance
-            json = card.json
-            json["html"] = card.html if card.creation > mintime else None
-            yield json
+            yield card.json_fragment(card.creation > mintime)
 
-    def get_playcards(self, category="all", download=None, path="", mintime=0):
+    def get_playcards(self, category="all", download=None, path="", mintime=0, changed=None):
+        '''
+        Get playcards of given category and location updated after mintime
+        or, if given, whose download id is in changed (see get_changes).
+        '''
         if download is None:
             # Getting all downloads
-            if category == "all":
-                for i in self._playcards.itervalues():
-                    if i.last_update > mintime:
-                        yield i
-            elif category == "recent":
-                for i in self._playcards.itervalues():
-                    if i.last_update > mintime and i.new:
-                        yield i
-            else:
-                for i in self._playcards.itervalues():
-                    if i.last_update > mintime and i.category == category:
-                        yield i
+            with self._playcards_lock:
+                if category == "all":
+                    dids = self._playcards.keys() if changed is None else changed
+                elif category == "recent":
+                    dids = self._recent_cards if changed is None else self._recent_cards.intersection(changed)
+                else:
+                    dids = self._category_cards.get(category, ())
+                    if not changed is None:
+                        dids = dids.intersection(changed) if dids else ()
+                dids = list(dids)
+            for did in dids:
+                card = self._playcards.get(did)
+                if card and (not changed is None or card.last_update > mintime):
+                    yield card
         elif download in self._playcards:
             # Getting all files on download path
             download_playcard = self._playcards[download]
             lfr = (category != "recent" or download_playcard.new)
-            if download_playcard.last_update > mintime and lfr:
+            if changed is None:
+                lfr = lfr and download_playcard.last_update > mintime
+            else:
+                lfr = lfr and download in changed
+            if lfr:
                 if category == "all":
                     for i in download_playcard.get_content_of(path):
                         yield i
@@ -961,20 +1315,16 @@ class Server(object):
                     continue
                 yield Category("%s:" % cat, _(text).decode('utf-8'), css, cat == category, template)
 
-    _async_actions = None
     def async_action(self, action, *args, **kwargs):
         '''
-        socket.io server should not call application functions directly
-        so this function allows queueing tasks that will be processed
-        in mainloop.
+        Web handlers run on server thread and should not call application
+        functions directly, so this function allows queueing tasks that
+        will be processed in mainloop.
         '''
-        self._async_actions.setdefault(action, []).append((args, kwargs))
+        self._gui_bus.put(None, self._run_action, action, args, kwargs)
 
-    def process_async_actions(self):
-        while self._async_actions:
-            action, calls = self._async_actions.popitem()
-            for args, kwargs in calls:
-                getattr(self, "action_%s" % action)(*args, **kwargs)
+    def _run_action(self, action, args, kwargs):
+        getattr(self, "action_%s" % action)(*args, **kwargs)
 
     def action_rename(self, card):
         tlw = WxProxy.unproxize(self.app.GetTopWindow()) if self.app else None
@@ -984,10 +1334,20 @@ class Server(object):
             card.last_update = time.time()
             if card.last_update > self._last_update:
                 self._last_update = card.last_update
+            self._log_change(card.path.split("/", 1)[0])
+
+    def is_streamable(self, card):
+        '''
+        True if given unfinished file (or single-file download) playcard
+        can be opened through its stream_path by an open handler.
+        '''
+        return bool(
+            card.stream_path and card.type in ("file", "download") and
+            card.progress < 1 and card.category in self.open_handler)
 
     def action_open(self, card):
         tlw = WxProxy.unproxize(self.app.GetTopWindow()) if self.app else None
-        if os.path.isfile(card.fspath):
+        if self.is_streamable(card) or os.path.isfile(card.fspath):
             category = card.category
             success = False
             if category in self.open_handler:
@@ -1022,14 +1382,26 @@ This file has been removed from disk, do you want to remove from your library to
 
     def _check_used_category(self, cat):
         if cat in constants.HIDDEN_CATEGORIES:
-            cats = set(self._used_hidden_categories)
-            for i in self._playcards.itervalues():
-                cats.discard(i.category)
-            if cats:
-                self._last_category_update = time.time()
-                self._used_hidden_categories.difference_update(cats)
+            with self._playcards_lock:
+                cats = {i for i in self._used_hidden_categories if not self._category_cards.get(i)}
+                if cats:
+                    self._last_category_update = time.time()
+                    self._used_hidden_categories.difference_update(cats)
+
+    def _index_category(self, did, category):
+        # _playcards_lock must be held
+        old = self._card_categories.get(did)
+        if old != category:
+            if not old is None:
+                self._category_cards[old].discard(did)
+            if category is None:
+                del self._card_categories[did]
+            else:
+                self._card_categories[did] = category
+                self._category_cards[category].add(did)
 
     def _add_used_category(self, cat):
+        # _playcards_lock must be held
         if cat in constants.HIDDEN_CATEGORIES and not cat in self._used_hidden_categories:
             self._used_hidden_categories.add(cat)
             self._last_category_update = time.time()
@@ -1043,31 +1415,33 @@ This file has been removed from disk, do you want to remove from your library to
 
     def update_download(self, download, is_new=False):
         did = str(id(download))
-        if did in self._playcards:
-            playcard = self._playcards[did]
-            playcard.last_update = time.time()
-        else:
-            self._playcards[did] = playcard = DownloadPlayCard(self, download, self.get_template("play.html"), is_new)
-        self._add_used_category(playcard.category)
+        with self._playcards_lock:
+            if did in self._playcards:
+                playcard = self._playcards[did]
+                playcard.last_update = time.time()
+            else:
+                self._playcards[did] = playcard = DownloadPlayCard(self, download, self.get_template("play.html"), is_new)
+                if playcard.new:
+                    self._recent_cards.add(did)
+            category = playcard.category
+            self._index_category(did, category)
+            self._add_used_category(category)
         if playcard.last_update > self._last_update:
             self._last_update = playcard.last_update
+        self._log_change(did)
 
     def remove_download_ids(self, download_ids):
-        t = time.time()
-        removed_downloads = []
         recheck_categories = set()
         for did in download_ids:
             did = str(did)
-            if did in self._playcards:
-                recheck_categories.add(self._playcards[did].category)
-                removed_downloads.append((t, did))
-                del self._playcards[did]
-        if removed_downloads:
-            self._removed_playcards.extend(removed_downloads)
-            if len(self._removed_playcards) > 100:
-                self._removed_playcards[:] = self._removed_playcards[-101:]
-            if t > self._last_remove:
-                self._last_remove = t
+            with self._playcards_lock:
+                playcard = self._playcards.pop(did, None)
+                if playcard:
+                    recheck_categories.add(playcard.category)
+                    self._recent_cards.discard(did)
+                    self._index_category(did, None)
+            if playcard:
+                self._log_change(did)
         for category in recheck_categories:
             self._check_used_category(category)
 
@@ -1086,16 +1460,15 @@ This file has been removed from disk, do you want to remove from your library to
         # Handler name
         if request.path.startswith("/card_image/"):
             handler = "handle_card_image"
+        elif request.path.startswith("/stream/"):
+            handler = "handle_stream"
         elif request.path == "/":
             handler = "handle_index"
         else:
             handler = "handle_" + request.path.strip("/").replace("/", "_")
 
         # Getting handler
-        try:
-            fnc = self._handler_cache.setdefault(handler, getattr(self, handler))
-        except AttributeError:
-            self._handler_cache[handler] = fnc = self.serve_file
+        fnc = self._handler_cache.get_or_set(handler, getattr, self, handler, self.serve_file)
 
         # Process
         try:
@@ -1158,6 +1531,25 @@ This file has been removed from disk, do you want to remove from your library to
             num_backends = len(self.app.backend.backends)
             )
 
+    def handle_events(self, request):
+        '''
+        Server-Sent Events stream notifying change log version as soon as
+        it grows, so pages can request /comm only when needed.
+        '''
+        request.response_headers["Content-Type"] = "text/event-stream"
+        request.response_headers["Cache-Control"] = "no-cache"
+        version = self.version
+        yield "retry: 2000\nevent: change\ndata: %d\n\n" % version
+        while self.running:
+            changed = self._changed
+            if version == self.version:
+                changed.wait(self.sse_keepalive)
+            if version == self.version:
+                yield ": keepalive\n\n"
+            else:
+                version = self.version
+                yield "event: change\ndata: %d\n\n" % version
+
     def handle_card_image(self, request):
         path = request.path[12:] # len("/card_image/") == 12
         if "/" in path:
@@ -1166,13 +1558,136 @@ This file has been removed from disk, do you want to remove from your library to
             download = path
             path = ""
         if download in self._playcards:
-            data = self.get_playcard("all", download, path).preview
+            playcard = self.get_playcard("all", download, path)
+            data = playcard.preview
             if data:
                 request.response_headers['Content-Type'] = "image/%s" % utils.image_format(data)
-                request.cache_forever()
+                if isinstance(playcard, FilePlayCard):
+                    request.cache_for(self.file_preview_max_age) # file could change
+                else:
+                    request.cache_forever()
                 return data
+            if isinstance(playcard, FilePlayCard):
+                return self._wait_file_preview(request, playcard)
         request.error(404)
 
+    preview_timeout = 10
+    file_preview_max_age = 3600
+    def _wait_file_preview(self, request, playcard):
+        '''
+        Render file thumbnail, waiting for it at most `preview_timeout`
+        seconds, and respond with it or with category placeholder.
+        '''
+        future = playcard.request_preview()
+        if future:
+            deadline = time.time() + self.preview_timeout
+            while not future.done() and time.time() < deadline:
+                gevent.sleep(0.1)
+            data = playcard.preview if future.done() else None
+            if data:
+                request.response_headers['Content-Type'] = "image/%s" % utils.image_format(data)
+                request.cache_for(self.file_preview_max_age)
+                return data
+        # Placeholder is not cached, so browser will try again
+        placeholder = constants.WEB_CATEGORY_PLACEHOLDERS.get(
+            playcard.filetype, constants.WEB_CATEGORY_PLACEHOLDERS["unknown"])
+        data = self.get_static("imgs/%s.png" % placeholder)
+        if data:
+            request.response_headers['Content-Type'] = "image/png"
+            return data
+        request.error(404)
+
+    stream_chunk_size = 262144 # 256 KiB
+    stream_readahead = 8388608 # 8 MiB prioritized ahead of streamed position
+    stream_timeout = 60 # seconds waiting for missing data
+    def handle_stream(self, request):
+        '''
+        Serve download files, with HTTP Range support, while they are
+        being downloaded.
+        '''
+        path = request.path[8:] # len("/stream/") == 8
+        download, sep, path = path.partition("/")
+        playcard = self._playcards.get(download)
+        if playcard is None:
+            request.error(404)
+            return None
+        download = playcard._download
+        try:
+            path = path.decode("utf-8").replace("/", os.sep)
+        except UnicodeDecodeError:
+            request.error(404)
+            return None
+        filenames = download.filenames
+        if not path and len(filenames) == 1:
+            path = filenames[0]
+        size = download.file_size(path) if path in filenames else None
+        if size is None:
+            request.error(404)
+            return None
+
+        headers = request.response_headers
+        headers["Accept-Ranges"] = "bytes"
+        headers["Content-Type"] = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        start, end = 0, size
+        if "HTTP_RANGE" in request.environ:
+            byte_range = utils.parse_range(request.environ["HTTP_RANGE"], size)
+            if byte_range is None:
+                request.response_code = "416 REQUESTED RANGE NOT SATISFIABLE"
+                headers["Content-Range"] = "bytes */%d" % size
+                return ()
+            start, end = byte_range
+            request.response_code = "206 PARTIAL CONTENT"
+            headers["Content-Range"] = "bytes %d-%d/%d" % (start, end - 1, size)
+        headers["Content-Length"] = str(end - start)
+        if request.environ.get("REQUEST_METHOD") == "HEAD" or start == end:
+            return ()
+        return self._stream_download(request, download, path, start, end)
+
+    def _stream_download(self, request, download, path, start, end):
+        '''
+        Yield download file data from start to end (excluded), waiting
+        cooperatively for missing pieces while backend prioritizes them.
+
+        If no data arrives in time for the first chunk, response is
+        turned into a 503 error.
+        '''
+        fspath = os.path.join(download.download_dir, path)
+        position = start
+        prioritized = start
+        f = None
+        try:
+            while position < end:
+                chunk_end = min(position + self.stream_chunk_size, end)
+                if not download.finished:
+                    prioritized = max(prioritized, min(position + self.stream_readahead, end))
+                    download.prioritize_range(path, position, prioritized)
+                    deadline = time.time() + self.stream_timeout
+                    while not download.have_range(path, position, chunk_end):
+                        if time.time() > deadline:
+                            logger.debug("Stream timeout on %r at %d" % (path, position))
+                            if position == start:
+                                # Headers are not sent until first chunk
+                                request.response_code = "503 SERVICE UNAVAILABLE"
+                                request.response_headers.pop("Content-Length", None)
+                                request.response_headers.pop("Content-Range", None)
+                                request.response_headers["Content-Type"] = "text/plain"
+                                yield "Service unavailable"
+                            return
+                        gevent.sleep(0.25)
+                if f is None:
+                    f = open(fspath, "rb")
+                    f.seek(position)
+                data = f.read(chunk_end - position)
+                if not data:
+                    return
+                position += len(data)
+                yield data
+        finally:
+            if f:
+                f.close()
+            if prioritized > start:
+                download.release_range(path, start, prioritized)
+
     _forced_mimes = {
         "png": "image/png",
         "gif": "image/gif",
@@ -1182,53 +1697,130 @@ This file has been removed from disk, do you want to remove from your library to
         "html": "text/html; charset=utf-8",
         "swf": "application/x-shockwave-flash",
         }
+    def _guess_mime(self, path):
+        ext = path.rsplit(".", 1)[-1]
+        if ext in self._forced_mimes:
+            return self._forced_mimes[ext]
+        mime, encoding = mimetypes.guess_type(path)
+        if mime is None:
+            mime = "application/octet-stream"
+        if encoding:
+            mime += "; " + encoding
+        return mime
+
+    def _load_asset(self, path):
+        '''
+        Read static file into asset cache.
+
+        Returns:
+            StaticAsset or None if file is too big to be cached.
+        '''
+        fp = utils.get_resource_stream(path)
+        if fp is None:
+            return None
+        try:
+            data = fp.read(self.static_max_asset_size + 1)
+        finally:
+            fp.close()
+        if len(data) > self.static_max_asset_size:
+            self._static_streamed.add(path)
+            return None
+        asset = StaticAsset(data, self._guess_mime(path), utils.get_resource_mtime(path))
+        self._static_cache[path] = asset
+        return asset
+
+    def _get_asset(self, path):
+        asset = self._static_cache.get(path)
+        if asset and config.DEBUG and asset.mtime != utils.get_resource_mtime(path):
+            asset = None # modified, reload
+        if asset is None and not path in self._static_streamed and utils.get_resource_exists(path):
+            asset = self._load_asset(path)
+        return asset
+
+    def load_static(self, base=None):
+        '''
+        Populate static asset cache with files on static directory, until
+        cache is full.
+        '''
+        base = base or self.static
+        for name in utils.get_resource_listdir(base):
+            path = base + "/" + name
+            if utils.get_resource_isdir(path):
+                self.load_static(path)
+            elif not path in self._static_cache and not path in self._static_streamed:
+                self._load_asset(path)
+            if self._static_cache.metrics["evictions"]:
+                break
+
+    def _stream_file(self, path):
+        fp = utils.get_resource_stream(path)
+        try:
+            chunk = fp.read(self.buffsize)
+            while chunk:
+                yield chunk
+                chunk = fp.read(self.buffsize)
+        finally:
+            fp.close()
+
     def serve_file(self, request):
         ''' Load files from static directory '''
         path = os.path.join(self.static, request.path.lstrip('/')).replace(os.sep, '/')
-        if path.startswith(self.static): # extra check due ".." components
+        if not path.startswith(self.static): # extra check due ".." components
+            request.error(404)
+            return None
+        asset = self._static_cache.get(path) if not config.DEBUG else None
+        if asset is None:
             if utils.get_resource_isdir(path):
                 path = path.rstrip("/") + "/index.html"
-            if utils.get_resource_exists(path):
-                ext = path.rsplit(".", 1)[-1]
-                if ext in self._forced_mimes:
-                    mime = self._forced_mimes[ext]
-                else:
-                    mime, encoding = mimetypes.guess_type(path)
-                    if mime is None:
-                        mime = "application/octet-stream"
-                    if encoding:
-                        mime += "; " + encoding
-                request.response_headers['Content-Type'] = mime
-                fp = utils.get_resource_stream(path)
-                chunk = fp.read(self.buffsize)
-                if not config.DEBUG:
-                    request.cache_for(3600) # an hour
-                while chunk:
-                    yield chunk
-                    chunk = fp.read(self.buffsize)
-            else:
+            asset = self._get_asset(path)
+        if not config.DEBUG:
+            request.cache_for(3600) # an hour
+        if asset is None:
+            if not path in self._static_streamed:
                 request.error(404)
-        else:
-            request.error(404)
+                return None
+            request.response_headers['Content-Type'] = self._guess_mime(path)
+            return self._stream_file(path)
+
+        headers = request.response_headers
+        headers['Content-Type'] = asset.mime
+        headers['ETag'] = asset.etag
+        if asset.gzdata:
+            headers['Vary'] = "Accept-Encoding"
+
+        etags = request.environ.get("HTTP_IF_NONE_MATCH", "")
+        if etags and (etags.strip() == "*" or asset.etag in (i.strip() for i in etags.split(","))):
+            request.response_code = "304 NOT MODIFIED"
+            return ()
+
+        if asset.gzdata and utils.accepts_encoding(request.environ.get("HTTP_ACCEPT_ENCODING", ""), "gzip"):
+            headers['Content-Encoding'] = "gzip"
+            return (asset.gzdata,)
+        return (asset.data,)
 
     def jump_play(self, download):
         self._last_jump = time.time()
         self._last_jump_id = str(id(download))
+        self._wake()
 
     def jump_settings(self, tbd):
         pass
 
-    def loop(self, event=None):
-        if self.running:
-            self.process_async_actions()
-            try:
-                gevent.sleep()
-            except KeyboardInterrupt:
-                self.app.close_app()
+    _wakeup = None
+    def _wake(self):
+        '''
+        Wake /events listeners, from any thread.
+        '''
+        if self._wakeup:
+            self._wakeup.send()
+
+    def _wake_listeners(self):
+        # Runs on server hub
+        changed, self._changed = self._changed, gevent.event.Event()
+        changed.set()
 
     @property
     def running(self):
-        #return self._thread.is_alive()
         return self in self._all_servers
 
     @classmethod
@@ -1238,26 +1830,50 @@ This file has been removed from disk, do you want to remove from your library to
 
     def shutdown(self):
         if self.running:
-            self._server.stop()
             self._all_servers.remove(self)
+            self._stopper.send()
+            self._thread.join(5)
 
-    _wkutimer = None
-    def start(self):
-        if not self._wkutimer:
-            self._wkutimer = wx.Timer(
-                WxProxy.unproxize(self.app),
-                wx.ID_ANY
-                ) # WakeUp timer on wxApp
+    def _serve(self, started):
+        # Server thread, with its own gevent hub
+        try:
+            loop = gevent.get_hub().loop
+            self._changed = gevent.event.Event()
+            self._stopper = loop.async()
+            self._stopper.start(lambda: gevent.spawn(self._server.stop))
+            wakeup = loop.async()
+            wakeup.start(self._wake_listeners)
+            self._wakeup = wakeup
+            self._server = WSGIServer(
+                ('0.0.0.0' if config.DEBUG else '127.0.0.1', self.port),
+                self.handler,
+                log=None #log="default" if config.DEBUG else None,
+                )
+            self._server.start()
+        except BaseException as e:
+            logger.exception(e)
+            self._all_servers.discard(self)
+            return
+        finally:
+            started.set()
+        try:
+            self.load_templates()
+            self.load_static()
+        except BaseException as e:
+            logger.exception(e)
+        self._server.serve_forever()
+        self._wakeup = None
 
+    _thread = None
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
         self._all_servers.add(self)
-        self._server = WSGIServer(
-            ('0.0.0.0' if config.DEBUG else '127.0.0.1', self.port),
-            self.handler,
-            log=None #log="default" if config.DEBUG else None,
-            )
-        self._server.start()
-        self.app.Bind(wx.EVT_TIMER, self.loop, None, self._wkutimer.GetId())
-        self._wkutimer.Start(50) # Using EVT_IDLE eats CPU
+        started = threading.Event()
+        self._thread = threading.Thread(target=self._serve, args=(started,), name="WebServer")
+        self._thread.daemon = True
+        self._thread.start()
+        started.wait()
 
         logger.debug("Local SocketIO server on %s" % self.url)
 
@@ -3,6 +3,7 @@
 import time
 import logging
 import config
+import utils
 
 logger = logging.getLogger(__name__)
 
@@ -27,6 +28,7 @@ class XHRComm(object):
         self._sessions = {}
         self._handlers = {} # For faster handler resolution
         self.session_expiration = 300 # 5 minutes
+        self.gzip_min_size = 2048 # bigger responses are compressed if accepted
 
     @property
     def current_id(self):
@@ -138,18 +140,22 @@ class XHRComm(object):
         try:
             # Request response
             headers = self.response_headers
+            if environ.get("response_emits"):
+                # Emits can contain cached JSONFragment objects
+                response_body = utils.json_dumps(environ["response_emits"])
+            elif self.response_headers.get("Content-Type", "").endswith("; charset=utf-8"):
+                response_body = environ["response_body"].encode("utf-8")
+            else:
+                response_body = environ["response_body"]
+            if len(response_body) > self.gzip_min_size and utils.accepts_encoding(environ.get("HTTP_ACCEPT_ENCODING", ""), "gzip"):
+                response_body = utils.gzip_data(response_body)
+                headers["Content-Encoding"] = "gzip"
             start_response(
                 environ["response_code"],
                 [(k, i)
                  for k, v in headers.iteritems()
                  for i in (v if isinstance(v, (list, tuple)) else (v,))]
                 )
-            if environ.get("response_emits"):
-                response_body = json.dumps(environ["response_emits"])
-            elif self.response_headers.get("Content-Type", "").endswith("; charset=utf-8"):
-                response_body = environ["response_body"].encode("utf-8")
-            else:
-                response_body = environ["response_body"]
 
             if config.DEBUG:
                 t = time.time()-now
@@ -188,16 +194,35 @@ class DownloaderXHRConn(XHRComm):
             server = self.server
             subscriptions = self.session["subscriptions"]
             if "play" in subscriptions:
-                if server.last_update > self.session["last_update"]:
-                    logger.debug("HEARTBEAT: play > last update")
+                if server.version > self.session["version"]:
+                    logger.debug("HEARTBEAT: play > version")
                     category, download, path = self.session["path"]
-                    cards = list(server.get_playcards_json(category, download, path, self.session["last_update"]))
-                    if cards:
-                        self.emit("update", {
-                            "tasks": server.get_toolbar_tasks(category, download, path),
-                            "cards": cards,
-                            })
-                    self.session["last_update"] = server.last_update
+                    version = server.version
+                    changes = server.get_changes(self.session["version"])
+                    if changes is None:
+                        # Change log compacted past our cursor so removals
+                        # are unknown, reload current path (updates version)
+                        self.on_open(self._path_string(category, download, path))
+                    else:
+                        changed, removed = changes
+                        if changed:
+                            cards = list(server.get_playcards_json(category, download, path, self.session["last_update"], changed))
+                            if cards:
+                                self.emit("update", {
+                                    "tasks": server.get_toolbar_tasks(category, download, path),
+                                    "cards": cards,
+                                    })
+                        if removed:
+                            self.emit("remove", {
+                                "tasks": server.get_toolbar_tasks(category, download, path),
+                                "ids": list(removed),
+                                })
+                        self.session["version"] = version
+                        self.session["last_update"] = server.last_update
+                    server.compact_changes(min(
+                        session.get("version", version)
+                        for session in self._sessions.itervalues()
+                        ))
                 if server.last_category_update > self.session["last_category_update"]:
                     logger.debug("HEARTBEAT: play > last category update")
                     category, download, path = self.session["path"]
@@ -208,16 +233,6 @@ class DownloaderXHRConn(XHRComm):
                             ]
                         })
                     self.session["last_category_update"] = server.last_category_update
-                if server.last_remove > self.session["last_remove"]:
-                    logger.debug("HEARTBEAT: play > last remove")
-                    category, download, path = self.session["path"]
-                    ids = list(server.get_last_removed_playcards(self.session["last_remove"]))
-                    if ids:
-                        self.emit("remove", {
-                            "tasks": server.get_toolbar_tasks(category, download, path),
-                            "ids": ids,
-                            })
-                    self.session["last_remove"] = server.last_remove
                 if server.last_jump > self.session["last_jump"]:
                     self.on_open(server.get_last_jump_path(self.session["last_jump"]))
                     self.session["last_jump"] = server.last_jump
@@ -242,8 +257,19 @@ class DownloaderXHRConn(XHRComm):
             cpath = ""
         return category, download, cpath
 
+    @classmethod
+    def _path_string(cls, category, download, path):
+        '''
+        Inverse of _path
+        '''
+        if download is None:
+            return "%s:" % category
+        if path:
+            return "%s:%s/%s" % (category, download, path)
+        return "%s:%s" % (category, download)
+
     _subsscription_defaults = {
-        "play": {"path": ("all", None, ""), "last_update": 0, "last_remove":0, "last_category_update":0, "last_jump": 0},
+        "play": {"path": ("all", None, ""), "last_update": 0, "version": 0, "last_category_update":0, "last_jump": 0},
         "settings": {"last_settings":0}
         }
     def on_subscribe(self, code, path="all:", jump=True):
@@ -280,14 +306,17 @@ class DownloaderXHRConn(XHRComm):
 
         base_playcard = server.get_playcard(category, download, cpath)
         cardtype = "root" if base_playcard is None else base_playcard.type
+        # Unfinished files, and single-file downloads, are opened
+        # through their stream_path instead of browsed
+        streamable = cardtype != "root" and server.is_streamable(base_playcard)
 
-        if cardtype in ("root", "folder", "download"):
+        if cardtype in ("root", "folder") or (cardtype == "download" and not streamable):
             # TODO(felipe): best-file-prediction for download
             # Session update
             self.session.update({
                 "path": (category, download, cpath),
                 "last_update": server.last_update,
-                "last_remove": server.last_remove,
+                "version": server.version,
                 })
 
             if jump:
@@ -306,5 +335,5 @@ class DownloaderXHRConn(XHRComm):
                         for cat in server.get_categories(category, download, cpath)
                         ],
                     })
-        elif jump and cardtype != "virtual" and base_playcard.progress == 1:
+        elif jump and cardtype != "virtual" and (base_playcard.progress == 1 or streamable):
             server.async_action("open", base_playcard)
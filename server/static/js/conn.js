@@ -19,6 +19,7 @@
             return (typeof obj[prop] != "undefined");
             },
         connected = false,
+        pushed = false, // server wakes us through /events
         timeout = null,
         timeout_relax = 0,
         timeout_relax_threshold = 10,
@@ -26,9 +27,18 @@
         increase_timeout = function(){
             if(timeout_relax < timeout_relax_threshold)
                 timeout_relax += 1;
-            else if(timeout_milliseconds < 1000)
+            else if(timeout_milliseconds < (pushed?5000:1000))
                 timeout_milliseconds += 250;
             },
+        listen = function(){
+            if(!window.EventSource) return;
+            var source = new EventSource('/events');
+            source.addEventListener("change", function(){
+                pushed = true;
+                instance.heartbeat();
+                }, false);
+            source.onerror = function(){pushed = false;};
+            },
         stress_timeout = function(){
             timeout_relax = 0;
             timeout_milliseconds = 100;
@@ -110,6 +120,7 @@
         dummy_socketio = {
             connect: function(){
                 instance.emit("connect");
+                listen();
                 return instance;
                 }
             };
@@ -0,0 +1,390 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Thumbnail generation off GUI thread with a content-addressed on-disk
+cache.
+'''
+
+import sys
+import os
+import os.path
+import time
+import shutil
+import hashlib
+import logging
+import itertools
+import threading
+import tempfile
+import subprocess
+
+try:
+    from cStringIO import StringIO  # C module
+except ImportError:
+    from StringIO import StringIO  # Python fallback
+
+import wx
+
+import utils
+import extras
+
+logger = logging.getLogger(__name__)
+
+def key_for_data(data):
+    '''
+    Get thumbnail key of given image source data
+    '''
+    return hashlib.sha1(data).hexdigest()
+
+def key_for_file(path):
+    '''
+    Get thumbnail key of given local file, from its path, size and
+    modification time.
+
+    Raises:
+        OSError if file cannot be stat'ed.
+    '''
+    st = os.stat(path)
+    if isinstance(path, unicode):
+        path = path.encode("utf-8")
+    return hashlib.sha1("%s\0%d\0%d" % (path, st.st_size, st.st_mtime)).hexdigest()
+
+if os.name == "nt":
+    STARTUPINFO = subprocess.STARTUPINFO()
+    STARTUPINFO.dwFlags |= subprocess.STARTF_USESHOWWINDOW
+else:
+    STARTUPINFO = None
+
+def grab_frame(mplayer, path, position=0, timeout=30):
+    '''
+    Extract a video frame with mplayer.
+
+    Params:
+        mplayer: mplayer executable path.
+        path: video file path.
+        position: seek position in seconds.
+        timeout: seconds before mplayer process is killed.
+
+    Returns:
+        PNG data or None if no frame could be extracted.
+    '''
+    encoding = sys.getfilesystemencoding() or "utf-8"
+    tmpdir = tempfile.mkdtemp()
+    try:
+        # mplayer suboption values with ':' (ie. windows drives) must
+        # be prefixed by their length as %len%
+        outdir = tmpdir.encode(encoding) if isinstance(tmpdir, unicode) else tmpdir
+        args = [
+            mplayer, "-really-quiet", "-nosound", "-nolirc", "-noconsolecontrols",
+            "-vo", "png:z=1:outdir=%%%d%%%s" % (len(outdir), outdir),
+            "-ss", str(position), "-frames", "2", "--", path,
+            ]
+        args = [arg.encode(encoding) if isinstance(arg, unicode) else arg for arg in args]
+        with open(os.devnull, "r+b") as devnull:
+            process = subprocess.Popen(
+                args, stdin=devnull, stdout=devnull, stderr=devnull,
+                startupinfo=STARTUPINFO)
+            deadline = time.time() + timeout
+            while process.poll() is None:
+                if time.time() > deadline:
+                    logger.debug("mplayer timeout on %r" % path)
+                    process.kill()
+                    process.wait()
+                    break
+                time.sleep(0.1)
+        frames = sorted(name for name in os.listdir(tmpdir) if name.endswith(".png"))
+        if frames:
+            with open(os.path.join(tmpdir, frames[-1]), "rb") as f:
+                return f.read()
+    finally:
+        shutil.rmtree(tmpdir, True)
+    return None
+
+
+class ThumbnailCache(object):
+    '''
+    Thumbnails stored as PNG files by key and size, on
+    `directory/<key[:2]>/<key>-<size>.png`.
+
+    Every thumbnail is rendered on every size of `sizes`, being sizes
+    the length of the shortest side.
+
+    Directory is kept under `max_size` bytes, least recently used
+    thumbnails are removed first (reads touch file mtime) until
+    `prune_ratio` of `max_size` is in use.
+    '''
+    sizes = (64, 150, 300)
+    min_source_size = 50 # smaller images are discarded
+    max_size = 64 << 20
+    prune_ratio = 0.75
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._usage = None # bytes, computed on first store
+        self._lock = threading.Lock()
+
+    def path(self, key, size):
+        return os.path.join(self.directory, key[:2], "%s-%d.png" % (key, size))
+
+    def has(self, key):
+        return os.path.isfile(self.path(key, self.sizes[-1]))
+
+    def get(self, key, size):
+        '''
+        Get thumbnail PNG data for given key and size, or None if not
+        cached.
+        '''
+        path = self.path(key, size)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path, None) # see prune
+            return data
+        except (IOError, OSError):
+            pass
+        return None
+
+    def _entries(self):
+        '''
+        Get {key: [mtime, size in bytes, paths]} of stored thumbnails.
+        '''
+        entries = {}
+        for dirpath, dirnames, filenames in os.walk(self.directory):
+            for name in filenames:
+                if not name.endswith(".png"):
+                    continue
+                path = os.path.join(dirpath, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                key = name.rsplit("-", 1)[0]
+                if key in entries:
+                    entry = entries[key]
+                    entry[0] = max(entry[0], st.st_mtime)
+                    entry[1] += st.st_size
+                    entry[2].append(path)
+                else:
+                    entries[key] = [st.st_mtime, st.st_size, [path]]
+        return entries
+
+    def prune(self):
+        '''
+        Remove least recently used thumbnails while over `max_size`.
+        '''
+        with self._lock:
+            entries = self._entries()
+            usage = sum(entry[1] for entry in entries.itervalues())
+            if usage > self.max_size:
+                target = self.max_size * self.prune_ratio
+                for mtime, size, paths in sorted(entries.itervalues()):
+                    if usage <= target:
+                        break
+                    for path in paths:
+                        try:
+                            os.remove(path)
+                        except OSError as e:
+                            logger.debug(e)
+                    usage -= size
+            self._usage = usage
+
+    def _account(self, size):
+        with self._lock:
+            if self._usage is not None:
+                self._usage += size
+                return self._usage > self.max_size
+        return True # first store, directory usage unknown
+
+    def store(self, key, data):
+        '''
+        Render and store thumbnails of given image data.
+
+        Raises:
+            ValueError if data is not a valid image or it is too small.
+        '''
+        image_type = utils.image_format_to_bitmap_type.get(utils.image_format(data))
+        if image_type is None:
+            raise ValueError("Unknown image format.")
+        image = wx.ImageFromStream(StringIO(data), image_type)
+        try:
+            if not image.IsOk():
+                raise ValueError("Cannot decode image.")
+            w, h = image.GetSize()
+            if w <= self.min_source_size or h <= self.min_source_size:
+                raise ValueError("Image too small (%dx%d)." % (w, h))
+            directory = os.path.dirname(self.path(key, 0))
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            stored = 0
+            for size in self.sizes: # largest last, see has
+                f = float(size) / min(w, h)
+                if f < 1:
+                    scaled = image.Scale(max(int(f*w), 1), max(int(f*h), 1), wx.IMAGE_QUALITY_HIGH)
+                    stored += self._save(scaled, self.path(key, size))
+                    scaled.Destroy()
+                else:
+                    stored += self._save(image, self.path(key, size))
+        finally:
+            image.Destroy()
+        if self._account(stored):
+            self.prune()
+
+    def _save(self, image, path):
+        '''
+        Save image as PNG on given path, returns written bytes.
+        '''
+        stream = StringIO()
+        image.SaveStream(stream, wx.BITMAP_TYPE_PNG)
+        data = stream.getvalue()
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        if os.path.exists(path):
+            os.remove(path) # no atomic replace on windows
+        os.rename(tmp, path)
+        return len(data)
+
+
+class ThumbnailService(object):
+    '''
+    Fetch, decode and render thumbnails into a ThumbnailCache on worker
+    threads.
+
+    Requests return Future objects resolving to thumbnail key. Equal
+    requests share the same Future while pending, and failed ones are
+    not retried for `retry_delay` seconds (request methods return None
+    meanwhile).
+
+    URLs are fetched on its own pool of `url_workers` threads, as
+    GetURL requests run on utils._iopool and waiting for them from
+    there would exhaust it, giving up after `url_timeout` seconds
+    without response.
+
+    Local files are processed on its own pool of `local_workers` threads
+    (every one running at most a single mplayer process), most recent
+    requests first.
+    '''
+    retry_delay = 600
+    url_workers = 4
+    url_timeout = 30
+    local_workers = 2
+    video_positions = (30, 0) # seconds, retried in order for short videos
+    video_timeout = 30
+    max_image_file_size = 32 << 20
+    file_categories = ("image", "video") # supported by request_file
+
+    def __init__(self, cache):
+        self.cache = cache
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._failed = utils.Cache("thumbnails.failed", maxsize=1024, ttl=self.retry_delay)
+        self._url_pool = utils.TaskPool(max_workers=self.url_workers)
+        self._local_pool = utils.TaskPool(max_workers=self.local_workers)
+        self._local_counter = itertools.count()
+
+    def _submit(self, token, pool, fnc, args, priority=0):
+        if token in self._failed:
+            return None
+        with self._lock:
+            future = self._pending.get(token)
+            if future is not None:
+                return future
+            future = pool.submit(self._run, (token, fnc, args), priority=priority)
+            self._pending[token] = future
+        # Outside lock, callback is called right away if already done
+        future.add_done_callback(lambda future: self._discard(token, future))
+        return future
+
+    def _discard(self, token, future):
+        with self._lock:
+            if self._pending.get(token) is future:
+                del self._pending[token]
+
+    def _run(self, token, fnc, args):
+        try:
+            return fnc(*args)
+        except BaseException:
+            self._failed[token] = True
+            raise
+
+    def _render(self, data):
+        key = key_for_data(data)
+        if not self.cache.has(key):
+            self.cache.store(key, data)
+        return key
+
+    def _render_url(self, url):
+        request = utils.GetURL(url)
+        request.wait(self.url_timeout)
+        if not request.ready:
+            request.cancel()
+            raise ValueError("Timeout fetching %r." % url)
+        if request.failed:
+            raise ValueError("Cannot fetch %r: %s" % (url, request.get_error_message()))
+        data = request.read_all() # socket reads time out on their own
+        # Decoding is CPU bound, leave I/O pool for fetching
+        return utils._taskpool.submit(self._render, (data,)).result()
+
+    def _render_file(self, key, path, category):
+        if self.cache.has(key):
+            return key
+        if category == "image":
+            if os.path.getsize(path) > self.max_image_file_size:
+                raise ValueError("Image file too big.")
+            with open(path, "rb") as f:
+                data = f.read()
+        else:
+            mplayer = extras.InternalMPlayer.available()
+            if mplayer is None:
+                raise ValueError("Player not available.")
+            for position in self.video_positions:
+                data = grab_frame(mplayer["path"], path, position, self.video_timeout)
+                if data:
+                    break
+            else:
+                raise ValueError("Cannot extract video frame.")
+        self.cache.store(key, data)
+        return key
+
+    def request_data(self, data):
+        '''
+        Render thumbnails of given image data.
+
+        Returns:
+            Future object resolving to thumbnail key.
+        '''
+        return self._submit(key_for_data(data), utils._taskpool, self._render, (data,))
+
+    def request_url(self, url):
+        '''
+        Fetch image from given url and render its thumbnails.
+
+        Returns:
+            Future object resolving to thumbnail key, or None if url
+            failed recently.
+        '''
+        return self._submit(url, self._url_pool, self._render_url, (url,))
+
+    def request_file(self, path, category, key=None):
+        '''
+        Render thumbnails of given local image or video file.
+
+        Params:
+            path: file path.
+            category: web category of file, "image" or "video".
+            key: thumbnail key as given by key_for_file, computed if
+                 not given.
+
+        Returns:
+            Future object resolving to thumbnail key, or None if file
+            failed recently or cannot be rendered.
+        '''
+        if not category in self.file_categories:
+            return None
+        if key is None:
+            try:
+                key = key_for_file(path)
+            except OSError:
+                return None
+        # Later requests are likely the ones being displayed
+        priority = -next(self._local_counter)
+        return self._submit(key, self._local_pool, self._render_file, (key, path, category), priority)
@@ -5,14 +5,16 @@ import sys
 import os
 import os.path
 import socket
+import select
 import logging
 import collections
 import urllib
 import urllib2
+import urlparse
+import httplib
 import threading
 import operator
 import itertools
-import functools
 import hashlib
 import weakref
 import errno
@@ -21,6 +23,7 @@ import traceback
 import platform
 import json
 import zlib
+import gzip
 import types
 import base64
 import gc
@@ -34,6 +37,16 @@ try:
 except ImportError:
     logging.warning("wx not available")
 
+try:
+    import multiprocessing
+except ImportError:
+    multiprocessing = None
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
 try:
     import cStringIO as StringIO
 except ImportError:
@@ -141,9 +154,216 @@ class DefaultAttrDict(dict):
         return "%s%s ; %s }" % (self.__class__.__name__, dict.__repr__(self)[:-1], self.factory)
 
 
-class CappedDict(collections.OrderedDict):
+class Cache(collections.MutableMapping):
+    '''
+    Instrumented mapping with optional bounds on number of entries
+    (`maxsize`), entry age (`ttl` seconds) and memory (`maxmemory` bytes,
+    as measured by `sizeof`). When full, least recently used entries are
+    evicted first, or least recently written ones if `lru` is False.
+    Lookups, writes and evictions are O(1).
+
+    Caches are registered by `name`, counters of all caches sharing a
+    name are available as dict from `Cache.stats()`. Every cache counters
+    are available as dict on `metrics`: hits, misses, evictions,
+    expirations, entries and memory (bytes, shallow estimate unless
+    `sizeof` is given).
+
+    Membership tests are not counted, so `get` should be preferred over
+    `in` checks followed by lookups.
+
+    >>> c = Cache("doctest", maxsize=2)
+    >>> c["a"] = 1
+    >>> c["b"] = 2
+    >>> c["a"]
+    1
+    >>> c["c"] = 3
+    >>> sorted(c)
+    ['a', 'c']
+    >>> c.get("b") is None
+    True
+    >>> m = c.metrics
+    >>> m["hits"], m["misses"], m["evictions"], m["entries"]
+    (1, 1, 1, 2)
+    >>> Cache.stats()["doctest"]["hits"]
+    1
     '''
-    OrderedDict with maximum size
+    _registry = weakref.WeakSet()
+    _counters = ("hits", "misses", "evictions", "expirations")
+    __hash__ = object.__hash__ # for registry
+
+    def __init__(self, name=None, maxsize=None, ttl=None, maxmemory=None, sizeof=None, lru=True):
+        self.name = name or self.__class__.__name__
+        self.maxsize = sys.maxint if maxsize is None else maxsize
+        self.ttl = ttl
+        self.maxmemory = maxmemory
+        self.sizeof = sizeof or (self._default_sizeof if maxmemory else None)
+        self.lru = lru
+        self._lock = threading.Lock()
+        self._data = collections.OrderedDict()
+        self._expires = collections.OrderedDict() # sorted by deadline as ttl is constant
+        self._sizes = {}
+        self._memory = 0
+        self._metrics = dict.fromkeys(self._counters, 0)
+        self._registry.add(self)
+
+    @staticmethod
+    def _default_sizeof(k, v):
+        return sys.getsizeof(k) + sys.getsizeof(v)
+
+    @property
+    def metrics(self):
+        with self._lock:
+            metrics = dict(self._metrics)
+            metrics["entries"] = len(self._data)
+            if self.sizeof:
+                metrics["memory"] = self._memory
+            else:
+                metrics["memory"] = sum(self._default_sizeof(k, v) for k, v in self._data.iteritems())
+        return metrics
+
+    @classmethod
+    def stats(cls):
+        '''
+        Get counters of every registered cache, aggregated by name.
+
+        Returns:
+            Dict {name: metrics dict}.
+        '''
+        stats = {}
+        for cache in list(cls._registry):
+            metrics = cache.metrics
+            if cache.name in stats:
+                for k, v in metrics.iteritems():
+                    stats[cache.name][k] += v
+            else:
+                metrics["caches"] = 1
+                stats[cache.name] = metrics
+        return stats
+
+    def _lookup(self, k):
+        # Lock must be held
+        v = self._data[k]
+        if self.ttl is not None and self._expires[k] < time.time():
+            self._remove(k)
+            self._metrics["expirations"] += 1
+            raise KeyError(k)
+        if self.lru:
+            del self._data[k]
+            self._data[k] = v
+        return v
+
+    def _store(self, k, v):
+        # Lock must be held
+        if k in self._data:
+            self._remove(k)
+        self._data[k] = v
+        if self.ttl is not None:
+            self._expires[k] = time.time() + self.ttl
+            self._expire()
+        if self.sizeof:
+            self._sizes[k] = size = self.sizeof(k, v)
+            self._memory += size
+        while len(self._data) > self.maxsize or (self.maxmemory and self._memory > self.maxmemory and len(self._data) > 1):
+            ek = iter(self._data).next()
+            self._evicted(ek, self._remove(ek))
+            self._metrics["evictions"] += 1
+
+    def _remove(self, k):
+        # Lock must be held
+        v = self._data.pop(k)
+        if self.ttl is not None:
+            del self._expires[k]
+        if self.sizeof:
+            self._memory -= self._sizes.pop(k)
+        return v
+
+    def _expire(self):
+        # Lock must be held
+        now = time.time()
+        expires = self._expires
+        while expires:
+            k = iter(expires).next()
+            if expires[k] >= now:
+                break
+            self._remove(k)
+            self._metrics["expirations"] += 1
+
+    def _evicted(self, k, v):
+        '''
+        Called with every entry evicted due size bounds.
+        '''
+        pass
+
+    def __getitem__(self, k):
+        with self._lock:
+            try:
+                v = self._lookup(k)
+            except KeyError:
+                self._metrics["misses"] += 1
+                raise
+            self._metrics["hits"] += 1
+            return v
+
+    def __setitem__(self, k, v):
+        with self._lock:
+            self._store(k, v)
+
+    def __delitem__(self, k):
+        with self._lock:
+            self._remove(k)
+
+    def __contains__(self, k):
+        with self._lock:
+            if not k in self._data:
+                return False
+            if self.ttl is not None and self._expires[k] < time.time():
+                self._remove(k)
+                self._metrics["expirations"] += 1
+                return False
+            return True
+
+    def __iter__(self):
+        with self._lock:
+            return iter(self._data.keys())
+
+    def __len__(self):
+        return len(self._data)
+
+    def __repr__(self):
+        return "<%s %r %d entries>" % (self.__class__.__name__, self.name, len(self._data))
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._expires.clear()
+            self._sizes.clear()
+            self._memory = 0
+
+    def discard(self, k):
+        '''
+        Remove given key if present, without counting a lookup.
+        '''
+        with self._lock:
+            if k in self._data:
+                self._remove(k)
+
+    def get_or_set(self, k, factory, *args, **kwargs):
+        '''
+        Get value for given key, calling factory with given arguments
+        and storing its result on miss.
+        '''
+        try:
+            return self[k]
+        except KeyError:
+            pass
+        v = factory(*args, **kwargs)
+        self[k] = v
+        return v
+
+
+class CappedDict(Cache):
+    '''
+    Cache with maximum size evicting least recently written entries
 
     >>> c = CappedDict(5, a=1)
     >>> c
@@ -155,66 +375,267 @@ class CappedDict(collections.OrderedDict):
     >>> c
     CappedDict([(6, 6), (7, 7), (8, 8), (9, 9), (10, 1)])
     '''
-    update_methods = ("fromkeys", "update")
-    maxsize = sys.maxint
     def __init__(self, *args, **kwargs):
-        if isinstance(args[0], (int, long)):
-            self.maxsize = args[0]
+        maxsize = None
+        if args and isinstance(args[0], (int, long)):
+            maxsize = args[0]
             args = args[1:]
-        collections.OrderedDict.__init__(self, *args, **kwargs)
-        self._check_size()
-        for mn in self.update_methods:
-            setattr(self, mn,
-                functools.partial(
-                    self._wrapper,
-                    getattr(collections.OrderedDict, mn)
-                    ))
-
-    def _check_size(self):
-        if len(self) > self.maxsize:
-            for k in tuple(self)[:-self.maxsize]:
-                del self[k]
-
-    def _wrapper(self, parent_method, *args, **kwargs):
-        r = parent_method(self, *args, **kwargs)
-        self._check_size()
-        return r
+        Cache.__init__(self, maxsize=maxsize, lru=False)
+        self.update(*args, **kwargs)
 
-    def __setitem__(self, k, v):
-        'od.__setitem__(i, y) <==> od[i]=y'
-        if k in self:
-            del self[k]
-        elif len(self) == self.maxsize:
-            del self[iter(self).next()]
-        collections.OrderedDict.__setitem__(self, k, v)
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, self.items())
 
 
-class WeakCappedDict(weakref.WeakValueDictionary):
+class WeakCappedDict(Cache):
     '''
-    Weakref WeakValueDictionary which keep a given number of hard references
+    Cache keeping hard references to a given number of most recently used
+    values, and weak references to the evicted ones.
+
+    >>> class Value(object): pass
+    >>> c = WeakCappedDict(1)
+    >>> a, b = Value(), Value()
+    >>> c["a"] = a
+    >>> c["b"] = b
+    >>> c["a"] is a
+    True
+    >>> del a, b
+    >>> "b" in c, "a" in c
+    (False, True)
     '''
-    def __init__(self, size, d = ()):
-        self._size = size
-        self._strong_refs = queue.Queue(size)
-        weakref.WeakValueDictionary.__init__(self, d)
+    def __init__(self, size, d=(), name=None):
+        self._weak = weakref.WeakValueDictionary()
+        Cache.__init__(self, name, size)
+        self.update(d)
 
-    def _strongref(self, o):
-        if self._strong_refs.full():
-            self._strong_refs.get(False)
-        self._strong_refs.put(o)
+    def _lookup(self, k):
+        try:
+            return Cache._lookup(self, k)
+        except KeyError:
+            v = self._weak.pop(k)
+        self._store(k, v)
+        return v
 
-    def __setitem__(self, k, v):
-        self._strongref(v)
-        weakref.WeakValueDictionary.__setitem__(self, k, v)
+    def _remove(self, k):
+        self._weak.pop(k, None)
+        return Cache._remove(self, k)
 
-    def __getitem__(self, k):
-        v = weakref.WeakValueDictionary.__getitem__(self, k)
-        self._strongref(v)
-        return v
+    def _evicted(self, k, v):
+        self._weak[k] = v
+
+    def __delitem__(self, k):
+        with self._lock:
+            if k in self._data:
+                self._remove(k)
+            else:
+                del self._weak[k]
+
+    def __contains__(self, k):
+        with self._lock:
+            return k in self._data or k in self._weak
+
+    def clear(self):
+        Cache.clear(self)
+        self._weak.clear()
+
+
+class DirectoryCache(Cache):
+    '''
+    Cache of directory listings as {name: is directory} dicts, collected
+    in one pass.
 
-    def update(self, o):
-        for k, v in dict(o).iteritems():
-            self[k] = v
+    On Linux, listings are invalidated through inotify. Elsewhere, or if
+    a directory cannot be watched, its mtime is checked at most every
+    `check_interval` seconds.
+
+    Inotify thread must be stopped calling close (or close_all).
+    '''
+    _all_caches = []
+    def __init__(self, name=None, maxsize=1024, check_interval=1.):
+        Cache.__init__(self, name, maxsize)
+        self._all_caches.append(self)
+        self.check_interval = check_interval
+        self._inotify = None
+        self._inotify_thread = None
+        self._wakeup = None # pipe (read fd, write fd) for stopping thread
+        self._watches = {} # {wd: path}
+        self._watched = {} # {path: wd}
+        self._watch_lock = threading.RLock() # held on eviction, see entries
+        self._generation = 0 # increased on every inotify invalidation
+
+    def _watch(self, path):
+        '''
+        Watch given directory for changes, return True if watched
+        '''
+        if not my_env.is_linux:
+            return False
+        with self._watch_lock:
+            if path in self._watched:
+                return True
+            if self._inotify is None:
+                try:
+                    self._inotify = my_env.linux.Inotify()
+                    self._wakeup = os.pipe()
+                except (OSError, AttributeError) as e:
+                    logging.warning("inotify not available: %s" % e)
+                    if self._inotify:
+                        self._inotify.close()
+                    self._inotify = False
+                else:
+                    t = threading.Thread(
+                        target=self._run_inotify,
+                        args=(self._inotify, self._wakeup[0]),
+                        name="DirectoryCache")
+                    t.daemon = True
+                    t.start()
+                    self._inotify_thread = t
+            if not self._inotify:
+                return False
+            inotify = self._inotify
+            try:
+                wd = inotify.add_watch(path,
+                    inotify.IN_CREATE | inotify.IN_DELETE | inotify.IN_MOVED_FROM |
+                    inotify.IN_MOVED_TO | inotify.IN_DELETE_SELF | inotify.IN_MOVE_SELF |
+                    inotify.IN_ONLYDIR)
+            except OSError:
+                return False
+            self._watches[wd] = path
+            self._watched[path] = wd
+            return True
+
+    def _run_inotify(self, inotify, wakeup):
+        try:
+            while True:
+                try:
+                    readable, w, x = select.select((inotify, wakeup), (), ())
+                    if wakeup in readable:
+                        break
+                    events = inotify.read_events()
+                except (OSError, select.error) as e:
+                    if e.args and e.args[0] == errno.EINTR:
+                        continue
+                    logging.exception(e)
+                    break
+                for wd, mask, cookie, name in events:
+                    with self._watch_lock:
+                        self._generation += 1
+                        if mask & inotify.IN_Q_OVERFLOW:
+                            self.clear()
+                            continue
+                        path = self._watches.pop(wd, None)
+                        if path is None:
+                            continue
+                        # Listing is outdated, it will be watched again
+                        # once requested
+                        del self._watched[path]
+                        if not mask & inotify.IN_IGNORED:
+                            inotify.rm_watch(wd)
+                        self.discard(path)
+        finally:
+            with self._watch_lock:
+                self._inotify = False
+                self._watches.clear()
+                self._watched.clear()
+                inotify.close()
+                for fd in self._wakeup:
+                    os.close(fd)
+                self._wakeup = None
+
+    def close(self):
+        '''
+        Stop inotify thread, removing all watches, and clear cache.
+        Directories are checked by mtime afterwards.
+        '''
+        with self._watch_lock:
+            thread = self._inotify_thread
+            if self._inotify:
+                os.write(self._wakeup[1], "\0")
+            self._inotify = False
+            self._inotify_thread = None
+            self._watches.clear()
+            self._watched.clear()
+            self.clear()
+        if thread and thread != threading.current_thread():
+            thread.join()
+
+    @classmethod
+    def close_all(cls):
+        for cache in cls._all_caches:
+            cache.close()
+
+    def _evicted(self, k, v):
+        with self._watch_lock:
+            wd = self._watched.pop(k, None)
+            if not wd is None:
+                del self._watches[wd]
+                self._inotify.rm_watch(wd)
+
+    def entries(self, path):
+        '''
+        Get directory entries.
+
+        Params:
+            path: directory path.
+
+        Returns:
+            Dict {name: True if is a directory}, or None if path is not
+            a directory.
+        '''
+        path = os.path.normpath(path)
+        now = time.time()
+        cached = self.get(path)
+        if cached:
+            checked, mtime, entries = cached
+            if path in self._watched or now - checked < self.check_interval:
+                return entries
+            try:
+                current = os.stat(path).st_mtime
+            except OSError:
+                current = None
+            if current == mtime:
+                with self._watch_lock: # lock order, see _evicted
+                    self[path] = (now, mtime, entries)
+                return entries
+        self._watch(path) # before listing, so no change is missed
+        generation = self._generation
+        try:
+            mtime = os.stat(path).st_mtime
+            entries = {
+                name: os.path.isdir(os.path.join(path, name))
+                for name in my_env.get_listdir(path)
+                }
+        except OSError:
+            mtime = entries = None
+        with self._watch_lock:
+            # Listing could be outdated if invalidated meanwhile
+            if generation == self._generation:
+                self[path] = (now, mtime, entries)
+        return entries
+
+    def listdir(self, path):
+        '''
+        Like os.listdir, from cache.
+        '''
+        entries = self.entries(path)
+        if entries is None:
+            raise OSError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+        return entries.keys()
+
+    def isdir(self, path):
+        '''
+        Like os.path.isdir, from parent directory listing.
+        '''
+        parent, name = os.path.split(os.path.normpath(path))
+        entries = self.entries(parent)
+        return bool(entries and entries.get(name))
+
+    def exists(self, path):
+        '''
+        Like os.path.exists, from parent directory listing.
+        '''
+        parent, name = os.path.split(os.path.normpath(path))
+        entries = self.entries(parent)
+        return not entries is None and name in entries
 
 
 class OrderedSet(collections.MutableSet):
@@ -229,9 +650,7 @@ class OrderedSet(collections.MutableSet):
     OrderedSet{'r', 'c', 'd'}
     '''
     def __init__(self, iterable=None):
-        self.end = end = []
-        end += [None, end, end]         # sentinel node for doubly linked list
-        self.map = {}                   # key --> [key, prev, next]
+        self.map = collections.OrderedDict()
         if iterable is not None:
             self |= iterable
 
@@ -242,37 +661,21 @@ class OrderedSet(collections.MutableSet):
         return key in self.map
 
     def add(self, key):
-        if key not in self.map:
-            end = self.end
-            curr = end[1]
-            curr[2] = end[1] = self.map[key] = [key, curr, end]
+        self.map[key] = None
 
     def discard(self, key):
-        if key in self.map:
-            key, prev, next = self.map.pop(key)
-            prev[2] = next
-            next[1] = prev
+        self.map.pop(key, None)
 
     def __iter__(self):
-        end = self.end
-        curr = end[2]
-        while curr is not end:
-            yield curr[0]
-            curr = curr[2]
+        return iter(self.map)
 
     def __reversed__(self):
-        end = self.end
-        curr = end[1]
-        while curr is not end:
-            yield curr[0]
-            curr = curr[1]
+        return reversed(self.map)
 
     def pop(self, last=True):
         if not self:
             raise KeyError('set is empty')
-        key = self.end[1][0] if last else self.end[2][0]
-        self.discard(key)
-        return key
+        return self.map.popitem(last)[0]
 
     def __repr__(self):
         if not self:
@@ -289,37 +692,351 @@ class OrderedSet(collections.MutableSet):
             self.add(i)
 
 class CappedSet(OrderedSet):
-    update_methods = ("update",)
+    '''
+    OrderedSet with maximum size, discarding oldest items first
+
+    >>> CappedSet(3, 'abcde')
+    CappedSet{'c', 'd', 'e'}
+    '''
     def __init__(self, maxsize, iterable=None):
-        OrderedSet.__init__(self, iterable)
         self.maxsize = maxsize
-        self._check_size()
-        for mn in self.update_methods:
-            setattr(self, mn,
-                functools.partial(
-                    self._wrapper,
-                    getattr(collections.OrderedDict, mn)
-                    ))
-
-    def _check_size(self):
-        if len(self) > self.maxsize:
-            for k in tuple(self)[:-self.maxsize]:
-                del self[k]
-
-    def _wrapper(self, parent_method, *args, **kwargs):
-        r = parent_method(self, *args, **kwargs)
-        self._check_size()
-        return r
+        OrderedSet.__init__(self, iterable)
 
     def add(self, v):
-        if not v in self:
-            if len(self) == self.maxsize:
-                self.pop(False)
-            OrderedSet.add(self, v)
+        if not v in self.map:
+            if len(self.map) >= self.maxsize:
+                self.map.popitem(False)
+            self.map[v] = None
+
+
+class PooledResponse(object):
+    '''
+    File-like wrapper of httplib.HTTPResponse compatible with urllib2
+    responses, giving its connection back to HTTPConnectionPool once
+    body is exhausted or response is closed.
+    '''
+    def __init__(self, pool, key, connection, response, url):
+        self._pool = pool
+        self._key = key
+        self._connection = connection
+        self._response = response
+        self._url = url
+        self.headers = response.msg
+
+    @property
+    def closed(self):
+        return self._connection is None
+
+    def geturl(self):
+        return self._url
+
+    def getcode(self):
+        return self._response.status
+
+    @property
+    def length(self):
+        '''
+        Body bytes not read yet, or None if unknown (ie. chunked).
+        '''
+        return self._response.length
+
+    def read(self, n=None):
+        if self._connection is None:
+            return ""
+        data = self._response.read() if n is None else self._response.read(n)
+        if self._response.isclosed():
+            self.close()
+        return data
+
+    def readinto(self, b):
+        '''
+        Read up to len(b) bytes into given writable buffer, returns the
+        number of bytes read. Python 2 httplib has no readinto, so data
+        is still copied once from the string read.
+        '''
+        data = self.read(len(b))
+        n = len(data)
+        memoryview(b)[:n] = data
+        return n
+
+    def __iter__(self):
+        # httplib responses do not iterate lines
+        pending = ""
+        data = self.read(8192)
+        while data:
+            lines = (pending + data).split("\n")
+            pending = lines.pop()
+            for line in lines:
+                yield line + "\n"
+            data = self.read(8192)
+        if pending:
+            yield pending
+
+    def close(self):
+        if not self._connection is None:
+            if self._response.length == 0 and not self._response.isclosed():
+                self._response.read() # empty body (ie. HEAD), mark as done
+            reusable = self._response.isclosed() and not self._response.will_close
+            if not reusable:
+                self._response.close()
+            self._pool.release(self._key, self._connection, reusable)
+            self._connection = None
+
+
+class HTTPConnectionPool(object):
+    '''
+    Persistent HTTP and HTTPS connections shared by host.
+
+    At most `max_per_host` connections are in use for the same
+    (scheme, host, port) at once, further requests wait up to `timeout`
+    seconds for one of them to be released. Released keep-alive
+    connections are reused and closed after `idle_timeout` seconds
+    unused. Environment proxies are honored as urllib2 does.
+    '''
+    connection_classes = {
+        "http": httplib.HTTPConnection,
+        "https": httplib.HTTPSConnection,
+        }
+    redirect_codes = (301, 302, 303, 307)
+    max_redirects = 10
+
+    def __init__(self, max_per_host=4, idle_timeout=30, timeout=60):
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.proxies = urllib.getproxies()
+        self._idle = collections.defaultdict(list) # key: [(last use, connection), ...]
+        self._busy = collections.defaultdict(set) # key: set of connections
+        self._condition = threading.Condition()
+
+    def _evict_idle(self):
+        # Must be called with condition acquired
+        limit = time.time() - self.idle_timeout
+        for key, idle in self._idle.items():
+            while idle and idle[0][0] < limit:
+                idle.pop(0)[1].close()
+            if not idle:
+                del self._idle[key]
+
+    def _route(self, url):
+        '''
+        Get pool key and request path for given url
+        '''
+        parts = urlparse.urlsplit(url)
+        scheme = parts.scheme.lower()
+        if not scheme in self.connection_classes:
+            raise ValueError("Unsupported url scheme %r" % scheme)
+        host = parts.hostname
+        port = parts.port or (443 if scheme == "https" else 80)
+        path = urlparse.urlunsplit(("", "", parts.path or "/", parts.query, ""))
+        proxy = self.proxies.get(scheme)
+        if proxy and not urllib.proxy_bypass(host):
+            proxy = urlparse.urlsplit(proxy if "://" in proxy else "http://%s" % proxy)
+            proxy = (proxy.hostname, proxy.port or 80)
+            if scheme == "http":
+                # Plain proxy requests use absolute urls
+                return ("http", proxy[0], proxy[1], None), url
+            return (scheme, proxy[0], proxy[1], (host, port)), path
+        return (scheme, host, port, None), path
+
+    def acquire(self, key):
+        '''
+        Get connection for given pool key as (connection, reused) tuple,
+        waiting if host has too many connections in use.
+        '''
+        deadline = time.time() + self.timeout
+        with self._condition:
+            self._evict_idle()
+            while len(self._busy[key]) >= self.max_per_host:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise socket.timeout("Too many connections to %s:%d" % key[1:3])
+                self._condition.wait(remaining)
+            idle = self._idle.get(key)
+            if idle:
+                connection = idle.pop()[1]
+                reused = True
+            else:
+                scheme, host, port, tunnel = key
+                connection = self.connection_classes[scheme](host, port, timeout=self.timeout)
+                if tunnel:
+                    connection.set_tunnel(*tunnel)
+                reused = False
+            self._busy[key].add(connection)
+        return connection, reused
+
+    def release(self, key, connection, reusable=True):
+        '''
+        Return connection to pool, closing it unless reusable.
+        '''
+        with self._condition:
+            busy = self._busy[key]
+            if connection in busy:
+                busy.remove(connection)
+                if reusable:
+                    self._idle[key].append((time.time(), connection))
+                else:
+                    connection.close()
+                if not busy:
+                    del self._busy[key]
+            else:
+                # Pool was cleared in the meantime
+                connection.close()
+            self._evict_idle()
+            self._condition.notify_all()
+
+    def request(self, method, url, body=None, headers={}):
+        '''
+        Send request following redirections and return PooledResponse.
+        '''
+        for redirection in xrange(self.max_redirects + 1):
+            key, path = self._route(url)
+            while True:
+                connection, reused = self.acquire(key)
+                try:
+                    connection.request(method, path, body, headers)
+                    response = connection.getresponse()
+                except (httplib.HTTPException, socket.error):
+                    self.release(key, connection, False)
+                    if reused:
+                        # Server closed kept-alive connection, try again
+                        continue
+                    raise
+                break
+            location = response.getheader("Location")
+            if response.status in self.redirect_codes and location:
+                response.read()
+                self.release(key, connection, not response.will_close)
+                url = urlparse.urljoin(url, location)
+                if response.status == 303 or (response.status != 307 and method == "POST"):
+                    method = "GET"
+                    body = None
+                continue
+            return PooledResponse(self, key, connection, response, url)
+        raise httplib.HTTPException("Too many redirections for %s" % url)
+
+    def close_all(self):
+        '''
+        Close idle and in-use connections.
+        '''
+        with self._condition:
+            for idle in self._idle.itervalues():
+                for last_use, connection in idle:
+                    connection.close()
+            for busy in self._busy.itervalues():
+                for connection in busy:
+                    connection.close()
+            self._idle.clear()
+            self._busy.clear()
+            self._condition.notify_all()
+
+
+class MirrorStats(object):
+    '''
+    Per-host latency and failure records of mirror checks, persisted as
+    JSON in app config dir so mirror ranking survives restarts.
+
+    Hosts are ranked by smoothed latency, hosts never checked go after
+    known ones and hosts which failed recently go last.
+    '''
+    filename = "mirrors.json"
+    smoothing = 0.3 # weight of last latency on moving average
+    failure_penalty = 3600 # seconds a failed host is ranked last
+    max_age = 21600 # seconds a check result can be trusted
+
+    def __init__(self, path=None):
+        self._path = path
+        self._hosts = None
+        self._lock = threading.Lock()
+        self._dirty = False
+
+    @property
+    def path(self):
+        if self._path is None:
+            self._path = os.path.join(my_env.get_config_dir(), self.filename)
+        return self._path
+
+    @classmethod
+    def host(cls, url):
+        parts = urlparse.urlsplit(url)
+        return "%s://%s" % (parts.scheme.lower(), parts.netloc.lower())
+
+    @property
+    def hosts(self):
+        if self._hosts is None:
+            self._hosts = {}
+            try:
+                with open(self.path, "rb") as f:
+                    self._hosts.update(json.load(f))
+            except (IOError, OSError, ValueError):
+                pass
+        return self._hosts
+
+    def record(self, url, latency):
+        '''
+        Record check result for given url, latency as None means failure.
+        '''
+        host = self.host(url)
+        with self._lock:
+            entry = self.hosts.setdefault(host, {"latency": None, "failures": 0})
+            entry["checked"] = time.time()
+            if latency is None:
+                entry["failures"] += 1
+                entry["failed"] = entry["checked"]
+            else:
+                entry["failures"] = 0
+                last = entry["latency"]
+                entry["latency"] = latency if last is None else (
+                    last + self.smoothing * (latency - last))
+            self._dirty = True
+
+    def _rank_key(self, url):
+        entry = self.hosts.get(self.host(url))
+        if entry is None or entry["latency"] is None:
+            return (1, 0)
+        if entry["failures"] and entry.get("failed", 0) > time.time() - self.failure_penalty:
+            return (2, entry["failures"])
+        return (0, entry["latency"])
+
+    def ranked(self, urls):
+        '''
+        Get given urls sorted from historically fastest to slowest.
+        '''
+        with self._lock:
+            return sorted(urls, key=self._rank_key)
+
+    def trusted(self, urls):
+        '''
+        Get fastest url if its last check is recent and successful, so
+        probing can be skipped, or None.
+        '''
+        with self._lock:
+            best = min(urls, key=self._rank_key)
+            entry = self.hosts.get(self.host(best))
+        if (entry and entry["latency"] is not None and not entry["failures"] and
+          entry["checked"] > time.time() - self.max_age):
+            return best
+        return None
+
+    def save(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            data = json.dumps(self.hosts)
+            self._dirty = False
+        try:
+            dirname = os.path.dirname(self.path)
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            with open(self.path, "wb") as f:
+                f.write(data)
+        except (IOError, OSError) as e:
+            logging.debug(e)
 
 
 class CheckURL(object):
     _all_instances = weakref.WeakSet()
+    mirror_stats = MirrorStats()
     @property
     def redirected(self):
         return self.response and self.response.geturl() != self.request.get_full_url()
@@ -365,6 +1082,7 @@ class CheckURL(object):
     def close_all_connections(cls):
         for wref in cls._all_instances:
             wref.close()
+        _connection_pool.close_all()
 
     @classmethod
     def faster_url(cls, *url_lists, **kwargs):
@@ -372,6 +1090,11 @@ class CheckURL(object):
         Get faster url for each url list in params in 0.5 seconds.
         If no url responds in max_time, last url is returned.
 
+        All urls are checked at once (historically fastest first) and
+        result is returned as soon as a url of every list responds,
+        cancelling pending checks. Lists whose best ranked url is known to
+        be fast from recent checks are not checked at all.
+
         If more than one list is given as argument, result will ge returned
         as list.
 
@@ -381,30 +1104,56 @@ class CheckURL(object):
         '''
         retries = kwargs.pop("retries", 10)
         wait_time = kwargs.pop("wait_time", 0.05)
-        checkers = [[cls(url) for url in url_list] for url_list in url_lists]
+        deadline = time.time() + retries * wait_time
+        stats = cls.mirror_stats
         results = [url_list[-1] for url_list in url_lists]
-        numlists = len(url_lists)
-        done = 0
-        for i in xrange(retries):
-            for n, checker_list in enumerate(checkers):
-                for checker in checker_list:
-                    if checker.ready and (not checker.failed) and (not checker.redirected):
-                        results[n] = checker.url
-                        checkers[n] = ()
-                        done += 1
-                        break
-            if done == numlists: break
-            time.sleep(wait_time)
-        if numlists == 1:
+        finished = queue.Queue()
+        pending = {} # checker: url_list index
+        for n, url_list in enumerate(url_lists):
+            trusted = stats.trusted(url_list)
+            if trusted:
+                results[n] = trusted
+                continue
+            for url in stats.ranked(url_list):
+                pending[cls(url, notify=finished)] = n
+        waiting = set(pending.itervalues())
+        try:
+            while waiting:
+                checker = finished.get(timeout=max(0, deadline - time.time()))
+                n = pending.pop(checker, None)
+                if n is None:
+                    continue # cancelled meanwhile
+                if checker.failed or checker.redirected:
+                    stats.record(checker.url, None)
+                    continue
+                stats.record(checker.url, checker.elapsed)
+                results[n] = checker.url
+                waiting.discard(n)
+                for other, m in pending.items():
+                    if m == n:
+                        other.cancel()
+                        del pending[other]
+        except queue.Empty:
+            pass
+        for checker in pending:
+            checker.cancel()
+        stats.save()
+        if len(url_lists) == 1:
             return results[0]
         return results
 
     def get_error_message(self):
         return self._error_message
 
-    def __init__(self, url, args=None, useragent=None, autoclose=True, method="HEAD"):
+    def __init__(self, url, args=None, useragent=None, autoclose=True, method="HEAD", notify=None):
+        '''
+        Params:
+            notify: optional Queue.Queue where this object will be put
+                    every time its request finishes.
+        '''
         self.__class__._all_instances.add(self)
         self._url = url
+        self._notify = notify
 
         if not url:
             traceback.print_stack()
@@ -422,10 +1171,14 @@ class CheckURL(object):
                 data = urllib.urlencode(args)
 
         self._data = data
+        self._method = method if data is None else "POST"
         self.request = urllib2.Request(url, data, headers)
+        if data:
+            self.request.add_unredirected_header("Content-Type", "application/x-www-form-urlencoded")
         self.response = None
         self.autoclose = autoclose
-        self.cthread = None
+        self._done = threading.Event()
+        self._done.set()
         self.retry()
 
     def close(self):
@@ -434,33 +1187,56 @@ class CheckURL(object):
                 self.response.close()
             self._closed = True
 
+    def cancel(self):
+        '''
+        Discard response, even if request is still running.
+        '''
+        self._cancelled = True
+        self.close()
+
+    _cancelled = False
+    elapsed = None
     def retry(self):
-        if self.cthread is None or not self.cthread.is_alive():
+        if self._done.is_set():
             self._rurl = None
             self._error_message = None
             self._respcode = -1
-            self.cthread = threading.Thread(target=self._connect)
-            self.cthread.start()
+            self._cancelled = False
+            self._started = time.time()
+            self._done.clear()
+            _iopool.async(self._connect)
 
     def wait(self, timeout=None):
-        if self.cthread and self.cthread.is_alive():
-            self.cthread.join(timeout)
+        self._done.wait(timeout)
 
     def _connect(self):
         try:
-            self.response = urllib2.urlopen(self.request, self._data)
-        except urllib2.HTTPError as e:
-            self._respcode = e.code
-            self._error_message = "Server returned code %d." % e.code
-        except urllib2.URLError as e:
-            logging.exception(e)
+            if self._cancelled:
+                raise socket.error("Request cancelled.")
+            self.response = _connection_pool.request(
+                self._method, self.request.get_full_url(), self._data,
+                dict(self.request.header_items()))
+        except (httplib.HTTPException, socket.error, ValueError) as e:
+            if not self._cancelled:
+                logging.exception(e)
             self._error_message = "Cannot connect to remote host."
             self.response = None
             self._respcode = 0
         else:
-            self._respcode = self.response.getcode()
-            if self.autoclose:
+            code = self.response.getcode()
+            if not 200 <= code < 300:
+                # As urllib2, error responses are not exposed
                 self.response.close()
+                self.response = None
+                self._error_message = "Server returned code %d." % code
+            elif self.autoclose or self._cancelled:
+                self.response.close()
+            self._respcode = code
+        finally:
+            self.elapsed = time.time() - self._started
+            self._done.set()
+            if self._notify:
+                self._notify.put(self)
 
     def __del__(self):
         self.close()
@@ -520,8 +1296,14 @@ class GetURL(CheckURL):
         self._eof = False
         self._offset = 0
         self._download_failed = False
+        self._aborted = False
         CheckURL.retry(self)
 
+    _aborted = False
+    def close(self):
+        self._aborted = True
+        CheckURL.close(self)
+
     def _discard_response(self):
         try:
             self.wait()
@@ -532,7 +1314,7 @@ class GetURL(CheckURL):
 
     def discard(self):
         if not self.closed:
-            threading.Thread(target=self._discard_response).start()
+            _iopool.async(self._discard_response)
 
     def _getnbytes(self, numbytes):
         self.wait()
@@ -591,13 +1373,14 @@ class GetURL(CheckURL):
                 return
 
             # Download and, if checksum is available, md5 feed
+            buffers = self._iter_buffers(buffsize=self._path_buffsize(path))
             if checksum:
                 md5sum = hashlib.md5()
-                for chunk in self:
+                for chunk in buffers:
                     md5sum.update(chunk)
                     fileobj.write(chunk)
             else:
-                for chunk in self:
+                for chunk in buffers:
                     fileobj.write(chunk)
             # File sync and close
             fileobj.flush()
@@ -637,6 +1420,142 @@ class GetURL(CheckURL):
             except BaseException as e:
                 logging.debug(e)
 
+    journal_suffix = ".journal"
+    segment_min_size = 1 << 20 # 1 MiB
+    segment_retries = 3
+    journal_interval = 1 # seconds between journal writes
+
+    @classmethod
+    def resumable(cls, path):
+        '''
+        True if an interrupted save_segmented to path can be resumed
+        '''
+        return os.path.isfile(path) and os.path.isfile(path + cls.journal_suffix)
+
+    def _load_journal(self, path, identity):
+        try:
+            with open(path + self.journal_suffix, "rb") as f:
+                journal = json.load(f)
+            if journal["identity"] == identity and os.stat(path).st_size == identity[1]:
+                return journal["segments"]
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            pass
+        return None
+
+    def _save_journal(self, path, identity, segments):
+        with open(path + self.journal_suffix, "wb") as f:
+            json.dump({"identity": identity, "segments": segments}, f)
+        self._journal_due = time.time() + self.journal_interval
+
+    def _fetch_segment(self, path, identity, segments, segment, lock):
+        '''
+        Download segment given as [start, end, done] list into path,
+        updating done count and, periodically, the journal.
+        '''
+        headers = dict(self.request.header_items())
+        buffsize = self._path_buffsize(path)
+        for attempt in xrange(self.segment_retries):
+            start, end, done = segment
+            if self._aborted or start + done >= end:
+                break
+            headers["Range"] = "bytes=%d-%d" % (start + done, end - 1)
+            try:
+                response = _connection_pool.request("GET", identity[0], None, headers)
+                try:
+                    if response.getcode() != 206:
+                        raise RuntimeError, "Range request failed, code %d" % response.getcode()
+                    # Unbuffered, journal must not count unwritten bytes
+                    with open(path, "r+b", 0) as f:
+                        f.seek(start + done)
+                        for data in self._iter_buffers(response.readinto, buffsize):
+                            if self._aborted:
+                                break
+                            f.write(data)
+                            with lock:
+                                segment[2] += len(data)
+                                self._offset += len(data)
+                                if time.time() > self._journal_due:
+                                    self._save_journal(path, identity, segments)
+                finally:
+                    response.close()
+            except (httplib.HTTPException, socket.error) as e:
+                if attempt == self.segment_retries - 1:
+                    raise
+                logging.debug(e)
+        if not self._aborted and segment[0] + segment[2] < segment[1]:
+            raise RuntimeError, "Download failed, end of segment not reached."
+
+    def save_segmented(self, path, segments=4):
+        '''
+        Save request body to path downloading `segments` byte ranges in
+        parallel over pooled connections.
+
+        Progress is kept in a journal file next to path, which is not
+        removed on error, so calling this method again with the same path
+        resumes the download. Falls back to save if server does not
+        accept ranges or body is too small to be worth splitting.
+
+        Create with method="HEAD" so body is only requested (by GET) when
+        falling back to save, otherwise a pooled HEAD request is enough.
+        '''
+        self.wait()
+        size = self.size
+        if (self.failed or self._partial or size < self.segment_min_size or
+          self.headers.get("Accept-Ranges", "").lower() != "bytes"):
+            if self._method == "HEAD":
+                self._method = "GET"
+                self.retry()
+                self.wait()
+            self.save(path)
+            return
+        checksum = self.headers.get("Content-MD5", None)
+        identity = [self.response_url, size, self.headers.get("ETag"), self.headers.get("Last-Modified")]
+        # Body will be downloaded by segments
+        self.response.close()
+        try:
+            ranges = self._load_journal(path, identity)
+            if ranges is None:
+                step = max(self.segment_min_size, -(-size // segments))
+                ranges = [[start, min(start + step, size), 0] for start in xrange(0, size, step)]
+                with open(path, "wb") as f:
+                    # Reserve disk space
+                    f.seek(size - 1)
+                    f.write("\0")
+            self._offset = sum(i[2] for i in ranges)
+            lock = threading.Lock()
+            self._save_journal(path, identity, ranges)
+            results = _iopool.parallelize_iter(
+                (self._fetch_segment, (path, identity, ranges, segment, lock))
+                for segment in ranges
+                if segment[0] + segment[2] < segment[1]
+                )
+            with lock:
+                self._save_journal(path, identity, ranges)
+            for result in results:
+                if isinstance(result, BaseException):
+                    raise result
+            if self._aborted:
+                raise RuntimeError, "Download aborted."
+            # File checksum
+            if checksum:
+                md5sum = hashlib.md5()
+                with open(path, "rb") as f:
+                    for chunk in self._iter_buffers(f.readinto, self._path_buffsize(path)):
+                        md5sum.update(chunk)
+                if base64.b64encode(md5sum.digest()) != checksum:
+                    os.remove(path)
+                    os.remove(path + self.journal_suffix)
+                    raise ValueError, "Integrity check failed with server checksum."
+            os.remove(path + self.journal_suffix)
+            self._eof = True
+        except BaseException as e:
+            self._download_failed = True
+            if hasattr(e, "message") and e.message:
+                self._error_message = e.message
+            elif hasattr(e, "errno"):
+                self._error_message = errno_message(e.errno)
+            logging.debug(e)
+
     def seek(self, v, whence=os.SEEK_SET):
         '''
         You should check for error code 416 after seek.
@@ -663,6 +1582,21 @@ class GetURL(CheckURL):
         raise StopIteration
 
     def read_all(self):
+        self.wait()
+        # Response length is what remains of this response body, which
+        # already excludes any seek offset
+        size = self.response.length if self.response and not self.failed else None
+        if size > 0:
+            # Known size, fill a single buffer instead of joining chunks
+            data = bytearray(size)
+            view = memoryview(data)
+            offset = 0
+            while offset < size:
+                n = self.readinto(view[offset:])
+                if not n:
+                    break
+                offset += n
+            return view[:offset].tobytes()
         return "".join(self)
 
     def read(self, n=None):
@@ -673,52 +1607,215 @@ class GetURL(CheckURL):
             return r
         return ""
 
+    def readinto(self, b):
+        '''
+        Read up to len(b) bytes into given writable buffer, returns the
+        number of bytes read, 0 on EOF.
+        '''
+        self.wait()
+        if self.failed or self.response is None:
+            return 0
+        n = self.response.readinto(b)
+        if n:
+            self._offset += n
+        elif len(b):
+            self._eof = True
+            self.close()
+        return n
+
+    buffsize_max = 1 << 20 # 1 MiB
+    read_target = 0.1 # seconds a single read should last
+    def _iter_buffers(self, readinto=None, buffsize=None):
+        '''
+        Yield memoryviews of body data over one reusable buffer, valid
+        only until next iteration, so memory usage is bounded by
+        buffsize_max regardless of body size.
+
+        Read size starts at given buffsize (defaults to `buffsize`) and
+        doubles while reads fill the buffer faster than read_target, or
+        halves when they get slower.
+        '''
+        readinto = readinto or self.readinto
+        minsize = buffsize or self.buffsize
+        maxsize = max(minsize, self.buffsize_max)
+        size = minsize
+        view = memoryview(bytearray(maxsize))
+        while True:
+            start = time.time()
+            n = readinto(view[:size])
+            if not n:
+                break
+            elapsed = time.time() - start
+            yield view[:n]
+            if n == size and elapsed < self.read_target / 2:
+                size = min(size * 2, maxsize)
+            elif elapsed > self.read_target:
+                size = max(size // 2, minsize)
+
+    def _path_buffsize(self, path):
+        '''
+        Initial read size for writing to path: a multiple of its
+        filesystem block size.
+        '''
+        try:
+            blocksize = my_env.get_blocksize(os.path.dirname(os.path.abspath(path)))
+        except BaseException as e:
+            logging.debug(e)
+            return self.buffsize
+        return max(blocksize, self.buffsize // blocksize * blocksize)
+
 
 class GeneratorFile(object):
+    '''
+    Read-only file-like object over an iterable of strings.
+
+    Pending data is kept in a deque of source chunks which are discarded
+    once read, so buffered memory never exceeds the size requested by
+    current read (or current line length) plus one source chunk,
+    whatever the length of the stream.
+
+    >>> f = GeneratorFile(["ab", "c\\nde", "f\\n", "g"])
+    >>> f.read(1)
+    'a'
+    >>> b = bytearray(3)
+    >>> f.readinto(b), b
+    (3, bytearray(b'bc\\n'))
+    >>> f.tell()
+    4
+    >>> list(f)
+    ['def\\n', 'g']
+    >>> f.read()
+    ''
+    '''
     def __init__(self, generator):
         self._iterator = iter(generator)
-        self._memory = ""
+        self._chunks = collections.deque()
+        self._head = 0 # bytes already read from first chunk
+        self._buffered = 0 # unread bytes in _chunks
         self._position = 0
         self._exhausted = False
 
-    def read(self, k=sys.maxint):
-        nextpos = self._position + k
-
-        if not self._exhausted:
+    def _fill(self, size):
+        '''
+        Buffer source chunks until `size` bytes are available or source
+        is exhausted.
+        '''
+        while self._buffered < size and not self._exhausted:
             try:
-                while len(self._memory) < nextpos:
-                    self._memory += self._iterator.next()
+                chunk = self._iterator.next()
             except StopIteration:
                 self._exhausted = True
+            else:
+                if chunk:
+                    self._chunks.append(chunk)
+                    self._buffered += len(chunk)
+
+    def _take(self, size):
+        '''
+        Remove and return up to `size` buffered bytes.
+        '''
+        chunks = self._chunks
+        parts = []
+        remaining = min(size, self._buffered)
+        while remaining:
+            chunk = chunks[0]
+            end = self._head + remaining
+            if end < len(chunk):
+                parts.append(chunk[self._head:end])
+                self._head = end
+                break
+            parts.append(chunk[self._head:] if self._head else chunk)
+            remaining = end - len(chunk)
+            chunks.popleft()
+            self._head = 0
+        data = parts[0] if len(parts) == 1 else "".join(parts)
+        self._buffered -= len(data)
+        self._position += len(data)
+        return data
+
+    def read(self, k=-1):
+        if k is None or k < 0:
+            # Whole stream, unbounded by definition
+            self._fill(sys.maxint)
+            return self._take(self._buffered)
+        self._fill(k)
+        return self._take(k)
 
-        old_pos = self._position
-        self._position = min(self._position, nextpos)
-        return self._memory[old_pos:k]
+    def readinto(self, b):
+        '''
+        Read up to len(b) bytes into given writable buffer copying from
+        source chunks directly, returns the number of bytes read.
+        '''
+        view = memoryview(b)
+        size = len(view)
+        self._fill(size)
+        chunks = self._chunks
+        offset = 0
+        while offset < size and chunks:
+            chunk = chunks[0]
+            n = min(len(chunk) - self._head, size - offset)
+            view[offset:offset + n] = buffer(chunk, self._head, n)
+            self._head += n
+            if self._head == len(chunk):
+                chunks.popleft()
+                self._head = 0
+            offset += n
+        self._buffered -= offset
+        self._position += offset
+        return offset
+
+    def readline(self, limit=-1):
+        '''
+        Read until newline (included), EOF or `limit` bytes.
+        '''
+        chunks = self._chunks
+        index = 0
+        scanned = 0 # buffered bytes without newline
+        size = None
+        while size is None:
+            if index == len(chunks):
+                self._fill(self._buffered + 1)
+                if index == len(chunks):
+                    size = scanned # EOF
+                    break
+            chunk = chunks[index]
+            start = self._head if index == 0 else 0
+            newline = chunk.find("\n", start)
+            if newline > -1:
+                size = scanned + newline - start + 1
+            else:
+                scanned += len(chunk) - start
+                index += 1
+            if -1 < limit < (scanned if size is None else size):
+                size = limit
+        return self._take(size)
 
     def tell(self):
         return self._position
 
-    def seek(self, pos, since=-1):
-        pass
+    def seek(self, pos, whence=os.SEEK_SET):
+        '''
+        Only forward seeking is supported, skipped data is discarded.
+        '''
+        if whence == os.SEEK_CUR:
+            pos += self._position
+        elif whence != os.SEEK_SET:
+            raise IOError, "Unsupported seek whence %r" % whence
+        if pos < self._position:
+            raise IOError, "Cannot seek backwards on a generator stream."
+        while self._position < pos:
+            size = min(pos - self._position, 1 << 16)
+            if not self.read(size):
+                break
 
     def __iter__(self):
-        self._position = 0
-        lastline = self._memory
-
-        while "\n" in lastline:
-            r, lastline = lastline.split("\n", 1)
-            self._position += len(r) + 1
-            yield r + "\n"
+        return self
 
-        if not self._exhausted:
-            for i in self._iterator:
-                lastline += i
-                while "\n" in lastline:
-                    r, lastline = lastline.split("\n", 1)
-                    self._position += len(r) + 1
-                    yield r + "\n"
-            self._exhausted = True
-        yield lastline
+    def next(self):
+        line = self.readline()
+        if line:
+            return line
+        raise StopIteration
 
 
 class JSONEncoder_extra(json.JSONEncoder):
@@ -756,21 +1853,242 @@ class LoggerHandler(logging.Handler):
         #    print >> sys.stderr, record.msg
 
 
-class TaskPool(object):
-    _emptydict = {}
-    _value_unset = type("ValueUnsetType", (), {})
-    _polling = 0.001
-    _all_pools = []
-    def __init__(self):
+class CancelledError(Exception):
+    pass
+
+
+class TimeoutError(Exception):
+    pass
+
+
+class Future(object):
+    '''
+    Result of a task submitted to TaskPool.
+
+    Callbacks given to add_done_callback are called with the future as
+    argument, on the thread finishing or cancelling it (or immediately
+    if already done).
+    '''
+    def __init__(self, fn, args=(), kwargs=None):
+        self._task = (fn, args, kwargs or {})
+        self._state = "pending"
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+        self._condition = threading.Condition()
+        self.queued = time.time()
+
+    def cancel(self):
+        '''
+        Cancel task if not running yet, returns True if cancelled.
+        '''
+        with self._condition:
+            if self._state != "pending":
+                return self._state == "cancelled"
+            self._state = "cancelled"
+            self._task = None
+            self._condition.notify_all()
+        self._run_callbacks()
+        return True
+
+    def cancelled(self):
+        return self._state == "cancelled"
+
+    def running(self):
+        return self._state == "running"
+
+    def done(self):
+        return self._state in ("cancelled", "finished")
+
+    def _wait(self, timeout):
+        deadline = None if timeout is None else time.time() + timeout
+        with self._condition:
+            while not self._state in ("cancelled", "finished"):
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+            if self._state == "cancelled":
+                raise CancelledError
+            if self._state != "finished":
+                raise TimeoutError
+
+    def result(self, timeout=None):
+        '''
+        Wait for and return task result, raising task exception if any,
+        TimeoutError if not done in timeout seconds or CancelledError.
+        '''
+        self._wait(timeout)
+        if self._exception:
+            raise self._exception
+        return self._result
+
+    def exception(self, timeout=None):
+        '''
+        Wait for task and return exception raised by it, or None.
+        '''
+        self._wait(timeout)
+        return self._exception
+
+    def add_done_callback(self, fn):
+        with self._condition:
+            if not self.done():
+                self._callbacks.append(fn)
+                return
+        self._call(fn)
+
+    def _call(self, fn):
+        try:
+            fn(self)
+        except BaseException as e:
+            logging.exception(e)
+
+    def _run_callbacks(self):
+        callbacks = self._callbacks
+        self._callbacks = []
+        for fn in callbacks:
+            self._call(fn)
+
+    def _claim(self):
         '''
-        Threadpool implementation using threads
+        Mark as running if pending, returns True if caller must run it.
         '''
-        #
+        with self._condition:
+            if self._state == "pending":
+                self._state = "running"
+                return True
+        return False
+
+    def _finish(self, result=None, exception=None):
+        with self._condition:
+            self._result = result
+            self._exception = exception
+            self._state = "finished"
+            self._condition.notify_all()
+        self._task = None
+        self._run_callbacks()
+
+    def _run(self):
+        fn, args, kwargs = self._task
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as e:
+            self._finish(exception=e)
+        else:
+            self._finish(result)
+
+
+class TaskPool(object):
+    '''
+    Bounded threadpool running tasks from a priority queue.
+
+    Tasks with lower priority value run first, ties in submission order.
+    At most `max_workers` threads are started on demand, exiting after
+    `idle_timeout` seconds without work.
+
+    Pool activity is available as dict on `metrics`: submitted,
+    completed, failed and cancelled task counts, total seconds tasks
+    waited in queue (wait_time) and spent running (run_time), current
+    queue depth, threads and idle threads.
+    '''
+    _all_pools = []
+    def __init__(self, max_workers=16, idle_timeout=60):
         self._all_pools.append(self) # We collect all pools for convenience
 
-        self._event_pool = collections.deque()
-        self._pool = []
+        self.max_workers = max_workers
+        self.idle_timeout = idle_timeout
+        self._counter = itertools.count()
         self._lock = threading.Lock()
+        self._new_generation()
+        self._metrics = dict.fromkeys(("submitted", "completed", "failed", "cancelled"), 0)
+        self._metrics.update(wait_time=0., run_time=0.)
+
+    def _new_generation(self):
+        '''
+        Start with a new queue, workers and stop flag, so workers of
+        previous generations (see _stop) never take new tasks.
+        '''
+        self._queue = queue.PriorityQueue()
+        self._workers = set()
+        self._stopped = threading.Event()
+        self._idle = 0
+
+    @property
+    def metrics(self):
+        with self._lock:
+            metrics = dict(self._metrics)
+            metrics["threads"] = len(self._workers)
+            metrics["idle_threads"] = self._idle
+        metrics["queue_depth"] = self._queue.qsize()
+        return metrics
+
+    def submit(self, fn, args=(), kwargs=None, priority=0):
+        '''
+        Queue fn(*args, **kwargs) for running on a worker thread.
+
+        Returns:
+            Future object.
+        '''
+        future = Future(fn, args, kwargs)
+        with self._lock:
+            self._queue.put((priority, next(self._counter), future))
+            self._metrics["submitted"] += 1
+            if self._queue.qsize() > self._idle and len(self._workers) < self.max_workers:
+                t = threading.Thread(
+                    target=self._worker,
+                    args=(self._queue, self._workers, self._stopped),
+                    name="TaskPool-%d" % id(self))
+                t.daemon = True
+                self._workers.add(t)
+                t.start()
+        return future
+
+    def _execute(self, future):
+        '''
+        Run future on current thread unless cancelled or already taken.
+        '''
+        if not future._claim():
+            if future.cancelled():
+                with self._lock:
+                    self._metrics["cancelled"] += 1
+            return
+        start = time.time()
+        future._run()
+        end = time.time()
+        with self._lock:
+            self._metrics["completed"] += 1
+            self._metrics["wait_time"] += start - future.queued
+            self._metrics["run_time"] += end - start
+            if future._exception:
+                self._metrics["failed"] += 1
+
+    def _worker(self, tasks, workers, stopped):
+        t = threading.current_thread()
+        while not stopped.is_set():
+            with self._lock:
+                counted = tasks is self._queue # idle count is per generation
+                if counted:
+                    self._idle += 1
+            try:
+                item = tasks.get(timeout=self.idle_timeout)
+            except queue.Empty:
+                item = None
+            with self._lock:
+                if counted and tasks is self._queue:
+                    self._idle -= 1
+                # Exit on stop marker or on idle timeout, unless a task
+                # was queued meanwhile
+                if item is None and tasks.empty() or item and item[2] is None:
+                    break
+            if item:
+                self._execute(item[2])
+        with self._lock:
+            workers.discard(t)
+
+    @classmethod
+    def _unpack_task(cls, task):
+        task = (task,) if callable(task) else task
+        return task[0], task[1] if len(task) > 1 else (), task[2] if len(task) > 2 else None
 
     def parallelize(self, *tasks):
         '''
@@ -779,7 +2097,9 @@ class TaskPool(object):
 
         It's a good idea to put the (usually) longer task in first
         place, it will run in the main thread and will minimize idle
-        time.
+        time. Tasks not yet taken by workers when the calling thread gets
+        to them are run on the calling thread too, so nested calls never
+        wait for busy workers.
 
         Args:
             *tasks: tasks given as callable or tuple parameters as
@@ -793,144 +2113,506 @@ class TaskPool(object):
         if not tasks:
             return ()
 
-        # Recycle event object or create new one for result notification
-        event = self._event_pool.popleft() if self._event_pool else threading.Event()
-
-        # Result list initialization
-        results = [self._value_unset for task in tasks]
-
-        # Run tasks
-        for n in xrange(1, len(tasks)):
-            self._add_task(tasks[n], n, results, event)
-        self._run_task(tasks[0], 0, results, event)
-
-        # Wait for all values
-        while self._value_unset in results:
-            event.wait() # Wait for new result
-            event.clear()
-
-        self._event_pool.append(event) # Return event object
-
+        futures = [Future(*self._unpack_task(tasks[0]))]
+        with self._lock:
+            self._metrics["submitted"] += 1
+        futures.extend(self.submit(*self._unpack_task(task)) for task in tasks[1:])
+        results = []
+        for future in futures:
+            self._execute(future)
+            exception = future.exception()
+            results.append(future.result() if exception is None else exception)
         return results
 
     def parallelize_iter(self, iterable):
         return self.parallelize(*iterable)
 
-    @classmethod
-    def _async_inner(cls, callback, args, kwargs, success, error):
-        try:
-            r = callback(*args, **kwargs)
-            if callable(success):
-                success(r)
-        except BaseException as e:
-            if callable(error):
-                error(e)
-
-    def async(self, callback, args=(), kwargs={}, success=None, error=None):
-        task = (self._async_inner, (callback, args, kwargs, success, error))
-        self._add_task(task)
-
-    def _add_task(self, task, n=0, results=None, event=None):
-        for t in self._pool:
-            # Worker picking and run task
-            if t.worker_task is None:
-                with self._lock: # Double-check lock
-                    if t.worker_task is None: # Double-check
-                        t.worker_task = (task, n, results, event)
-                        t.worker_semaphore.release() # hup worker
-                        break
-        else:
-            # New worker initialization with task
-            t = threading.Thread(target=self._worker)
-            t.worker_semaphore = threading.Semaphore(0) # block on first acquire
-            t.worker_loop = True
-            t.worker_task = (task, n, results, event)
-            t.start()
-            self._pool.append(t)
-
-    @classmethod
-    def _worker(cls):
-        t = threading.current_thread()
-        while t.worker_loop:
-            cls._run_task(*t.worker_task)
-            t.worker_task = None
-            t.worker_semaphore.acquire() # Hang loop until new task
+    def async(self, callback, args=(), kwargs={}, success=None, error=None, priority=0):
+        '''
+        Run callback on a worker thread, calling success with its return
+        value or error with raised exception.
 
-    @classmethod
-    def _run_task(cls, task, n, results, event):
-        task = (task,) if callable(task) else task
-        args = task[1] if len(task) > 1 else ()
-        kwargs = task[2] if len(task) > 2 else cls._emptydict
-        if results:
-            try:
-                results[n] = task[0](*args, **kwargs)
-            except BaseException as e:
-                results[n] = e
-        else:
+        Returns:
+            Future object.
+        '''
+        future = self.submit(callback, args, kwargs, priority)
+        if callable(success) or callable(error):
+            def done(future):
+                exception = future.exception()
+                if exception is None:
+                    if callable(success):
+                        success(future.result())
+                elif callable(error):
+                    error(exception)
+            future.add_done_callback(done)
+        return future
+
+    def _stop(self):
+        '''
+        Cancel queued tasks and tell current workers to exit, returns
+        them. Tasks submitted afterwards run on new workers.
+        '''
+        with self._lock:
+            tasks = self._queue
+            workers = list(self._workers)
+            self._stopped.set()
+            self._new_generation()
+        while True:
             try:
-                task[0](*args, **kwargs)
-            except BaseException as e:
-                logging.exception(e)
-        if event:
-            event.set()
+                priority, n, future = tasks.get_nowait()
+            except queue.Empty:
+                break
+            if future and future.cancel():
+                with self._lock:
+                    self._metrics["cancelled"] += 1
+        for t in workers:
+            # Wake up markers, old queue is only read by stopped workers
+            tasks.put((0, next(self._counter), None))
+        return workers
 
     @classmethod
-    def clean_all(self):
-        for pool in self._all_pools:
-            for t in pool._pool:
-                t.worker_loop = False
-                t.worker_semaphore.release()
-        for pool in self._all_pools:
-            for t in pool._pool:
+    def _join(cls, workers):
+        current = threading.current_thread()
+        for t in workers:
+            if t != current:
                 t.join()
-            pool._pool[:] = ()
 
     def clean(self, join=True):
         '''
-        Clean all workers.
+        Cancel queued tasks and stop all workers.
         '''
-        for t in self._pool:
-            t.worker_loop = False
-            t.worker_semaphore.release()
-        for t in self._pool:
-            t.join()
-        self._pool[:] = ()
+        workers = self._stop()
+        if join:
+            self._join(workers)
 
+    @classmethod
+    def clean_all(cls):
+        workers = [pool._stop() for pool in cls._all_pools]
+        for pool_workers in workers:
+            cls._join(pool_workers)
 
-class FileEater(threading.Thread):
-    def __init__(self, f):
-        threading.Thread.__init__(self)
-        self._f = f
-        self._b = ""
-        self._v = collections.deque()
-        self._l = threading.Lock()
-        self._r = True
-        self.daemon = True
-        self.start()
+
+def _process_call(payload):
+    '''
+    Run pickled (fn, args, kwargs) task on a ProcessPool process.
+
+    Both task and (success, result or exception) response are pickled
+    here, so unpicklable values are reported as task errors instead of
+    being lost by multiprocessing.
+    '''
+    try:
+        fn, args, kwargs = pickle.loads(payload)
+        response = (True, fn(*args, **kwargs))
+    except BaseException as e:
+        response = (False, e)
+    try:
+        return pickle.dumps(response, pickle.HIGHEST_PROTOCOL)
+    except BaseException as e:
+        return pickle.dumps((False, RuntimeError(repr(e))), pickle.HIGHEST_PROTOCOL)
+
+
+class ProcessPool(object):
+    '''
+    Pool of worker processes for CPU-bound tasks, which would hold the
+    GIL if run on TaskPool threads. Processes are started on first
+    submit.
+
+    Tasks, arguments and results must be picklable, so tasks should be
+    module-level functions. If multiprocessing is not available, tasks
+    run on TaskPool threads instead.
+    '''
+    _all_pools = []
+    def __init__(self, processes=None):
+        self._all_pools.append(self) # We collect all pools for convenience
+
+        self.processes = processes
+        self._pool = None
+        self._lock = threading.Lock()
+
+    @property
+    def pool(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = False # Do not retry on error
+                if multiprocessing:
+                    try:
+                        self._pool = multiprocessing.Pool(
+                            self.processes or max(1, multiprocessing.cpu_count() - 1))
+                    except BaseException as e:
+                        logging.exception(e)
+            return self._pool or None
+
+    def submit(self, fn, args=(), kwargs=None):
+        '''
+        Run fn(*args, **kwargs) on a worker process.
+
+        Returns:
+            Future object.
+        '''
+        pool = self.pool
+        if pool is None:
+            return _taskpool.submit(fn, args, kwargs)
+        future = Future(fn, args, kwargs)
+        future._claim()
+        try:
+            payload = pickle.dumps((fn, args, kwargs or {}), pickle.HIGHEST_PROTOCOL)
+        except BaseException as e:
+            future._finish(exception=e)
+            return future
+        def done(response):
+            # Called on multiprocessing result handler thread, which
+            # must not die
+            try:
+                success, value = pickle.loads(response)
+            except BaseException as e:
+                success, value = False, e
+            if success:
+                future._finish(value)
+            else:
+                future._finish(exception=value)
+        pool.apply_async(_process_call, (payload,), callback=done)
+        return future
+
+    def clean(self):
+        '''
+        Wait for submitted tasks and stop worker processes.
+        '''
+        with self._lock:
+            pool = self._pool
+            self._pool = None
+        if pool:
+            pool.close()
+            pool.join()
+
+    @classmethod
+    def clean_all(cls):
+        for pool in cls._all_pools:
+            pool.clean()
+
+
+class OutputBuffer(object):
+    '''
+    Output of a pipe watched by OutputCollector.
+
+    Only last `maxsize` bytes are kept (as a deque of chunks), while
+    `received` counts every byte read. Given callbacks are called from
+    collector thread with every chunk read and with every complete line
+    (trailing newline included).
+    '''
+    def __init__(self, collector, fileobj, maxsize, line_callback=None, chunk_callback=None):
+        self.collector = collector
+        self.fileobj = fileobj
+        self.fd = fileobj.fileno()
+        self.maxsize = maxsize
+        self.received = 0
+        self.closed = False
+        self._line_callback = line_callback
+        self._chunk_callback = chunk_callback
+        self._chunks = collections.deque()
+        self._size = 0
+        self._partial_line = ""
+        self._lock = threading.Lock()
 
     @property
     def value(self):
-        with self._l:
-            if self._v:
-                self._b += "".join(self._v)
-                self._v.clear()
-        return self._b
+        with self._lock:
+            if len(self._chunks) > 1:
+                data = "".join(self._chunks)
+                self._chunks.clear()
+                self._chunks.append(data)
+            return self._chunks[0] if self._chunks else ""
 
     def __len__(self):
-        return len(self._b) + len(self._v)
+        return self._size
 
     def finish(self):
-        self._r = False
+        '''
+        Stop reading from pipe.
+        '''
+        self.collector.unwatch(self)
+
+    def _feed(self, data):
+        with self._lock:
+            self.received += len(data)
+            self._chunks.append(data)
+            self._size += len(data)
+            while self._size - len(self._chunks[0]) >= self.maxsize:
+                self._size -= len(self._chunks.popleft())
+            if self._size > self.maxsize:
+                first = self._chunks.popleft()
+                self._chunks.appendleft(first[self._size - self.maxsize:])
+                self._size = self.maxsize
+        if self._chunk_callback:
+            self._call(self._chunk_callback, data)
+        if self._line_callback:
+            lines = (self._partial_line + data).split("\n")
+            self._partial_line = lines.pop()
+            for line in lines:
+                self._call(self._line_callback, line + "\n")
+
+    def _eof(self):
+        self.closed = True
+        if self._line_callback and self._partial_line:
+            self._call(self._line_callback, self._partial_line)
+            self._partial_line = ""
+
+    def _call(self, callback, data):
+        try:
+            callback(data)
+        except BaseException as e:
+            logging.exception(e)
+
+
+class OutputCollector(object):
+    '''
+    Reads subprocess pipes in chunks of up to `chunksize` bytes, all of
+    them from a single thread using poll (or select where poll is not
+    available). Thread is started on demand and exits when no pipe is
+    left.
+
+    Windows pipes are not selectable, so there every pipe gets its own
+    reader thread, still reading in chunks.
+    '''
+    chunksize = 65536
+    buffer_class = OutputBuffer
+
+    def __init__(self):
+        self._buffers = {} # fd: OutputBuffer
+        self._lock = threading.Lock()
+        self._thread = None
+        self._wakeup = None
+
+    def watch(self, fileobj, maxsize=1 << 20, line_callback=None, chunk_callback=None):
+        '''
+        Start collecting output from given pipe file object.
+
+        Params:
+            fileobj: pipe file object, as Popen.stdout, which must not be
+                     read elsewhere.
+            maxsize: bytes of output kept on returned buffer.
+            line_callback: optional, called with every line.
+            chunk_callback: optional, called with every chunk read.
+
+        Returns:
+            OutputBuffer object
+        '''
+        buff = self.buffer_class(self, fileobj, maxsize, line_callback, chunk_callback)
+        if my_env.is_windows:
+            t = threading.Thread(target=self._read_blocking, args=(buff,), name="OutputCollector")
+            t.daemon = True
+            t.start()
+            return buff
+        with self._lock:
+            self._buffers[buff.fd] = buff
+            if self._thread is None:
+                self._wakeup = os.pipe()
+                self._thread = threading.Thread(target=self._run, name="OutputCollector")
+                self._thread.daemon = True
+                self._thread.start()
+            else:
+                os.write(self._wakeup[1], "\0")
+        return buff
+
+    def unwatch(self, buff):
+        '''
+        Stop collecting output for given OutputBuffer.
+        '''
+        buff.closed = True
+        with self._lock:
+            if self._buffers.get(buff.fd) is buff:
+                del self._buffers[buff.fd]
+                os.write(self._wakeup[1], "\0")
 
-    def run(self):
+    def _read_blocking(self, buff):
         try:
-            s = self._f.read(1)
-            while self._r and s:
-                with self._l:
-                    self._v.append(s)
-                s = self._f.read(1)
-        except:
+            data = os.read(buff.fd, self.chunksize)
+            while data and not buff.closed:
+                buff._feed(data)
+                data = os.read(buff.fd, self.chunksize)
+        except (IOError, OSError):
             pass
+        buff._eof()
+
+    def _wait(self, fds):
+        if hasattr(select, "poll"):
+            poller = select.poll()
+            for fd in fds:
+                poller.register(fd, select.POLLIN | select.POLLPRI)
+            return [fd for fd, event in poller.poll()]
+        return select.select(fds, (), ())[0]
+
+    def _drop(self, fds):
+        with self._lock:
+            dropped = [
+                self._buffers.pop(fd) for fd in fds
+                if fd in self._buffers
+                ]
+        for buff in dropped:
+            buff._eof()
+
+    def _run(self):
+        wakeup_read, wakeup_write = self._wakeup
+        try:
+            while True:
+                with self._lock:
+                    buffers = dict(self._buffers)
+                    if not buffers:
+                        # Exit, next watch will start a new thread
+                        self._thread = None
+                        self._wakeup = None
+                        break
+                try:
+                    ready = self._wait([wakeup_read] + buffers.keys())
+                except (select.error, IOError, OSError) as e:
+                    if e.args[0] == errno.EINTR:
+                        continue
+                    logging.exception(e)
+                    # Drop pipes closed elsewhere, or every pipe if none
+                    # of them can be blamed, so the error is not repeated
+                    invalid = []
+                    for fd in buffers:
+                        try:
+                            os.fstat(fd)
+                        except OSError:
+                            invalid.append(fd)
+                    self._drop(invalid or buffers)
+                    continue
+                for fd in ready:
+                    if fd == wakeup_read:
+                        os.read(wakeup_read, self.chunksize)
+                        continue
+                    buff = buffers[fd]
+                    try:
+                        data = os.read(fd, self.chunksize)
+                    except (IOError, OSError):
+                        data = ""
+                    if data:
+                        buff._feed(data)
+                    else:
+                        with self._lock:
+                            if self._buffers.get(fd) is buff:
+                                del self._buffers[fd]
+                        buff._eof()
+        except BaseException as e:
+            logging.exception(e)
+        finally:
+            with self._lock:
+                if self._thread is threading.current_thread():
+                    # Left by an error, nothing will read these pipes
+                    orphans = self._buffers.values()
+                    self._buffers.clear()
+                    self._thread = None
+                    self._wakeup = None
+                else:
+                    orphans = ()
+            for buff in orphans:
+                buff._eof()
+            os.close(wakeup_read)
+            os.close(wakeup_write)
+
+
+class EventBus(object):
+    '''
+    Cross-thread delivery queue for EventHandler emits.
+
+    Emits put from any thread are delivered in batches, in order, on the
+    thread run by `dispatcher`, a callable scheduling a function call
+    there (as wx.CallAfter). Emits sharing a coalescing key replace each
+    other while pending, so only the latest one is delivered.
+
+    If `is_target` (as is_main_thread) tells the bus it is being used
+    from the target thread, pending emits and the new one are delivered
+    immediately. Emits from handlers are delivered after current batch.
+
+    >>> bus = EventBus(None, lambda: True)
+    >>> calls = []
+    >>> def handler(n):
+    ...     calls.append(n)
+    ...     if n < 2:
+    ...         bus.put(None, handler, n + 1)
+    >>> bus.put(None, handler, 0)
+    >>> calls
+    [0, 1, 2]
+
+    Counters are available as dict on `metrics`: emits, dropped (replaced
+    by coalescing), delivered, batches, and total and max seconds spent
+    on handlers (handler_time, max_handler_time).
+    '''
+    def __init__(self, dispatcher, is_target=None):
+        self.dispatcher = dispatcher
+        self.is_target = is_target
+        self._pending = collections.OrderedDict()
+        self._counter = itertools.count()
+        self._scheduled = False
+        self._flushing = False
+        self._lock = threading.Lock()
+        self._metrics = dict.fromkeys(("emits", "dropped", "delivered", "batches"), 0)
+        self._metrics.update(handler_time=0., max_handler_time=0.)
+
+    @property
+    def metrics(self):
+        with self._lock:
+            metrics = dict(self._metrics)
+            metrics["pending"] = len(self._pending)
+        return metrics
+
+    def put(self, key, callback, *args):
+        '''
+        Queue callback(*args) call, replacing pending one with same key
+        unless key is None.
+        '''
+        with self._lock:
+            self._metrics["emits"] += 1
+            if key is None:
+                key = next(self._counter)
+            elif key in self._pending:
+                self._metrics["dropped"] += 1
+            self._pending[key] = (callback, args)
+            schedule = not self._scheduled
+            self._scheduled = True
+        if self.is_target and self.is_target():
+            self.flush()
+        elif schedule:
+            self.dispatcher(self.flush)
+
+    def flush(self):
+        '''
+        Deliver pending calls on current thread.
+
+        Handlers run without any lock held, calls emitted by them while
+        flushing are left pending for the running flush loop.
+        '''
+        with self._lock:
+            if self._flushing:
+                return
+            self._flushing = True
+        try:
+            while True:
+                with self._lock:
+                    batch = self._pending.values()
+                    self._pending.clear()
+                    self._scheduled = False
+                if not batch:
+                    return
+                handler_time = 0.
+                max_handler_time = 0.
+                for callback, args in batch:
+                    start = time.time()
+                    try:
+                        callback(*args)
+                    except BaseException as e:
+                        logging.exception(e)
+                    elapsed = time.time() - start
+                    handler_time += elapsed
+                    max_handler_time = max(max_handler_time, elapsed)
+                with self._lock:
+                    self._metrics["delivered"] += len(batch)
+                    self._metrics["batches"] += 1
+                    self._metrics["handler_time"] += handler_time
+                    self._metrics["max_handler_time"] = max(self._metrics["max_handler_time"], max_handler_time)
+        finally:
+            with self._lock:
+                self._flushing = False
 
 
 class EventHandler(object):
@@ -1044,17 +2726,39 @@ class EventHandler(object):
             for args in self.__reemits[event_name][1]:
                 handler(*args)
 
-    def emit(self, event_name, *args):
+    __bus = None
+    __coalesce = frozenset()
+    def set_event_bus(self, bus, coalesce=()):
         '''
-        Call registered handlers for 'event_name' with given arguments.
+        Deliver emits through given EventBus instead of calling handlers
+        on emitting thread.
+
+        Params:
+            bus: EventBus instance or None for synchronous delivery.
+            coalesce: optional, event names whose pending emits are
+                      replaced by newer ones with same first argument.
         '''
-        # Run handlers
+        self.__bus = bus
+        self.__coalesce = frozenset(coalesce)
+
+    def _run_handlers(self, event_name, args):
         for handler in self.__handlers.get(event_name, ()):
             try:
                 handler(*args)
             except BaseException as e:
                 logging.exception(e)
 
+    def emit(self, event_name, *args):
+        '''
+        Call registered handlers for 'event_name' with given arguments.
+        '''
+        # Run handlers
+        if self.__bus is None:
+            self._run_handlers(event_name, args)
+        else:
+            key = (id(self), event_name, args[:1]) if event_name in self.__coalesce else None
+            self.__bus.put(key, self._run_handlers, event_name, args)
+
         # Save emit
         if event_name in self.__reemits:
             is_multi, emits = self.__reemits[event_name]
@@ -1066,6 +2770,12 @@ class EventHandler(object):
             self.__reemits[event_name] = (self.__default_reemit_multi, [args])
 
 
+def is_main_thread():
+    '''
+    True if called from main thread (where wx main loop runs)
+    '''
+    return isinstance(threading.current_thread(), threading._MainThread)
+
 def make_hash_obj(obj):
     if hasattr(obj, "__hash__"):
         try:
@@ -1088,6 +2798,8 @@ def hash_obj(obj):
     return hash(make_hash_obj(obj))
 
 _taskpool = TaskPool()
+_iopool = TaskPool() # CheckURL and GetURL requests
+_connection_pool = HTTPConnectionPool()
 def parallelize(*tasks):
     return _taskpool.parallelize(*tasks)
 
@@ -1095,7 +2807,28 @@ def parallelize_iter(tasks):
     return _taskpool.parallelize_iter(tasks)
 
 def async(*args, **kwargs):
-    _taskpool.async(*args, **kwargs)
+    return _taskpool.async(*args, **kwargs)
+
+def submit(*args, **kwargs):
+    return _taskpool.submit(*args, **kwargs)
+
+_processpool = ProcessPool()
+def submit_process(*args, **kwargs):
+    return _processpool.submit(*args, **kwargs)
+
+_output_collector = OutputCollector()
+def collect_output(*args, **kwargs):
+    return _output_collector.watch(*args, **kwargs)
+
+_directory_cache = DirectoryCache("utils.directories")
+def listdir_cached(path):
+    return _directory_cache.listdir(path)
+
+def isdir_cached(path):
+    return _directory_cache.isdir(path)
+
+def exists_cached(path):
+    return _directory_cache.exists(path)
 
 def unix_to_win_version(version):
     if not "-" in version:
@@ -1118,6 +2851,96 @@ def optimport(importable):
     return None
 
 
+def gzip_data(data, compresslevel=6):
+    '''
+    Compress given string as gzip file data
+    '''
+    buff = StringIO.StringIO()
+    with gzip.GzipFile(fileobj=buff, mode="wb", compresslevel=compresslevel, mtime=0) as f:
+        f.write(data)
+    return buff.getvalue()
+
+class JSONFragment(str):
+    '''
+    Already encoded JSON value, inserted verbatim by json_dumps.
+    '''
+    __slots__ = ()
+
+def json_dumps(obj):
+    '''
+    Like json.dumps, but inserting JSONFragment objects found in lists,
+    tuples and dict values as they are.
+
+    >>> json_dumps([("update", {"cards": [JSONFragment('{"a": 1}')]})])
+    '[["update", {"cards": [{"a": 1}]}]]'
+    '''
+    if isinstance(obj, JSONFragment):
+        return obj
+    elif isinstance(obj, (list, tuple)):
+        return "[%s]" % ", ".join(json_dumps(i) for i in obj)
+    elif isinstance(obj, dict):
+        return "{%s}" % ", ".join(
+            "%s: %s" % (json.dumps(k if isinstance(k, basestring) else str(k)), json_dumps(v))
+            for k, v in obj.iteritems())
+    return json.dumps(obj)
+
+def accepts_encoding(header, encoding):
+    '''
+    Get if given HTTP Accept-Encoding header value allows given encoding
+
+    >>> accepts_encoding("gzip, deflate", "gzip")
+    True
+    >>> accepts_encoding("deflate, gzip;q=0", "gzip")
+    False
+    >>> accepts_encoding("", "gzip")
+    False
+    '''
+    for part in header.split(","):
+        name, sep, params = part.partition(";")
+        if name.strip().lower() in (encoding, "*"):
+            params = params.replace(" ", "")
+            if params.startswith("q="):
+                try:
+                    return float(params[2:]) > 0
+                except ValueError:
+                    return False
+            return True
+    return False
+
+def parse_range(header, size):
+    '''
+    Get (start, end) byte positions, end excluded, of given HTTP Range
+    header value for a resource of given size, or None if range is
+    not satisfiable. Only first range of multi-range headers is used.
+
+    >>> parse_range("bytes=0-499", 1000)
+    (0, 500)
+    >>> parse_range("bytes=500-", 1000)
+    (500, 1000)
+    >>> parse_range("bytes=-200", 1000)
+    (800, 1000)
+    >>> parse_range("bytes=900-2000, 0-1", 1000)
+    (900, 1000)
+    >>> parse_range("bytes=1000-", 1000) is None
+    True
+    >>> parse_range("items=0-1", 1000) is None
+    True
+    '''
+    unit, sep, ranges = header.partition("=")
+    if unit.strip().lower() != "bytes":
+        return None
+    start, sep, end = ranges.split(",", 1)[0].partition("-")
+    try:
+        if not start.strip(): # suffix range
+            return (max(size - int(end), 0), size) if int(end) > 0 and size else None
+        start = int(start)
+        end = int(end) + 1 if end.strip() else size
+    except ValueError:
+        return None
+    if start >= size or end <= start:
+        return None
+    return (start, min(end, size))
+
 def sizeof_fmt(number, b1024=False, fmt="%.1f %s"):
     "sizeof_fmt(25331, b1024=True)  ->  '24.7 KiB'"
 
@@ -1190,6 +3013,11 @@ def get_resource_exists(path):
         return os.path.exists(os.path.join(config.RESOURCESDIR, path))
     return pkg_resources.resource_exists(__name__, path)
 
+def get_resource_listdir(path):
+    if my_env.is_linux or my_env.is_frozen:
+        return os.listdir(os.path.join(config.RESOURCESDIR, path))
+    return pkg_resources.resource_listdir(__name__, path)
+
 def get_resource_isdir(path):
     if my_env.is_linux or my_env.is_frozen:
         return os.path.isdir(os.path.join(config.RESOURCESDIR, path))
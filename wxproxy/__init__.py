@@ -797,7 +797,7 @@ class WxProxy(object):
     _proxy_blacklist = _proxy_classes = ()
     _class_cache = {} # Cache of wrapped clases by wx type
 
-    _obj_cache = utils.WeakCappedDict(10) # utils.CappedDict(1000)
+    _obj_cache = utils.WeakCappedDict(10, name="wxproxy.objects")
     def __new__(cls, *args, **kwargs):
         # Let's try to construct a WxProxy object
         if cls == WxProxy: